@@ -8,6 +8,9 @@ class AssignmentsConfig(AppConfig):
     name = "assignments"
 
     def ready(self):
+        # keeps the assignment engine up to date with changes to proxies
+        from assignments import signals
+
         # Your function to run on startup
         if os.environ.get("RUN_MAIN") == "FALSE":
             startup.test_startup()
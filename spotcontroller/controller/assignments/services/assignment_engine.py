@@ -0,0 +1,324 @@
+import threading
+from random import choice
+
+import numpy as np
+
+from assignments.models import Proxy, Client, Assignment, ProxyReport
+from assignments.services.scoring import (
+    normalized_distances,
+    client_base_utilities,
+    proxy_base_utilities,
+    with_distance,
+)
+
+# the Enem19 weights and utilization cap AssignmentView has always used
+ALPHAS = (1, 1, 1, 1, 1)
+BETAS = (1, 1, 1, 1)
+UTILIZATION_CAP = 50
+INITIAL_SLOTS = 1024
+
+
+class ProxyStats:
+    def __init__(self, proxy: Proxy, slot):
+        self.id = proxy.id
+        self.ip = proxy.ip
+        # index of the proxy in the engine's arrays
+        self.slot = slot
+        # client ips ever assigned to the proxy, and those in its last report
+        self.known_by = set()
+        self.connected = set()
+        self.is_blocked = proxy.is_blocked
+        self.is_active = proxy.is_active
+
+
+class ClientStats:
+    def __init__(self, client: Client):
+        self.ip = client.ip
+        self.latitude = client.latitude
+        self.longitude = client.longitude
+        self.requests = 0
+        # number of proxy reports the client showed up in
+        self.reports = 0
+        self.known_proxies = set()
+
+
+class AssignmentEngine:
+    """
+    The counters AssignmentView scores proxies with, kept in memory and updated
+    as assignments, proxy changes, reports and telemetry happen, so choosing a
+    proxy is arithmetic over the proxies rather than two queries per proxy.
+
+    Each proxy has a slot in NumPy arrays of locations and counters, which
+    choose() scores all at once; removed proxies leave an unusable slot behind.
+
+    Saved and deleted proxies reach it through the signals in
+    assignments/signals.py, wherever the change was made.
+
+    The engine is state of the process it lives in: signals only reach the
+    engine of the process that saved the proxy, and each process hands out its
+    own copy of a proxy's capacity. So the controller has to be served by a
+    single process (manage.py runserver, or one worker with threads); scripts
+    that change proxies from another process are seen after a restart.
+
+    Loaded from the database on first use; until then the update methods do
+    nothing, as load() will read what they would have recorded.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.reset()
+
+    def reset(self):
+        self.proxies = {}
+        self.proxies_by_ip = {}
+        self.clients = {}
+        # ProxyStats by slot, None where a proxy was removed
+        self.slots = []
+        self.latitudes = np.zeros(INITIAL_SLOTS)
+        self.longitudes = np.zeros(INITIAL_SLOTS)
+        self.capacities = np.zeros(INITIAL_SLOTS, dtype=np.int64)
+        self.known_counts = np.zeros(INITIAL_SLOTS, dtype=np.int64)
+        self.connected_counts = np.zeros(INITIAL_SLOTS, dtype=np.int64)
+        # present, active and not blocked; capacity is checked separately
+        self.usable = np.zeros(INITIAL_SLOTS, dtype=bool)
+
+    def load(self):
+        with self.lock:
+            self.reset()
+            for proxy in Proxy.objects.order_by("id"):
+                self._add_proxy(proxy)
+            self.clients = {
+                client.ip: ClientStats(client) for client in Client.objects.all()
+            }
+            for proxy_id, client_ip in Assignment.objects.values_list(
+                "proxy_id", "client_id"
+            ):
+                self._assign(proxy_id, client_ip)
+
+            # every report counts towards its clients' utilization, and the last
+            # one of each proxy says who is connected to it now
+            last_reports = {}
+            for report_id, proxy_id in ProxyReport.objects.order_by(
+                "created_at"
+            ).values_list("uuid", "proxy_id"):
+                last_reports[proxy_id] = report_id
+            proxy_of_report = {
+                report_id: proxy_id for proxy_id, report_id in last_reports.items()
+            }
+            through = ProxyReport.connected_clients.through
+            for report_id, client_ip in through.objects.values_list(
+                "proxyreport_id", "client_id"
+            ).iterator():
+                if client_ip in self.clients:
+                    self.clients[client_ip].reports += 1
+                proxy_id = proxy_of_report.get(report_id)
+                if proxy_id in self.proxies:
+                    self.proxies[proxy_id].connected.add(client_ip)
+            for proxy in self.proxies.values():
+                self.connected_counts[proxy.slot] = len(proxy.connected)
+            self.loaded = True
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _grow(self):
+        for name in (
+            "latitudes",
+            "longitudes",
+            "capacities",
+            "known_counts",
+            "connected_counts",
+            "usable",
+        ):
+            array = getattr(self, name)
+            grown = np.zeros(2 * len(array), dtype=array.dtype)
+            grown[: len(array)] = array
+            setattr(self, name, grown)
+
+    def _add_proxy(self, proxy: Proxy):
+        if len(self.slots) == len(self.usable):
+            self._grow()
+        stats = ProxyStats(proxy, len(self.slots))
+        self.slots.append(stats)
+        self.proxies[proxy.id] = stats
+        self.proxies_by_ip[proxy.ip] = stats
+        self._update_proxy(stats, proxy)
+
+    def _update_proxy(self, stats: ProxyStats, proxy: Proxy):
+        if proxy.ip != stats.ip:
+            if self.proxies_by_ip.get(stats.ip) is stats:
+                del self.proxies_by_ip[stats.ip]
+            stats.ip = proxy.ip
+            self.proxies_by_ip[proxy.ip] = stats
+        stats.is_blocked = proxy.is_blocked
+        stats.is_active = proxy.is_active
+        # proxies made without the manager have no location, and score last
+        self.latitudes[stats.slot] = (
+            np.nan if proxy.latitude is None else proxy.latitude
+        )
+        self.longitudes[stats.slot] = (
+            np.nan if proxy.longitude is None else proxy.longitude
+        )
+        self.capacities[stats.slot] = proxy.capacity
+        self.usable[stats.slot] = not proxy.is_blocked and proxy.is_active
+
+    def _assign(self, proxy_id, client_ip):
+        proxy = self.proxies.get(proxy_id)
+        client = self.clients.get(client_ip)
+        if proxy is None or client is None:
+            return
+        if client_ip not in proxy.known_by:
+            proxy.known_by.add(client_ip)
+            self.known_counts[proxy.slot] += 1
+        client.known_proxies.add(proxy_id)
+        client.requests += 1
+
+    def assign(self, proxy_id, client_ip):
+        with self.lock:
+            if self.loaded:
+                self._assign(proxy_id, client_ip)
+
+    def add_client(self, client: Client):
+        with self.lock:
+            if self.loaded and client.ip not in self.clients:
+                self.clients[client.ip] = ClientStats(client)
+
+    def add_proxy(self, proxy: Proxy):
+        """
+        Records a new proxy, or the new ip, location, capacity, blocked or
+        active state of a known one
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            stats = self.proxies.get(proxy.id)
+            if stats is None:
+                self._add_proxy(proxy)
+            else:
+                self._update_proxy(stats, proxy)
+
+    update_proxy = add_proxy
+
+    def remove_proxy(self, proxy_id):
+        with self.lock:
+            if not self.loaded:
+                return
+            stats = self.proxies.pop(proxy_id, None)
+            if stats is None:
+                return
+            if self.proxies_by_ip.get(stats.ip) is stats:
+                del self.proxies_by_ip[stats.ip]
+            self.slots[stats.slot] = None
+            self.usable[stats.slot] = False
+            for client_ip in stats.known_by:
+                client = self.clients.get(client_ip)
+                if client is not None:
+                    client.known_proxies.discard(proxy_id)
+
+    def report(self, proxy_id, client_ips):
+        with self.lock:
+            if not self.loaded:
+                return
+            for client_ip in client_ips:
+                client = self.clients.get(client_ip)
+                if client is not None:
+                    client.reports += 1
+            proxy = self.proxies.get(proxy_id)
+            if proxy is not None:
+                proxy.connected = set(client_ips)
+                self.connected_counts[proxy.slot] = len(proxy.connected)
+
+    def update_connected(self, proxy_ip, count):
+        """
+        A fresher count of the proxy's clients than its last report, from its
+        telemetry
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            proxy = self.proxies_by_ip.get(proxy_ip)
+            if proxy is not None:
+                self.connected_counts[proxy.slot] = count
+
+    def capacity(self, proxy_id):
+        return int(self.capacities[self.proxies[proxy_id].slot])
+
+    def available(self):
+        count = len(self.slots)
+        return self.usable[:count] & (self.capacities[:count] > 0)
+
+    def random_proxy(self):
+        with self.lock:
+            available = np.flatnonzero(self.available())
+            return self.slots[choice(available)] if len(available) else None
+
+    def choose(self, client_ip) -> ProxyStats:
+        """
+        The available proxy with the highest product of the client's and the
+        proxy's utility, as AssignmentView has always scored them
+        """
+        alpha5, beta4 = ALPHAS[4], BETAS[3]
+        with self.lock:
+            available = self.available()
+            if not available.any():
+                return None
+            client = self.clients[client_ip]
+            known_blocked = [
+                self.proxies[proxy_id]
+                for proxy_id in client.known_proxies
+                if self.proxies[proxy_id].is_blocked
+            ]
+            blocked_proxy_usage = sum(
+                1 for proxy in known_blocked if client_ip not in proxy.connected
+            )
+            client_base = client_base_utilities(
+                client.reports,
+                client.requests,
+                blocked_proxy_usage,
+                len(known_blocked),
+                ALPHAS,
+                UTILIZATION_CAP,
+            )
+
+            count = len(self.slots)
+            distances = normalized_distances(
+                client.latitude,
+                client.longitude,
+                self.latitudes[:count],
+                self.longitudes[:count],
+            )
+            proxy_base = proxy_base_utilities(
+                self.known_counts[:count], self.connected_counts[:count], BETAS
+            )
+            values = with_distance(client_base, distances, alpha5, axis=0) * (
+                with_distance(proxy_base, distances, beta4, axis=1)
+            )
+            values[~available | np.isnan(values)] = -np.inf
+            return self.slots[int(np.argmax(values))]
+
+    def take(self, proxy: ProxyStats, client_ip):
+        """
+        Assigns the client to the proxy and uses up one of its slots
+        """
+        with self.lock:
+            self.capacities[proxy.slot] -= 1
+            self._assign(proxy.id, client_ip)
+
+    def assign_new(self, client_ip, at_random=False) -> ProxyStats:
+        """
+        choose() (or a random available proxy) and take() in one go, so
+        concurrent requests cannot both get a proxy's last slot
+        """
+        with self.lock:
+            if at_random:
+                proxy = self.random_proxy()
+            else:
+                proxy = self.choose(client_ip)
+            if proxy is not None:
+                self.take(proxy, client_ip)
+            return proxy
+
+
+assignment_engine = AssignmentEngine()
@@ -1,46 +1,153 @@
 import threading
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct
+from time import sleep, time
 import socket
 import json
 
+from django.db import transaction
+
 from assignments.models import Proxy, ProxyReport, Client
+from assignments.services.assignment_engine import assignment_engine
+
+# proxies prefix every report with its length as a big-endian u64
+LENGTH_PREFIX = Struct(">Q")
+
+
+def recv_exact(sock: socket.socket, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(min(length - len(data), 1024 * 1024))
+        if not chunk:
+            raise ConnectionResetError("proxy closed the connection mid-report")
+        data += chunk
+    return bytes(data)
+
+
+def save_reports(results):
+    """
+    Saves (proxy, report) pairs as ProxyReports in one go: one ip__in lookup finds
+    the clients of every report and the links go in with one bulk_create on the
+    through table
+    """
+    reports = [
+        ProxyReport(
+            proxy=proxy,
+            utility=report["utility"],
+            throughput=report["throughput"],
+        )
+        for proxy, report in results
+    ]
+    all_ips = set().union(*(report["connected_clients"] for _, report in results))
+    through = ProxyReport.connected_clients.through
+    with transaction.atomic():
+        ProxyReport.objects.bulk_create(reports)
+        known_ips = set(
+            Client.objects.filter(ip__in=all_ips).values_list("ip", flat=True)
+        )
+        through.objects.bulk_create(
+            [
+                through(proxyreport_id=proxy_report.pk, client_id=ip)
+                for proxy_report, (_, report) in zip(reports, results)
+                for ip in report["connected_clients"]
+                if ip in known_ips
+            ],
+            batch_size=5000,
+        )
+    for proxy, report in results:
+        assignment_engine.report(proxy.id, report["connected_clients"])
+    return reports
 
 
 class PollerThread(threading.Thread):
+    """
+    Every `polling_frequency_mins` polls all active proxies, up to `workers` at a
+    time, giving up on a proxy after `timeout` seconds, and saves the round's
+    reports together. Each proxy is asked only for the clients that changed since
+    the last report it sent.
+    """
+
     # def __init__(self, listen_endpoint: tuple, forward_endpoint: tuple):
-    def __init__(self):
+    def __init__(
+        self, polling_frequency_mins=5, polling_port=8120, workers=32, timeout=5
+    ):
         threading.Thread.__init__(self)
-        self.polling_frequency_mins = 5
+        self.polling_frequency_mins = polling_frequency_mins
+        self.polling_port = polling_port
+        self.workers = workers
+        self.timeout = timeout
+        # proxy ip -> (client list version, set of client ips) as last reported
+        self.known_clients = {}
+        self.last_round_duration = None
         # self.forward_endpoint = forward_endpoint
 
+    def poll(self, proxy_ip):
+        """
+        Returns the proxy's report, with "connected_clients" filled in from the
+        delta it answered with
+        """
+        # version 0 is the empty list, so the first answer holds every client
+        version, clients = self.known_clients.get(proxy_ip, (0, set()))
+        message = f"delta {version}"
+        with socket.create_connection(
+            (proxy_ip, self.polling_port), timeout=self.timeout
+        ) as client_socket:
+            client_socket.sendall(message.encode("utf-8"))
+            header = recv_exact(client_socket, LENGTH_PREFIX.size)
+            report = json.loads(recv_exact(client_socket, LENGTH_PREFIX.unpack(header)[0]))
+
+        delta = report.pop("clients", None)
+        if delta is None:
+            clients = set(report["connected_clients"])
+        elif delta["full"]:
+            clients = set(delta["clients"])
+        else:
+            clients = (clients - set(delta["removed"])) | set(delta["added"])
+        if delta is not None:
+            self.known_clients[proxy_ip] = (delta["version"], clients)
+        report["connected_clients"] = clients
+        return report
+
+    def poll_round(self):
+        # telemetry imports this module, so the table is looked up here
+        from assignments.services.telemetry import telemetry_table
+
+        start_time = time()
+        # proxies pushing telemetry get their reports from the snapshot thread
+        pushing = telemetry_table.current().keys()
+        active_proxies = list(
+            Proxy.objects.filter(
+                is_blocked=False, is_active=True, capacity__gt=0
+            ).exclude(ip__in=pushing)
+        )
+        results = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            polls = {
+                proxy: executor.submit(self.poll, proxy.ip) for proxy in active_proxies
+            }
+            for proxy, poll in polls.items():
+                try:
+                    results.append((proxy, poll.result()))
+                except (OSError, ValueError, KeyError) as e:
+                    failed.append(proxy.ip)
+                    print(f"ERROR: could not poll {proxy.ip}: {e}")
+        polled_time = time()
+        save_reports(results)
+        self.last_round_duration = time() - start_time
+        print(
+            f"poll round: {len(results)}/{len(active_proxies)} proxies in "
+            f"{self.last_round_duration:.3f}s (polling {polled_time - start_time:.3f}s, "
+            f"saving {time() - polled_time:.3f}s), {len(failed)} failed"
+        )
+        return results, failed
+
     def run(self):
-        polling_port = 8120
-        try:
-            while True:
-                sleep(self.polling_frequency_mins * 60)
-                active_proxies = Proxy.objects.filter(
-                    is_blocked=False, is_active=True, capacity__gt=0
-                ).all()
-                for proxy in active_proxies:
-                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    client_socket.connect((proxy.ip, polling_port))
-                    message = "hello"
-                    client_socket.send(message.encode("utf-8"))
-                    data = client_socket.recv(8192)
-                    client_socket.close()
-
-                    report_dict = json.loads(data.decode())
-                    report = ProxyReport.objects.create(
-                        proxy=proxy,
-                        utility=report["utility"],
-                        throughput=report["throughput"],
-                    )
-                    for client_ip in report_dict["connected_clients"]:
-                        if Client.objects.filter(ip=client_ip).count() != 0:
-                            client = Client.objects.get(ip=client_ip)
-                            report.connected_clients.add(client)
-                    report.save()
-
-        except Exception as e:
-            print("ERROR: a fatal error has happened")
-            print(e)
+        while True:
+            # rounds start every polling_frequency_mins, however long the last one took
+            sleep(max(0, self.polling_frequency_mins * 60 - (self.last_round_duration or 0)))
+            try:
+                self.poll_round()
+            except Exception as e:
+                print("ERROR: a fatal error has happened")
+                print(e)
@@ -0,0 +1,113 @@
+"""
+The Enem19 utilities for every client and proxy pair at once, as NumPy arrays,
+for AssignmentView (through the assignment engine) and the simulator.
+
+Every utility is computed with the same operations, in the same order, as the
+per-pair Python code it replaces, so scores and preference orders come out the
+same down to ties.
+"""
+import numpy as np
+
+from scripts.config_basic import CENSORED_REGION_SIZE
+
+TOP_PREFERENCES_ROWS = 1024
+
+
+def normalized_distances(latitudes, longitudes, proxy_latitudes, proxy_longitudes):
+    """
+    (clients, proxies) matrix of distances over CENSORED_REGION_SIZE; for one
+    client, given as scalars, a vector over the proxies
+    """
+    dx = np.subtract.outer(latitudes, proxy_latitudes)
+    dy = np.subtract.outer(longitudes, proxy_longitudes)
+    return np.sqrt(dx * dx + dy * dy) / CENSORED_REGION_SIZE
+
+
+def client_base_utilities(
+    utilization, requests, blocked_proxy_usage, known_blocked, alphas, cap
+):
+    """
+    The distance-free part of each client's utility, over arrays of clients
+    """
+    alpha1, alpha2, alpha3, alpha4 = alphas[:4]
+    return (
+        alpha1 * np.minimum(utilization, cap)
+        - alpha2 * np.asarray(requests)
+        - alpha3 * np.asarray(blocked_proxy_usage)
+        - alpha4 * np.asarray(known_blocked)
+    )
+
+
+def proxy_base_utilities(known_by, connected, betas, total_utilization=0):
+    """
+    The distance-free part of each proxy's utility, over arrays of proxies
+    """
+    beta1, beta2, beta3 = betas[:3]
+    return (
+        beta1 * np.asarray(known_by)
+        + beta2 * np.asarray(connected)
+        + beta3 * total_utilization
+    )
+
+
+def with_distance(base_utilities, distances, weight, axis):
+    """
+    base_utilities (of the clients, axis=0, or of the proxies, axis=1) minus
+    weight times the distance, for every pair in distances
+    """
+    base = np.asarray(base_utilities, dtype=float)
+    if distances.ndim == 2 and axis == 0:
+        base = base[:, None]
+    return base - weight * distances
+
+
+def preference_order(utilities):
+    """
+    Indices along the last axis from the highest utility down, ties in the order
+    reversed(sorted(...)) puts them
+    """
+    return np.argsort(utilities, axis=-1, kind="stable")[..., ::-1]
+
+
+def top_preferences(utilities, k):
+    """
+    The first k of each row's preference_order(), found with argpartition
+    instead of sorting whole rows. Rows with a tie across the k-th place are
+    sorted in full, so the result is always a prefix of preference_order() and a
+    longer list extends a shorter one. A k past the number of columns gives
+    whole rows.
+    """
+    if k < 1:
+        raise ValueError(f"top_preferences needs k >= 1, got {k}")
+    size = utilities.shape[-1]
+    if k >= size:
+        return preference_order(utilities)
+    if utilities.ndim == 2 and len(utilities) > TOP_PREFERENCES_ROWS:
+        # a block of rows at a time, so the partitioning never holds a copy of
+        # the whole matrix
+        return np.concatenate(
+            [
+                top_preferences(utilities[i : i + TOP_PREFERENCES_ROWS], k)
+                for i in range(0, len(utilities), TOP_PREFERENCES_ROWS)
+            ]
+        )
+    top = np.argpartition(-utilities, k - 1, axis=-1)[..., :k]
+    top_utilities = np.take_along_axis(utilities, top, axis=-1)
+    # highest utility first, and the higher index first among equal ones, as
+    # preference_order() has them
+    order = np.lexsort((-top, -top_utilities), axis=-1)
+    top = np.take_along_axis(top, order, axis=-1)
+    # argpartition keeps any of the entries equal to the k-th utility, not
+    # necessarily the higher indices preference_order() puts first
+    kth = top_utilities.min(axis=-1, keepdims=True)
+    tied = (utilities == kth).sum(axis=-1) > (top_utilities == kth).sum(axis=-1)
+    if tied.any():
+        top[tied] = preference_order(utilities[tied])[..., :k]
+    return top
+
+
+def preference_lists(utilities, names):
+    """
+    Each row's names, most preferred first
+    """
+    return np.asarray(names, dtype=object)[preference_order(utilities)].tolist()
@@ -0,0 +1,123 @@
+from math import floor
+
+import numpy as np
+
+
+class ProxyGrid:
+    """
+    Proxy slots bucketed by location into square cells of cell_size, so the
+    proxies nearest a point are found by looking at the cells around it, ring by
+    ring, instead of at every proxy.
+
+    The grid only keeps slots; their coordinates are read from the arrays passed
+    to nearest(), such as an AssignmentEngine's. The engine itself keeps no grid,
+    as choose() scores every proxy; benchmark_assignments measures the lookup.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cell_of = {}
+        # bounds of the cells that have held a slot, so a search knows when to stop
+        self.bounds = None
+
+    def __len__(self):
+        return len(self.cell_of)
+
+    def __contains__(self, slot):
+        return slot in self.cell_of
+
+    def _cell(self, latitude, longitude):
+        return (
+            floor(latitude / self.cell_size),
+            floor(longitude / self.cell_size),
+        )
+
+    def add(self, slot, latitude, longitude):
+        """
+        Puts the slot in the cell of its location, moving it if it was elsewhere
+        """
+        cell = self._cell(latitude, longitude)
+        if self.cell_of.get(slot) == cell:
+            return
+        self.remove(slot)
+        self.cells.setdefault(cell, set()).add(slot)
+        self.cell_of[slot] = cell
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            self.bounds[0] = min(self.bounds[0], cell[0])
+            self.bounds[1] = max(self.bounds[1], cell[0])
+            self.bounds[2] = min(self.bounds[2], cell[1])
+            self.bounds[3] = max(self.bounds[3], cell[1])
+
+    def remove(self, slot):
+        cell = self.cell_of.pop(slot, None)
+        if cell is None:
+            return
+        slots = self.cells[cell]
+        slots.discard(slot)
+        if not slots:
+            del self.cells[cell]
+
+    def _ring(self, center, radius):
+        """
+        The slots in the cells exactly radius cells away from center
+        """
+        ci, cj = center
+        if radius == 0:
+            return list(self.cells.get(center, ()))
+        slots = []
+        for i in range(ci - radius, ci + radius + 1):
+            for j in (cj - radius, cj + radius):
+                slots.extend(self.cells.get((i, j), ()))
+        for j in range(cj - radius + 1, cj + radius):
+            for i in (ci - radius, ci + radius):
+                slots.extend(self.cells.get((i, j), ()))
+        return slots
+
+    def nearest(self, latitude, longitude, k, latitudes, longitudes, accept=None):
+        """
+        Array of the (up to) k slots nearest the point, nearest first and the
+        lower slot first at equal distance. accept(slots), if given, returns
+        which of an array of slots may be picked.
+
+        Cells are searched outwards until k slots are found and no cell further
+        out can hold anything nearer than the k-th, so in a grid whose cells
+        hold a few slots each only the cells around the point are looked at.
+        """
+        if not self.cell_of or k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        center = self._cell(latitude, longitude)
+        # rings past this one hold no cells that were ever filled
+        last_radius = max(
+            center[0] - self.bounds[0],
+            self.bounds[1] - center[0],
+            center[1] - self.bounds[2],
+            self.bounds[3] - center[1],
+        )
+        found_slots = []
+        found_distances = []
+        found = 0
+        for radius in range(last_radius + 1):
+            ring = self._ring(center, radius)
+            if ring:
+                slots = np.array(ring, dtype=np.int64)
+                if accept is not None:
+                    slots = slots[accept(slots)]
+                dx = latitudes[slots] - latitude
+                dy = longitudes[slots] - longitude
+                found_slots.append(slots)
+                found_distances.append(np.sqrt(dx * dx + dy * dy))
+                found += len(slots)
+            # the point lies in the center cell, so every cell of the next ring
+            # is at least radius cells away from it
+            if found >= k:
+                distances = np.concatenate(found_distances)
+                if np.partition(distances, k - 1)[k - 1] <= radius * self.cell_size:
+                    break
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        slots = np.concatenate(found_slots)
+        distances = np.concatenate(found_distances)
+        return slots[np.lexsort((slots, distances))[:k]]
@@ -5,7 +5,7 @@ from time import time, sleep
 
 def startup():
     from assignments.models import Proxy
-    from assignments.services import poller_threads
+    from assignments.services import poller_threads, telemetry
 
     if Proxy.objects.all().count() != 0:
         # Note: can be changed if needed
@@ -27,6 +27,9 @@ def startup():
 
     poller_thread = poller_threads.PollerThread()
     poller_thread.start()
+    # proxies push their load between polls; snapshots keep the report history
+    telemetry.TelemetryReceiverThread().start()
+    telemetry.TelemetrySnapshotThread().start()
 
     # TODO: Add a system for migrations and stuff, since we don't have the push for the current test
 
@@ -0,0 +1,156 @@
+import threading
+import socket
+import json
+from time import sleep, time
+
+from assignments.models import Proxy
+from assignments.services.assignment_engine import assignment_engine
+from assignments.services.poller_threads import LENGTH_PREFIX, recv_exact, save_reports
+
+TELEMETRY_PORT = 8123
+# seconds after its last push that a proxy's telemetry still counts as current
+TELEMETRY_MAX_AGE = 10
+
+
+class ProxyState:
+    def __init__(self, ip):
+        self.ip = ip
+        self.utility = 0
+        self.throughput = 0
+        self.connections = 0
+        self.clients = set()
+        self.version = None
+        self.sampled_at = None
+        self.received_at = 0
+
+
+class TelemetryTable:
+    """
+    The latest telemetry pushed by every proxy, by proxy IP, kept in memory so
+    assignments can use it without waiting for the next poll or snapshot
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def apply(self, ip, message):
+        clients = message["clients"]
+        with self.lock:
+            state = self.states.get(ip)
+            if state is None:
+                state = self.states[ip] = ProxyState(ip)
+            if clients["full"]:
+                state.clients = set(clients["clients"])
+            else:
+                state.clients -= set(clients["removed"])
+                state.clients |= set(clients["added"])
+            state.version = clients["version"]
+            state.utility = message["utility"]
+            state.throughput = message["throughput"]
+            state.connections = message["connections"]
+            state.sampled_at = message["sampled_at"]
+            state.received_at = time()
+            connected = len(state.clients)
+        assignment_engine.update_connected(ip, connected)
+
+    def connected_clients(self, ip, max_age=TELEMETRY_MAX_AGE):
+        """
+        Number of clients on the proxy, or None without current telemetry from it
+        """
+        with self.lock:
+            state = self.states.get(ip)
+            if state is None or time() - state.received_at > max_age:
+                return None
+            return len(state.clients)
+
+    def current(self, max_age=TELEMETRY_MAX_AGE):
+        """
+        {ip: report} for every proxy that pushed within max_age seconds, in the
+        shape ProxyReports are saved from
+        """
+        now = time()
+        with self.lock:
+            return {
+                ip: {
+                    "utility": state.utility,
+                    "throughput": state.throughput,
+                    "connected_clients": set(state.clients),
+                }
+                for ip, state in self.states.items()
+                if now - state.received_at <= max_age
+            }
+
+
+telemetry_table = TelemetryTable()
+
+
+class TelemetryConnectionThread(threading.Thread):
+    def __init__(
+        self, proxy_socket: socket.socket, proxy_address, table: TelemetryTable
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.proxy_socket = proxy_socket
+        self.proxy_address = proxy_address
+        self.table = table
+
+    def run(self):
+        try:
+            with self.proxy_socket:
+                while True:
+                    header = recv_exact(self.proxy_socket, LENGTH_PREFIX.size)
+                    (length,) = LENGTH_PREFIX.unpack(header)
+                    message = json.loads(recv_exact(self.proxy_socket, length))
+                    self.table.apply(self.proxy_address[0], message)
+        except (OSError, ValueError, KeyError) as e:
+            # the proxy reconnects and starts over with its full client list
+            print(f"telemetry from {self.proxy_address[0]} stopped: {e}")
+
+
+class TelemetryReceiverThread(threading.Thread):
+    """
+    Accepts the proxies' telemetry connections and feeds them into the table
+    """
+
+    def __init__(self, port=TELEMETRY_PORT, table: TelemetryTable = telemetry_table):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port
+        self.table = table
+
+    def run(self):
+        dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        dock_socket.bind(("0.0.0.0", self.port))
+        dock_socket.listen(socket.SOMAXCONN)
+        while True:
+            proxy_socket, proxy_address = dock_socket.accept()
+            TelemetryConnectionThread(proxy_socket, proxy_address, self.table).start()
+
+
+class TelemetrySnapshotThread(threading.Thread):
+    """
+    Every `snapshot_mins` saves the table's current state of every proxy as a
+    ProxyReport, so the history in the database stays as it was with polling
+    """
+
+    def __init__(self, snapshot_mins=1, table: TelemetryTable = telemetry_table):
+        threading.Thread.__init__(self, daemon=True)
+        self.snapshot_mins = snapshot_mins
+        self.table = table
+
+    def snapshot(self):
+        start_time = time()
+        current = self.table.current()
+        proxies = Proxy.objects.filter(ip__in=current.keys())
+        reports = save_reports([(proxy, current[proxy.ip]) for proxy in proxies])
+        print(f"telemetry snapshot: {len(reports)} proxies in {time() - start_time:.3f}s")
+        return reports
+
+    def run(self):
+        while True:
+            sleep(self.snapshot_mins * 60)
+            try:
+                self.snapshot()
+            except Exception as e:
+                print("ERROR: a fatal error has happened")
+                print(e)
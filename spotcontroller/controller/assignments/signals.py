@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from assignments.models import Proxy
+from assignments.services.assignment_engine import assignment_engine
+
+
+@receiver(post_save, sender=Proxy)
+def proxy_saved(sender, instance: Proxy, **kwargs):
+    """
+    Keeps the assignment engine in step with proxies created, blocked,
+    rejuvenated or deactivated anywhere: the views, the admin or scripts
+    """
+    assignment_engine.update_proxy(instance)
+
+
+@receiver(post_delete, sender=Proxy)
+def proxy_deleted(sender, instance: Proxy, **kwargs):
+    assignment_engine.remove_proxy(instance.id)
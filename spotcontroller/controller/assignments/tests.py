@@ -0,0 +1,234 @@
+import os
+import socket
+import sys
+from copy import deepcopy
+from random import Random
+from time import sleep
+from unittest import TestCase, skipUnless
+
+import numpy as np
+
+from assignments.models import Proxy
+from assignments.services.assignment_engine import AssignmentEngine
+from assignments.services.poller_threads import PollerThread
+from assignments.services.scoring import preference_order, top_preferences
+from assignments.services.spatial_index import ProxyGrid
+from scripts.deferred_acceptance import get_matched_clients
+
+
+def get_matched_clients_listwise(client_prefrences, proxy_prefrences, capacities):
+    """
+    The first implementation of deferred acceptance, kept to check
+    get_matched_clients() against: every proposal rescans the waiting list and
+    re-sorts the proxy's accepted clients
+    """
+    waiting_clients = [student for student in client_prefrences]
+    assignment_results = {choice: [] for choice in capacities}
+
+    def get_waiting_list_without_student(student):
+        return [x for x in waiting_clients if x != student]
+
+    def get_sorted_results_with_student(student, choice):
+        assignment_results[choice].append(student)
+        return [x for x in proxy_prefrences[choice] if x in assignment_results[choice]]
+
+    while waiting_clients:
+        for student in waiting_clients.copy():
+            if not client_prefrences[student]:
+                waiting_clients = get_waiting_list_without_student(student)
+                continue
+            choice = client_prefrences[student].pop(0)
+            if len(assignment_results[choice]) < capacities[choice]:
+                assignment_results[choice] = get_sorted_results_with_student(
+                    student, choice
+                )
+                waiting_clients = get_waiting_list_without_student(student)
+            else:
+                if proxy_prefrences[choice].index(student) < proxy_prefrences[
+                    choice
+                ].index(assignment_results[choice][-1]):
+                    assignment_results[choice] = get_sorted_results_with_student(
+                        student, choice
+                    )
+                    waiting_clients = get_waiting_list_without_student(student)
+                    waiting_clients.append(assignment_results[choice].pop())
+
+    return assignment_results
+
+
+def random_preferences(clients, proxies, max_capacity, rng):
+    client_names = [f"client{i}" for i in range(clients)]
+    proxy_names = [f"proxy{i}" for i in range(proxies)]
+    client_preferences = {
+        client: rng.sample(proxy_names, rng.randint(0, proxies))
+        for client in client_names
+    }
+    proxy_preferences = {
+        proxy: rng.sample(client_names, clients) for proxy in proxy_names
+    }
+    proxy_capacities = {proxy: rng.randint(1, max_capacity) for proxy in proxy_names}
+    return client_preferences, proxy_preferences, proxy_capacities
+
+
+class DeferredAcceptanceTests(TestCase):
+    def test_matches_listwise_version(self):
+        """
+        Both implementations on random instances, some with more clients than
+        places and some with fewer, some with clients that do not list every proxy
+        """
+        rng = Random(0)
+        for round in range(200):
+            preferences = random_preferences(
+                rng.randint(1, 30), rng.randint(1, 10), rng.randint(1, 6), rng
+            )
+            # the listwise implementation pops from the client lists
+            expected = get_matched_clients_listwise(*deepcopy(preferences))
+            with self.subTest(round=round):
+                self.assertEqual(get_matched_clients(*preferences), expected)
+
+
+class TopPreferencesTests(TestCase):
+    def test_prefix_of_preference_order_with_ties(self):
+        """
+        Utilities with few distinct values, so ties across the k-th place are common
+        """
+        rng = np.random.default_rng(0)
+        utilities = rng.integers(0, 3, size=(50, 20)).astype(float)
+        full = preference_order(utilities)
+        for k in range(1, 21):
+            self.assertTrue(np.array_equal(top_preferences(utilities, k), full[:, :k]))
+            for row in utilities[:5]:
+                # the lists more_choices() extends with, one row at a time
+                self.assertTrue(
+                    np.array_equal(
+                        top_preferences(row, 2 * k)[:k], top_preferences(row, k)
+                    )
+                )
+
+    def test_k_out_of_range(self):
+        utilities = np.arange(12.0).reshape(3, 4)
+        for k in (0, -1):
+            with self.assertRaises(ValueError):
+                top_preferences(utilities, k)
+        self.assertTrue(
+            np.array_equal(top_preferences(utilities, 10), preference_order(utilities))
+        )
+
+
+class AssignmentEngineTests(TestCase):
+    def test_proxy_ip_change(self):
+        engine = AssignmentEngine()
+        # in memory only, as if load() had found no proxies
+        engine.loaded = True
+        proxy = Proxy(id=1, ip="1.0.0.1", capacity=5, latitude=0, longitude=0)
+        engine.add_proxy(proxy)
+        proxy.ip = "1.0.0.2"
+        engine.update_proxy(proxy)
+        self.assertNotIn("1.0.0.1", engine.proxies_by_ip)
+        self.assertIs(engine.proxies_by_ip["1.0.0.2"], engine.proxies[1])
+        engine.remove_proxy(1)
+        self.assertEqual(engine.proxies_by_ip, {})
+
+
+class ProxyGridTests(TestCase):
+    def test_nearest_matches_brute_force(self):
+        """
+        Points clustered and spread over several cells, some slots moved or
+        removed, and only even slots accepted
+        """
+        rng = np.random.default_rng(0)
+        latitudes = np.concatenate([rng.normal(0, 3, 300), rng.uniform(-50, 50, 300)])
+        longitudes = np.concatenate([rng.normal(0, 3, 300), rng.uniform(-50, 50, 300)])
+        grid = ProxyGrid(5)
+        for slot in range(len(latitudes)):
+            grid.add(slot, latitudes[slot], longitudes[slot])
+        for slot in range(0, 600, 11):
+            latitudes[slot], longitudes[slot] = rng.uniform(-60, 60, 2)
+            grid.add(slot, latitudes[slot], longitudes[slot])
+        for slot in range(0, 600, 13):
+            grid.remove(slot)
+        present = np.array([slot for slot in range(600) if slot in grid])
+
+        for latitude, longitude in rng.uniform(-70, 70, (50, 2)):
+            dx = latitudes[present] - latitude
+            dy = longitudes[present] - longitude
+            order = present[np.lexsort((present, np.sqrt(dx * dx + dy * dy)))]
+            for k in (1, 10, 100, 1000):
+                self.assertTrue(
+                    np.array_equal(
+                        grid.nearest(latitude, longitude, k, latitudes, longitudes),
+                        order[:k],
+                    )
+                )
+                self.assertTrue(
+                    np.array_equal(
+                        grid.nearest(
+                            latitude,
+                            longitude,
+                            k,
+                            latitudes,
+                            longitudes,
+                            accept=lambda slots: slots % 2 == 0,
+                        ),
+                        order[order % 2 == 0][:k],
+                    )
+                )
+
+
+# the proxy side of the polling protocol lives in the wireguard tree
+WIREGUARD_SRC = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "wireguard", "src"
+)
+
+
+@skipUnless(os.path.isdir(WIREGUARD_SRC), "needs the wireguard tree")
+class PollingWireFormatTests(TestCase):
+    """
+    The controller's PollerThread against a proxy's PollingHandler, so a change
+    to either end of the protocol breaks here rather than in production
+    """
+
+    def setUp(self):
+        if WIREGUARD_SRC not in sys.path:
+            sys.path.append(WIREGUARD_SRC)
+        from metrics import MetricsSampler
+        from registry import ConnectionRegistry
+        from server_threads import PollingHandler
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.registry = ConnectionRegistry()
+        self.connections = [
+            self.registry.add((f"10.0.0.{i}", 40000), None, None) for i in range(1, 6)
+        ]
+        self.sampler = MetricsSampler(self.registry)
+        self.sampler.sample()
+        handler = PollingHandler(("127.0.0.1", self.port), self.sampler)
+        handler.daemon = True
+        handler.start()
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.port)).close()
+                break
+            except ConnectionRefusedError:
+                sleep(0.01)
+
+    def test_full_then_delta(self):
+        poller = PollerThread(polling_port=self.port, timeout=2)
+        report = poller.poll("127.0.0.1")
+        self.assertEqual(
+            report["connected_clients"], {f"10.0.0.{i}" for i in range(1, 6)}
+        )
+        self.assertIn("utility", report)
+        self.assertIn("throughput", report)
+
+        self.registry.remove(self.connections[0])
+        self.registry.add(("10.0.0.9", 40000), None, None)
+        self.sampler.sample()
+        # the second poll asks for a delta from the version the first one saw
+        report = poller.poll("127.0.0.1")
+        self.assertEqual(
+            report["connected_clients"],
+            {"10.0.0.2", "10.0.0.3", "10.0.0.4", "10.0.0.5", "10.0.0.9"},
+        )
@@ -1,6 +1,7 @@
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F
 from rest_framework.views import APIView
 from rest_framework.serializers import ValidationError
 from rest_framework.response import Response
@@ -10,8 +11,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from rest_framework.parsers import MultiPartParser
 from assignments.services.startup import id_to_nums
-from scripts.config_basic import CENSORED_REGION_SIZE
-from random import randint
+from assignments.services.assignment_engine import assignment_engine
 from time import time
 import socket
 import traceback
@@ -19,14 +19,6 @@ import traceback
 from assignments.models import *
 
 
-def calcualte_distance(point_1, point_2):
-    return ((point_1[0] - point_2[0]) ** 2 + (point_1[1] - point_2[1]) ** 2) ** 0.5
-
-
-def get_normalized_distance(point_1, point_2):
-    return calcualte_distance(point_1, point_2) / CENSORED_REGION_SIZE
-
-
 class AssignmentView(APIView):
     """
     Get a new proxy assigned
@@ -38,95 +30,25 @@ class AssignmentView(APIView):
             return Response(data=f"No Ip reported.", status=status.HTTP_400_BAD_REQUEST)
 
         user_device = request.META.get("HTTP_USER_AGENT", "N/A")
+        assignment_engine.ensure_loaded()
         try:
             client = Client.objects.get(ip=user_ip)
+            is_new_client = False
         except ObjectDoesNotExist:
             client = Client.objects.create(ip=user_ip, user_agent=user_device)
-            # provide with random proxy and done. discuss this
-            active_proxies = Proxy.objects.filter(
-                is_blocked=False, is_active=True, capacity__gt=0
-            ).all()
-            chosen_proxy = active_proxies[randint(0, len(active_proxies) - 1)]
-            Assignment.objects.create(proxy=chosen_proxy, client=client)
-            chosen_proxy.capacity -= 1
-            chosen_proxy.save()
-            return Response(data=f"{chosen_proxy.ip}", status=status.HTTP_200_OK)
+            is_new_client = True
+        assignment_engine.add_client(client)
 
         # ################ Enem19 implementation ################
-
-        active_proxies = Proxy.objects.filter(
-            is_blocked=False, is_active=True, capacity__gt=0
-        ).all()
-        client_assignments = Assignment.objects.filter(client=client)
-        known_blocked_proxies_for_client = client_assignments.values("proxy").filter(
-            is_blocked=True
-        )
-
-        blocked_proxy_usage = 0
-        for proxy in known_blocked_proxies_for_client:
-            if (
-                not ProxyReport.objects.filter(proxy=proxy)
-                .values("clients")
-                .contains(client)
-            ):
-                blocked_proxy_usage += 1
-
-        number_of_blocked_proxies_that_a_user_knows = (
-            known_blocked_proxies_for_client.count()
-        )
-        number_of_requests_for_new_proxies = client_assignments.count()
-        proxy_utilization = ProxyReport.objects.filter(
-            connected_clients__value=client
-        ).count()
-
-        utility_values_for_client = []
-        alpha1, alpha2, alpha3, alpha4, alpha5 = 1, 1, 1, 1, 1
-        some_cap_value = 50
-        for proxy in active_proxies:
-            distance = get_normalized_distance(
-                (proxy.latitude, proxy.longitude), (client.latitude, client.longitude)
+        # new clients get a random proxy; the others the best scoring one, from
+        # the engine's counters and the proxies' latest telemetry
+        chosen_proxy = assignment_engine.assign_new(client.ip, at_random=is_new_client)
+        if chosen_proxy is None:
+            return Response(
+                data="No proxy available.", status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
-            proxy_utility = (
-                alpha1 * min(proxy_utilization, some_cap_value)
-                - alpha2 * number_of_requests_for_new_proxies
-                - alpha3 * blocked_proxy_usage
-                - alpha4 * number_of_blocked_proxies_that_a_user_knows
-                - alpha5 * distance
-            )
-            utility_values_for_client.append(proxy_utility)
-
-        utility_values_for_proxies = []
-        beta1, beta2, beta3, beta4 = 1, 1, 1, 1
-        for proxy in active_proxies:
-            distance = get_normalized_distance(
-                (proxy.latitude, proxy.longitude), (client.latitude, client.longitude)
-            )
-            number_of_connected_clients = (
-                ProxyReport.objects.filter(proxy=proxy).last().connected_clients.count()
-            )
-            number_of_clients_who_know_the_proxy = (
-                Assignment.objects.filter(proxy=proxy)
-                .values("client")
-                .distinct()
-                .count()
-            )
-            total_utilization_of_proxy_for_users = 0
-            client_utility = (
-                beta1 * number_of_clients_who_know_the_proxy
-                + beta2 * number_of_connected_clients
-                + beta3 * total_utilization_of_proxy_for_users
-                - beta4 * distance
-            )
-            utility_values_for_proxies.append(client_utility)
-
-        mults = []
-        for i in range(len(utility_values_for_client)):
-            mults.append(utility_values_for_client[i] * utility_values_for_proxies[i])
-
-        chosen_proxy = active_proxies[mults.index(max(mults))]
-        Assignment.objects.create(proxy=chosen_proxy, client=client)
-        chosen_proxy.capacity -= 1
-        chosen_proxy.save()
+        Assignment.objects.create(proxy_id=chosen_proxy.id, client=client)
+        Proxy.objects.filter(id=chosen_proxy.id).update(capacity=F("capacity") - 1)
         return Response(data=f"{chosen_proxy.ip}", status=status.HTTP_200_OK)
 
 
@@ -155,6 +77,7 @@ class ProxyUpdateView(APIView):
             for client_ip in clients:
                 client = Client.objects.get(ip=client_ip)
                 Assignment.objects.create(client=client, proxy=new_proxy)
+                assignment_engine.assign(new_proxy.id, client_ip)
             migration_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # This endpoint 
             migration_socket.connect((proxy_ip, 8121))
@@ -208,7 +131,9 @@ class RealProxyUpdateView(APIView):
                     new_proxy, _ = Proxy.objects.get_or_create(ip=new_proxy_ip)
                     for client_ip in clients:
                         client, _ = Client.objects.get_or_create(ip=client_ip)
+                        assignment_engine.add_client(client)
                         Assignment.objects.create(client=client, proxy=new_proxy)
+                        assignment_engine.assign(new_proxy.id, client_ip)
                     migration_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                     migration_socket.connect((proxy_ip, 8121))
                     migration_socket.send(f"migrate {new_proxy_ip}".encode())
@@ -0,0 +1,9 @@
+"""
+Lets plain pytest run the Django app's tests, as manage.py test does
+"""
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "controller.settings")
+django.setup()
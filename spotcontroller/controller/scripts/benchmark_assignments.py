@@ -0,0 +1,335 @@
+"""
+Benchmarks for choosing proxies, in memory with synthetic proxies and clients,
+so they leave the database alone. Run from spotcontroller/controller:
+
+    python manage.py runscript benchmark_assignments --script-args engine [proxies ...]
+    python manage.py runscript benchmark_assignments --script-args scoring [clients] [proxies]
+    python manage.py runscript benchmark_assignments --script-args \
+        matching [clients] [proxies]
+    python manage.py runscript benchmark_assignments --script-args \
+        topk [clients] [proxies] [k ...]
+    python manage.py runscript benchmark_assignments --script-args \
+        nearest [k] [proxies ...]
+"""
+from random import random, randint, seed
+from time import time
+
+import numpy as np
+
+from assignments.models import Proxy, Client
+from assignments.services.assignment_engine import AssignmentEngine
+from assignments.services.spatial_index import ProxyGrid
+from assignments.services.scoring import (
+    normalized_distances,
+    with_distance,
+    preference_order,
+    preference_lists,
+    top_preferences,
+)
+from scripts.deferred_acceptance import get_matched_client_ids
+from scripts.config_basic import WORLD_SIZE, CENSORED_REGION_SIZE, MAX_PROXY_CAPACITY
+
+GRID_CELL_SIZE = CENSORED_REGION_SIZE / 4
+
+
+def synthetic_proxy(proxy_id):
+    return Proxy(
+        id=proxy_id,
+        ip=f"1.{proxy_id // 65536}.{proxy_id // 256 % 256}.{proxy_id % 256}",
+        capacity=MAX_PROXY_CAPACITY,
+        latitude=(random() - 0.5) * WORLD_SIZE,
+        longitude=(random() - 0.5) * WORLD_SIZE,
+    )
+
+
+def synthetic_client(client_id):
+    return Client(
+        ip=f"2.{client_id // 65536}.{client_id // 256 % 256}.{client_id % 256}",
+        latitude=(random() * 2 - 1) * CENSORED_REGION_SIZE,
+        longitude=(random() * 2 - 1) * CENSORED_REGION_SIZE,
+    )
+
+
+def synthetic_engine(proxies, clients):
+    """
+    An engine with `proxies` proxies and `clients` clients that have each been
+    assigned a few proxies already, some of them blocked since
+    """
+    engine = AssignmentEngine()
+    engine.loaded = True
+    for proxy_id in range(proxies):
+        engine.add_proxy(synthetic_proxy(proxy_id))
+    client_ips = []
+    for client_id in range(clients):
+        client = synthetic_client(client_id)
+        engine.add_client(client)
+        client_ips.append(client.ip)
+        for _ in range(3):
+            engine.assign(randint(0, proxies - 1), client.ip)
+    for proxy_id in range(0, proxies, 10):
+        engine.proxies[proxy_id].is_blocked = True
+    # enough slots that no proxy fills up during a run
+    engine.capacities[:proxies] = 1 << 40
+    return engine, client_ips
+
+
+def benchmark_engine(proxy_counts=(1000, 10000, 100000), clients=1000, seconds=3):
+    seed(0)
+    for proxies in proxy_counts:
+        engine, client_ips = synthetic_engine(proxies, clients)
+        requests = 0
+        start = time()
+        while time() - start < seconds:
+            engine.assign_new(client_ips[requests % clients])
+            requests += 1
+        elapsed = time() - start
+        print(
+            f"{proxies:>7} proxies: {requests / elapsed:8.1f} requests/s "
+            f"({elapsed / requests * 1000:.2f} ms per choice)"
+        )
+
+
+def benchmark_scoring(clients=1000, proxies=1000):
+    """
+    The simulator's utilities and preference lists, per pair in Python as
+    request_new_proxy computed them, then as arrays
+    """
+    seed(0)
+    client_points = [
+        (client.latitude, client.longitude)
+        for client in map(synthetic_client, range(clients))
+    ]
+    proxy_points = [
+        (proxy.latitude, proxy.longitude)
+        for proxy in map(synthetic_proxy, range(proxies))
+    ]
+    client_names = [f"c{i}" for i in range(clients)]
+    proxy_names = [f"p{i}" for i in range(proxies)]
+    client_base = [randint(-100, 100) for _ in range(clients)]
+    proxy_base = [randint(0, 80) for _ in range(proxies)]
+    alpha5, beta4 = 10, 1
+
+    start = time()
+    proxy_prefrences = {}
+    for j, proxy_point in enumerate(proxy_points):
+        utilities = {}
+        for i, client_point in enumerate(client_points):
+            distance = (
+                (proxy_point[0] - client_point[0]) ** 2
+                + (proxy_point[1] - client_point[1]) ** 2
+            ) ** 0.5 / CENSORED_REGION_SIZE
+            utilities[client_names[i]] = client_base[i] - alpha5 * distance
+        proxy_prefrences[proxy_names[j]] = list(
+            reversed(sorted(utilities, key=lambda k: utilities[k]))
+        )
+    client_prefrences = {}
+    for i, client_point in enumerate(client_points):
+        utilities = {}
+        for j, proxy_point in enumerate(proxy_points):
+            distance = (
+                (proxy_point[0] - client_point[0]) ** 2
+                + (proxy_point[1] - client_point[1]) ** 2
+            ) ** 0.5 / CENSORED_REGION_SIZE
+            utilities[proxy_names[j]] = proxy_base[j] - beta4 * distance
+        client_prefrences[client_names[i]] = list(
+            reversed(sorted(utilities, key=lambda k: utilities[k]))
+        )
+    loops = time() - start
+
+    start = time()
+    client_array, proxy_array = np.array(client_points), np.array(proxy_points)
+    distances = normalized_distances(
+        client_array[:, 0], client_array[:, 1], proxy_array[:, 0], proxy_array[:, 1]
+    )
+    client_utilities = with_distance(client_base, distances, alpha5, axis=0)
+    proxy_utilities = with_distance(proxy_base, distances, beta4, axis=1)
+    vectorized_proxy_prefrences = dict(
+        zip(proxy_names, preference_lists(client_utilities.T, client_names))
+    )
+    vectorized_client_prefrences = dict(
+        zip(client_names, preference_lists(proxy_utilities, proxy_names))
+    )
+    vectorized = time() - start
+
+    same = (
+        vectorized_proxy_prefrences == proxy_prefrences
+        and vectorized_client_prefrences == client_prefrences
+    )
+    print(f"{clients} clients x {proxies} proxies, same preferences: {same}")
+    print(f"  per-pair loops: {loops:.3f}s")
+    print(f"  vectorized:     {vectorized:.3f}s ({loops / vectorized:.1f}x)")
+
+
+def matching_instance(clients, proxies, spread=80):
+    """
+    Client preferences, proxy ranks and capacities as the simulator builds them,
+    with places for about as many clients as there are
+    """
+    client_array = np.array(
+        [(c.latitude, c.longitude) for c in map(synthetic_client, range(clients))]
+    )
+    proxy_array = np.array(
+        [(p.latitude, p.longitude) for p in map(synthetic_proxy, range(proxies))]
+    )
+    distances = normalized_distances(
+        client_array[:, 0], client_array[:, 1], proxy_array[:, 0], proxy_array[:, 1]
+    )
+    client_base = np.array([randint(-100, 100) for _ in range(clients)])
+    proxy_base = np.array([randint(0, spread) for _ in range(proxies)])
+    client_utilities = with_distance(client_base, distances, 10, axis=0)
+    proxy_utilities = with_distance(proxy_base, distances, 1, axis=1)
+    capacities = [randint(1, 2 * clients // proxies) for _ in range(proxies)]
+    return client_utilities, proxy_utilities, capacities
+
+
+def benchmark_matching(clients=10000, proxies=2000):
+    seed(0)
+    client_utilities, proxy_utilities, capacities = matching_instance(clients, proxies)
+    start = time()
+    client_choices = preference_order(proxy_utilities)
+    prepared = time() - start
+    start = time()
+    matches = get_matched_client_ids(client_choices, client_utilities.T, capacities)
+    matched = time() - start
+    print(
+        f"{clients} clients x {proxies} proxies: {sum(map(len, matches))} matched in "
+        f"{matched:.3f}s (+{prepared:.3f}s for the preference arrays)"
+    )
+
+
+def benchmark_topk(clients=10000, proxies=2000, ks=(8, 32, 128)):
+    """
+    Matching with each client's top k proxies against full preference lists:
+    time, memory held in preference arrays, and how the matches compare, with
+    the lists extended when a client runs out of choices and without. Run on
+    proxies whose base utilities spread as the simulator's do, so that clients
+    largely agree on the best proxies, and on proxies told apart mostly by
+    distance.
+    """
+    for spread in (80, 2):
+        seed(0)
+        client_utilities, proxy_utilities, capacities = matching_instance(
+            clients, proxies, spread
+        )
+        print(f"{clients} clients x {proxies} proxies, proxy base utility 0-{spread}:")
+        full = None
+        for k in (None, *ks):
+            for extend in (False, True) if k else (False,):
+                start = time()
+                if k is None:
+                    client_choices = preference_order(proxy_utilities)
+                else:
+                    client_choices = top_preferences(proxy_utilities, k)
+                extended = []
+
+                def more_choices(client, choices):
+                    longer = top_preferences(
+                        proxy_utilities[client], 2 * max(len(choices), 1)
+                    )
+                    extended.append(longer.nbytes)
+                    return longer
+
+                matches = get_matched_client_ids(
+                    client_choices,
+                    client_utilities.T,
+                    capacities,
+                    more_choices if extend else None,
+                )
+                elapsed = time() - start
+                memory = client_choices.nbytes + sum(extended)
+                proxy_of = {c: p for p, cs in enumerate(matches) for c in cs}
+                # the matched clients' mean utility for their proxy
+                utility = sum(proxy_utilities[c, p] for c, p in proxy_of.items()) / max(
+                    1, len(proxy_of)
+                )
+                if full is None:
+                    full = (elapsed, memory, proxy_of, utility)
+                    print(
+                        f"  full lists:     {elapsed:6.2f}s, {memory / 2**20:4.0f} MiB "
+                        f"of preferences, {len(proxy_of)} matched"
+                    )
+                    continue
+                same = sum(1 for c, p in proxy_of.items() if full[2].get(c) == p)
+                print(
+                    f"  k={k:<4}{'extended ' if extend else 'truncated'}: "
+                    f"{elapsed:6.2f}s ({full[0] / elapsed:4.1f}x), "
+                    f"{memory / 2**20:4.0f} MiB, {len(proxy_of)} matched, "
+                    f"{same} to the same proxy, mean client utility "
+                    f"{utility - full[3]:+.2f}"
+                )
+
+
+def synthetic_grid(engine):
+    """
+    A ProxyGrid of the engine's available proxies, as a nearest-proxy lookup
+    would keep them
+    """
+    grid = ProxyGrid(GRID_CELL_SIZE)
+    for slot in np.flatnonzero(engine.available()):
+        grid.add(int(slot), engine.latitudes[slot], engine.longitudes[slot])
+    return grid
+
+
+def benchmark_nearest(k=64, proxy_counts=(1000, 10000, 100000), clients=1000):
+    """
+    The k nearest available proxies from a ProxyGrid against sorting the
+    distances to every proxy.
+
+    The engine does not keep a grid: the Enem19 product choose() maximizes is
+    not distance-local (a client with a negative base utility scores far
+    proxies highest), so scoring only the nearest proxies picks a different
+    one, and on these synthetic proxies the 64 nearest never held the best.
+    """
+    for proxies in proxy_counts:
+        seed(0)
+        engine, client_ips = synthetic_engine(proxies, clients)
+        # some proxies full, which the lookup has to skip
+        engine.capacities[:proxies:7] = 0
+        grid = synthetic_grid(engine)
+        points = [
+            (engine.clients[ip].latitude, engine.clients[ip].longitude)
+            for ip in client_ips
+        ]
+
+        start = time()
+        by_grid = [
+            grid.nearest(*point, k, engine.latitudes, engine.longitudes)
+            for point in points
+        ]
+        grid_time = time() - start
+        start = time()
+        by_sorting = []
+        for latitude, longitude in points:
+            available = np.flatnonzero(engine.available())
+            dx = engine.latitudes[available] - latitude
+            dy = engine.longitudes[available] - longitude
+            distances = np.sqrt(dx * dx + dy * dy)
+            by_sorting.append(available[np.lexsort((available, distances))[:k]])
+        sort_time = time() - start
+        same = all(np.array_equal(a, b) for a, b in zip(by_grid, by_sorting))
+        print(
+            f"{proxies:>7} proxies, {k} nearest: grid {grid_time / clients * 1000:.3f} "
+            f"ms, sorting {sort_time / clients * 1000:.3f} ms "
+            f"({sort_time / grid_time:.1f}x), same proxies: {same}"
+        )
+
+        chosen = [engine.choose(ip).slot for ip in client_ips]
+        near = sum(slot in nearest for slot, nearest in zip(chosen, by_grid))
+        print(f"  choose() picked one of the {k} nearest for {near} of {clients}")
+
+
+def run(*args):
+    mode = args[0] if args else "engine"
+    numbers = [int(arg) for arg in args[1:]]
+    if mode == "engine":
+        benchmark_engine(*([numbers] if numbers else []))
+    elif mode == "scoring":
+        benchmark_scoring(*numbers)
+    elif mode == "matching":
+        benchmark_matching(*numbers)
+    elif mode == "topk":
+        benchmark_topk(*numbers[:2], *([numbers[2:]] if numbers[2:] else []))
+    elif mode == "nearest":
+        benchmark_nearest(*numbers[:1], *([numbers[1:]] if numbers[1:] else []))
+    else:
+        print(__doc__)
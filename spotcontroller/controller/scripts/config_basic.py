@@ -13,6 +13,9 @@ CENSORED_REGION_SIZE = 1000
 MAX_PROXY_CAPACITY = 40
 CENSOR_UTILIZATION_RATIO = 0.4
 
+# None: clients rank every proxy. k >= 1: only their top k, extended when used up
+MATCHING_TOP_K = None
+
 ############ RATES ############
 # for our reference: TIME_UNIT = 2 hour
 NEW_USER_RATE_INTERVAL = 4  # 1 user every 3 units
@@ -1,39 +1,98 @@
+from collections import deque
+from heapq import heappush, heapreplace
+
+
+def get_matched_client_ids(
+    client_choices, proxy_scores, capacities, more_choices=None
+):
+    """
+    The deferred acceptence algorithm from the Enem19 paper, over integer ids:
+    client_choices[c] is client c's proxies, most preferred first,
+    proxy_scores[p][c] is how much proxy p wants client c (higher is better, and
+    the higher id wins a tie) and capacities[p] how many clients proxy p takes.
+    Lists or NumPy arrays work for all three, so a proxy's utilities can be
+    passed as they are, and only those of the clients that propose are looked at.
+
+    The choice lists may be cut short: when a client has proposed to every proxy
+    on theirs, more_choices(client, choices), if given, returns a longer list
+    starting with the same proxies, or one no longer to give up.
+
+    Free clients wait in a deque, each proxy keeps its accepted clients in a heap
+    with the worst one on top, and a client a proxy lets go proposes on right
+    away, so every proposal costs O(log capacity). Returns each proxy's clients,
+    best first.
+    """
+    client_choices = list(client_choices)
+    next_choice = [0] * len(client_choices)
+    accepted = [[] for _ in range(len(capacities))]
+    free_clients = deque(range(len(client_choices)))
+
+    while free_clients:
+        client = free_clients.popleft()
+        choices = client_choices[client]
+        position = 0
+        while True:
+            if position == len(choices):
+                if more_choices is None:
+                    break
+                choices = client_choices[client] = more_choices(client, choices)
+                if position == len(choices):
+                    break
+            proxy = int(choices[position])
+            position += 1
+            # entries are (score, client), so the worst accepted client is on top
+            entry = (float(proxy_scores[proxy][client]), client)
+            heap = accepted[proxy]
+            if len(heap) < capacities[proxy]:
+                heappush(heap, entry)
+                next_choice[client] = position
+                break
+            if heap and entry > heap[0]:
+                next_choice[client] = position
+                client = heapreplace(heap, entry)[1]
+                choices = client_choices[client]
+                position = next_choice[client]
+
+    return [[client for _, client in sorted(heap, reverse=True)] for heap in accepted]
+
+
 def get_matched_clients(client_prefrences, proxy_prefrences, capacities):
     """
-    The deferred acceptence algorithm from the Enem19 paper
+    get_matched_client_ids() for preferences given as lists of names: returns
+    {proxy: [clients it takes, in its order of preference]}. Clients a proxy
+    does not rank are never accepted by it.
     """
-    waiting_clients = [student for student in client_prefrences]
-    assignment_results = {choice: [] for choice in capacities}
-
-    def get_waiting_list_without_student(student):
-        return [x for x in waiting_clients if x != student]
-
-    def get_sorted_results_with_student(student, choice):
-        assignment_results[choice].append(student)
-        return [x for x in proxy_prefrences[choice] if x in assignment_results[choice]]
-
-    while waiting_clients:
-        for student in waiting_clients.copy():
-            if not client_prefrences[student]:
-                waiting_clients = get_waiting_list_without_student(student)
-                continue
-            choice = client_prefrences[student].pop(0)
-            if len(assignment_results[choice]) < capacities[choice]:
-                assignment_results[choice] = get_sorted_results_with_student(
-                    student, choice
-                )
-                waiting_clients = get_waiting_list_without_student(student)
-            else:
-                if proxy_prefrences[choice].index(student) < proxy_prefrences[
-                    choice
-                ].index(assignment_results[choice][-1]):
-                    assignment_results[choice] = get_sorted_results_with_student(
-                        student, choice
-                    )
-                    waiting_clients = get_waiting_list_without_student(student)
-                    waiting_clients.append(assignment_results[choice].pop())
-
-    return assignment_results
+    clients = list(client_prefrences)
+    proxies = list(capacities)
+    client_ids = {client: i for i, client in enumerate(clients)}
+    proxy_ids = {proxy: i for i, proxy in enumerate(proxies)}
+
+    # minus the client's place in the proxy's list, so the first scores highest
+    unranked = None
+    proxy_scores = []
+    for proxy in proxies:
+        scores = [unranked] * len(clients)
+        for rank, client in enumerate(proxy_prefrences[proxy]):
+            client_id = client_ids.get(client)
+            if client_id is not None:
+                scores[client_id] = -rank
+        proxy_scores.append(scores)
+    client_choices = [
+        [
+            proxy_ids[proxy]
+            for proxy in client_prefrences[client]
+            if proxy_scores[proxy_ids[proxy]][client_id] is not unranked
+        ]
+        for client_id, client in enumerate(clients)
+    ]
+
+    matches = get_matched_client_ids(
+        client_choices, proxy_scores, [capacities[proxy] for proxy in proxies]
+    )
+    return {
+        proxy: [clients[client] for client in matched]
+        for proxy, matched in zip(proxies, matches)
+    }
 
 
 if __name__ == "__main__":
@@ -4,15 +4,26 @@ from rest_framework import status
 from assignments.services.startup import id_to_nums
 from random import randint
 from time import time
-from django.db.models import F
+from collections import defaultdict
+import numpy as np
+from django.db.models import F, Count
 from assignments.models import *
 from scripts.config_basic import (
     CENSORED_REGION_SIZE,
     MAX_PROXY_CAPACITY,
     CENSOR_UTILIZATION_RATIO,
     CLIENT_UTILITY_THRESHOLD,
+    MATCHING_TOP_K,
+)
+from scripts.deferred_acceptance import get_matched_client_ids
+from assignments.services.scoring import (
+    normalized_distances,
+    client_base_utilities,
+    proxy_base_utilities,
+    with_distance,
+    preference_order,
+    top_preferences,
 )
-from scripts.deferred_acceptance import get_matched_clients
 
 
 def calcualte_distance(point_1, point_2):
@@ -68,123 +79,102 @@ def request_new_proxy_new_client(client, right_now):
 
 
 def request_new_proxy(proposing_clients, right_now: int):
-    client_prefrences = {}
-    proxy_prefrences = {}
-    proxy_capacities = {}
-    general_client_utilities = {}
-    general_proxy_utilities = {}
     flagged_clients = []
 
     # time1 = time()
 
-    active_proxies = Proxy.objects.filter(
-        is_blocked=False, is_active=True, capacity__gt=0
-    ).all()
+    active_proxies = list(
+        Proxy.objects.filter(is_blocked=False, is_active=True, capacity__gt=0)
+        .annotate(known_by=Count("assignee__client", distinct=True))
+        .all()
+    )
 
     # time2 = time()
 
     alpha1, alpha2, alpha3, alpha4, alpha5 = 2, 1, 1, 2, 10
     some_cap_value = 1000 * 24
-    for client in proposing_clients:
-        if client.flagged == True:
-            continue
-        # ################ Enem19 implementation ################
-        client_assignments = Assignment.objects.filter(client=client).order_by(
-            "created_at"
-        )
-
-        blocked_proxy_usage = 0
-        for assignment in client_assignments:
-            if assignment.proxy.is_blocked == True:
-                blocked_proxy_usage += (
-                    assignment.proxy.blocked_at - assignment.assignment_time
-                )
-        number_of_blocked_proxies_that_a_user_knows = client.known_blocked_proxies
-        number_of_requests_for_new_proxies = client.request_count
-        # clients_proxy_utilization = get_client_proxy_utilization(client, client_assignments, right_now)
-        clients_proxy_utilization = right_now - client.creation_time
-        if client.is_censor_agent:
-            clients_proxy_utilization = (
-                clients_proxy_utilization * CENSOR_UTILIZATION_RATIO
-            )
-        client_utility = (
-            alpha1 * min(clients_proxy_utilization, some_cap_value)
-            - alpha2 * number_of_requests_for_new_proxies
-            - alpha3 * blocked_proxy_usage
-            - alpha4 * number_of_blocked_proxies_that_a_user_knows
-        )
-        general_client_utilities[client.ip] = client_utility
+    clients = [client for client in proposing_clients if client.flagged != True]
+    # ################ Enem19 implementation ################
+    blocked_proxy_usage = defaultdict(int)
+    for client_ip, blocked_at, assignment_time in Assignment.objects.filter(
+        client__in=clients, proxy__is_blocked=True
+    ).values_list("client_id", "proxy__blocked_at", "assignment_time"):
+        blocked_proxy_usage[client_ip] += blocked_at - assignment_time
+    # clients_proxy_utilization = get_client_proxy_utilization(client, client_assignments, right_now)
+    clients_proxy_utilization = np.array(
+        [
+            (right_now - client.creation_time)
+            * (CENSOR_UTILIZATION_RATIO if client.is_censor_agent else 1)
+            for client in clients
+        ]
+    )
+    general_client_utilities = client_base_utilities(
+        clients_proxy_utilization,
+        [client.request_count for client in clients],
+        [blocked_proxy_usage[client.ip] for client in clients],
+        [client.known_blocked_proxies for client in clients],
+        (alpha1, alpha2, alpha3, alpha4),
+        some_cap_value,
+    )
+    # every pair is needed: flagging looks at each client's worst proxy and the
+    # matching ranks all of them, so a nearest-proxy index cannot narrow this down
+    distances = normalized_distances(
+        np.array([client.latitude for client in clients]),
+        np.array([client.longitude for client in clients]),
+        np.array([proxy.latitude for proxy in active_proxies]),
+        np.array([proxy.longitude for proxy in active_proxies]),
+    )
 
     # time3 = time()
 
-    for proxy in active_proxies:
-        utility_values_for_clients = {}
-        for client in proposing_clients:
-            if client.flagged == True:
-                continue
-            # ################ Enem19 implementation ################
-            distance = get_normalized_distance(
-                (proxy.latitude, proxy.longitude), (client.latitude, client.longitude)
-            )
-            client_utility = general_client_utilities[client.ip] - alpha5 * distance
-
-            if client_utility < CLIENT_UTILITY_THRESHOLD:
-                client.flagged = True
-                client.save()
-                flagged_clients.append(client)
-            utility_values_for_clients[client.ip] = client_utility
-        proxy_prefrences[proxy.ip] = list(
-            reversed(
-                sorted(
-                    utility_values_for_clients,
-                    key=lambda k: utility_values_for_clients[k],
-                )
-            )
-        )
-        proxy_capacities[proxy.ip] = proxy.capacity
+    # (clients, proxies) utility of each client for each proxy
+    client_utilities = with_distance(
+        general_client_utilities, distances, alpha5, axis=0
+    )
+    is_flagged = (client_utilities < CLIENT_UTILITY_THRESHOLD).any(axis=1)
+    flagged_clients = [client for client, flag in zip(clients, is_flagged) if flag]
+    for client in flagged_clients:
+        client.flagged = True
+    Client.objects.filter(ip__in=[client.ip for client in flagged_clients]).update(
+        flagged=True
+    )
+    # flagged clients do not propose, so they are left out of the proxies' lists
+    clients = [client for client, flag in zip(clients, is_flagged) if not flag]
+    # preferences by position in clients and active_proxies, not by ip; the
+    # proxies go by the clients' utilities themselves
+    proxy_scores = client_utilities[~is_flagged].T
+    proxy_capacities = [proxy.capacity for proxy in active_proxies]
 
     # time4 = time()
 
     beta1, beta2, beta3, beta4 = 1, 1, 1, 1
-    for proxy in active_proxies:
-        number_of_connected_clients = MAX_PROXY_CAPACITY - proxy.capacity
-        number_of_clients_who_know_the_proxy = (
-            Assignment.objects.filter(proxy=proxy)
-            .values_list("client", flat=True)
-            .distinct()
-            .count()
-        )
-        total_utilization_of_proxy_for_users = 0
-        proxy_utility = (
-            beta1 * number_of_clients_who_know_the_proxy
-            + beta2 * number_of_connected_clients
-            + beta3 * total_utilization_of_proxy_for_users
-        )
-        general_proxy_utilities[proxy.ip] = proxy_utility
-
-    for client in proposing_clients:
-        if client.flagged == True:
-            continue
-        utility_values_for_proxies = {}
-        beta4 = 1
-        for proxy in active_proxies:
-            distance = get_normalized_distance(
-                (proxy.latitude, proxy.longitude), (client.latitude, client.longitude)
-            )
-            proxy_utility = general_proxy_utilities[proxy.ip] - beta4 * distance
-            utility_values_for_proxies[proxy.ip] = proxy_utility
-        client_prefrences[client.ip] = list(
-            reversed(
-                sorted(
-                    utility_values_for_proxies,
-                    key=lambda k: utility_values_for_proxies[k],
-                )
-            )
-        )
+    general_proxy_utilities = proxy_base_utilities(
+        [proxy.known_by for proxy in active_proxies],
+        [MAX_PROXY_CAPACITY - proxy.capacity for proxy in active_proxies],
+        (beta1, beta2, beta3),
+    )
+    # (clients, proxies) utility of each proxy for each client
+    proxy_utilities = with_distance(
+        general_proxy_utilities, distances[~is_flagged], beta4, axis=1
+    )
+    if MATCHING_TOP_K is None:
+        client_choices = preference_order(proxy_utilities)
+        more_choices = None
+    else:
+        client_choices = top_preferences(proxy_utilities, MATCHING_TOP_K)
+
+        def more_choices(client, choices):
+            return top_preferences(proxy_utilities[client], 2 * max(len(choices), 1))
 
     # time5 = time()
 
-    matches = get_matched_clients(client_prefrences, proxy_prefrences, proxy_capacities)
+    matched_ids = get_matched_client_ids(
+        client_choices, proxy_scores, proxy_capacities, more_choices
+    )
+    matches = {
+        proxy.ip: [clients[client].ip for client in matched]
+        for proxy, matched in zip(active_proxies, matched_ids)
+    }
 
     # time6 = time()
 
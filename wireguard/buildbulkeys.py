@@ -1,10 +1,12 @@
 import subprocess
 from src.settings import *
+from src.wgconfig import Peer, WireGuardConfig
 import os
 from tqdm import tqdm
 
 server_ip = MAIN_PROXY_ENDPOINT
-peers_with_publickeys = []
+with open('./templates/serverbase.txt') as f:
+    server_config = WireGuardConfig.parse(f.read())
 number_of_peers = 1050
 
 # peer template needs: num1.num2 private_key server_endpoint
@@ -26,10 +28,7 @@ for peer_number in tqdm(range(3,number_of_peers)):
     num1 = peer_number//200
     num2 = (peer_number % 200) + 22
 
-    with open(f'./templates/singlepeer_for_server_template.txt') as f:
-        peer_template = f.read()
-
-    peers_with_publickeys.append(peer_template.format(publickey, num1, num2))
+    server_config.add_peer(Peer({'PublicKey': publickey, 'AllowedIPs': f'10.27.{num1}.{num2}'}))
 
     with open('./templates/peertemplate.txt') as f:
         template = f.read()
@@ -43,9 +42,5 @@ for peer_number in tqdm(range(3,number_of_peers)):
     
     # if peer_number > 5: break
 
-with open('./templates/serverbase.txt') as f:
-    server_base = f.read()
-
 with open(f'key_store/server/wg0.conf', 'w') as f:
-    f.write(server_base)
-    f.write('\n'.join(peers_with_publickeys))
+    f.write(server_config.render())
@@ -0,0 +1,110 @@
+#!/bin/bash
+# SECTION: Measure the client-side migration gap locally, without Docker or cloud hosts.
+# One client and two proxies live in network namespaces joined by a bridge; the
+# client pings the tunnel address every 10ms while it is moved from proxy 1 to
+# proxy 2, and the longest stretch without a reply is the gap.
+# Usage (as root, from wireguard/scripts): bash netns_migration_gap.sh [restart|hot|both]
+set -e
+
+MODE=${1:-both}
+SRC_DIR=$(cd "$(dirname "$0")/../src" && pwd)
+WORK_DIR=$(mktemp -d)
+BRIDGE=mg-br0
+PING_SECONDS=6
+MIGRATE_AT=2
+
+cleanup() {
+    for ns in mg-client mg-proxy1 mg-proxy2; do
+        ip netns del $ns 2>/dev/null || true
+    done
+    ip link del $BRIDGE 2>/dev/null || true
+    rm -rf "$WORK_DIR"
+}
+trap cleanup EXIT
+
+setup() {
+    cleanup
+    WORK_DIR=$(mktemp -d)
+    ip link add $BRIDGE type bridge
+    ip link set $BRIDGE up
+
+    local i=1
+    for ns in mg-client mg-proxy1 mg-proxy2; do
+        ip netns add $ns
+        ip link add veth-$ns type veth peer name eth0 netns $ns
+        ip link set veth-$ns master $BRIDGE up
+        ip -n $ns addr add 192.168.77.$i/24 dev eth0
+        ip -n $ns link set eth0 up
+        ip -n $ns link set lo up
+        i=$((i + 1))
+    done
+
+    CLIENT_KEY=$(wg genkey)
+    PROXY_KEY=$(wg genkey)
+    CLIENT_PUB=$(echo "$CLIENT_KEY" | wg pubkey)
+    PROXY_PUB=$(echo "$PROXY_KEY" | wg pubkey)
+
+    # both proxies share a key, as after a migration the new proxy answers for the old one
+    for ns in mg-proxy1 mg-proxy2; do
+        ip -n $ns link add wg0 type wireguard
+        echo "$PROXY_KEY" > "$WORK_DIR/proxy.key"
+        ip netns exec $ns wg set wg0 listen-port 51820 private-key "$WORK_DIR/proxy.key" \
+            peer "$CLIENT_PUB" allowed-ips 10.27.0.2/32
+        ip -n $ns addr add 10.27.0.1/24 dev wg0
+        ip -n $ns link set wg0 up
+    done
+
+    cat > "$WORK_DIR/wg0.conf" <<EOF
+[Interface]
+Address = 10.27.0.2/24
+PrivateKey = $CLIENT_KEY
+[Peer]
+PublicKey = $PROXY_PUB
+AllowedIPs = 10.27.0.0/24
+Endpoint = 192.168.77.2:51820
+PersistentKeepalive = 23
+EOF
+    ip netns exec mg-client wg-quick up "$WORK_DIR/wg0.conf" >/dev/null 2>&1
+}
+
+migrate_restart() {
+    sed -i 's/^Endpoint = .*/Endpoint = 192.168.77.3:51820/' "$WORK_DIR/wg0.conf"
+    ip netns exec mg-client wg-quick down "$WORK_DIR/wg0.conf" >/dev/null 2>&1
+    ip netns exec mg-client wg-quick up "$WORK_DIR/wg0.conf" >/dev/null 2>&1
+}
+
+migrate_hot() {
+    (cd "$SRC_DIR" && ip netns exec mg-client python3 -c "
+from endpoint_swap import swap_endpoint
+print(swap_endpoint('$PROXY_PUB', '192.168.77.3:51820', '10.27.0.0/24'))
+")
+}
+
+measure() {
+    local mode=$1
+    setup
+    ip netns exec mg-client ping -D -n -i 0.01 -w $PING_SECONDS 10.27.0.1 > "$WORK_DIR/ping.txt" &
+    local ping_pid=$!
+    sleep $MIGRATE_AT
+    # the old proxy goes away, as it does when it is rejuvenated
+    ip -n mg-proxy1 link set wg0 down
+    migrate_$mode
+    wait $ping_pid || true
+
+    awk -v mode="$mode" '
+        /bytes from/ {
+            t = substr($1, 2, length($1) - 2)
+            if (last && t - last > gap) gap = t - last
+            last = t
+            replies++
+        }
+        END { printf "%-8s gap %.3fs, %d replies\n", mode, gap, replies }
+    ' "$WORK_DIR/ping.txt"
+}
+
+if [ "$MODE" = "both" ]; then
+    measure restart
+    measure hot
+else
+    measure "$MODE"
+fi
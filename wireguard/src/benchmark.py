@@ -0,0 +1,62 @@
+"""
+Local benchmarks for the proxy and NAT components, run from wireguard/src:
+
+    python3 benchmark.py forwarding [clients] [payload_kb]
+    python3 benchmark.py relay [clients] [megabytes_per_client]
+    python3 benchmark.py nat [clients] [requests_per_client] [pipeline_depth]
+    python3 benchmark.py beeg [chunks_per_client] [file_mb]
+    python3 benchmark.py kv [clients] [requests_per_client] [redis_rtt_ms]
+    python3 benchmark.py migration [clients] [client_rtt_ms]
+    python3 benchmark.py peers [peers]
+    python3 benchmark.py wgconfig [peers] [rounds]
+    python3 benchmark.py handover [clients] [switch_ms]
+    python3 benchmark.py resume [seconds] [interrupt_ms]
+    python3 benchmark.py framing [frames] [requests] [handler_ms]
+    python3 benchmark.py mux [small_requests] [big_mb] [rounds]
+    python3 benchmark.py registry [connections] [live] [threads]
+    python3 benchmark.py workers [clients] [megabytes_per_client]
+    python3 benchmark.py polling [clients] [polls] [churn_percent]
+
+Each subsystem's benchmarks live in a module of the benchmarks package.
+"""
+import sys
+
+from benchmarks.handover import (
+    benchmark_migration,
+    benchmark_handover,
+    benchmark_resume,
+)
+from benchmarks.nat_servers import benchmark_nat, benchmark_beeg, benchmark_kv
+from benchmarks.peers import benchmark_peers, benchmark_wgconfig
+from benchmarks.polling import benchmark_polling
+from benchmarks.relay import (
+    benchmark_forwarding,
+    benchmark_relay,
+    benchmark_registry,
+    benchmark_workers,
+)
+from benchmarks.tunnel import benchmark_framing, benchmark_mux
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "forwarding": benchmark_forwarding,
+        "relay": benchmark_relay,
+        "nat": benchmark_nat,
+        "beeg": benchmark_beeg,
+        "kv": benchmark_kv,
+        "migration": benchmark_migration,
+        "peers": benchmark_peers,
+        "wgconfig": benchmark_wgconfig,
+        "handover": benchmark_handover,
+        "resume": benchmark_resume,
+        "framing": benchmark_framing,
+        "mux": benchmark_mux,
+        "registry": benchmark_registry,
+        "workers": benchmark_workers,
+        "polling": benchmark_polling,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"usage: python3 benchmark.py [{'|'.join(benchmarks)}] [args...]")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*map(int, sys.argv[2:]))
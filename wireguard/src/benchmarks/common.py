@@ -0,0 +1,133 @@
+"""
+Helpers the benchmarks share: ports, daemon threads and loopback endpoints
+standing in for the sites and clients a proxy relays for.
+"""
+import selectors
+import socket
+import threading
+from time import time
+
+LOCALHOST = "127.0.0.1"
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((LOCALHOST, 0))
+        return s.getsockname()[1]
+
+
+def start_daemon(thread: threading.Thread):
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_for_listener(port, timeout=5):
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            socket.create_connection((LOCALHOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            pass
+    raise RuntimeError(f"nothing is listening on {port}")
+
+
+def recv_exact(sock: socket.socket, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionResetError("connection closed early")
+        data += chunk
+    return bytes(data)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class LoopbackEchoThread(threading.Thread):
+    """
+    Stand-in NAT that echoes everything back, from one selector loop so that it
+    costs the same for every forwarding mode being measured.
+    """
+
+    def __init__(self, port):
+        threading.Thread.__init__(self)
+        self.port = port
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        dock_socket.bind((LOCALHOST, self.port))
+        dock_socket.listen(1024)
+        selector.register(dock_socket, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is dock_socket:
+                    conn, _ = dock_socket.accept()
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if not data:
+                    selector.unregister(conn)
+                    conn.close()
+                    continue
+                conn.setblocking(True)
+                conn.sendall(data)
+                conn.setblocking(False)
+
+
+class LoopbackBulkSourceThread(threading.Thread):
+    """
+    Stand-in NAT for bulk transfers: streams `size` bytes to every connection and
+    closes it, like a BEEGThread client that keeps asking for the next chunk.
+    """
+
+    def __init__(self, port, size):
+        threading.Thread.__init__(self)
+        self.port = port
+        self.size = size
+
+    def run(self):
+        dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        dock_socket.bind((LOCALHOST, self.port))
+        dock_socket.listen(1024)
+        while True:
+            conn, _ = dock_socket.accept()
+            start_daemon(threading.Thread(target=self.stream, args=(conn,)))
+
+    def stream(self, conn: socket.socket):
+        chunk = memoryview(bytes(1024 * 1024))
+        remaining = self.size
+        with conn:
+            if not conn.recv(1):
+                return
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                try:
+                    conn.sendall(chunk[:n])
+                except OSError:
+                    # the client went away mid-transfer
+                    return
+                remaining -= n
+
+
+def drain(port, size, results, index):
+    total = 0
+    buffer = bytearray(1024 * 1024)
+    with socket.create_connection((LOCALHOST, port)) as s:
+        s.sendall(b"x")
+        while total < size and (n := s.recv_into(buffer)):
+            total += n
+    results[index] = total
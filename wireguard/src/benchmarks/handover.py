@@ -0,0 +1,342 @@
+"""
+Benchmarks of moving clients between proxies: migration notices,
+make-before-break handover and resumable sessions.
+"""
+import os
+import tempfile
+import socket
+import threading
+from time import sleep, time
+
+from buffers import LENGTH_PREFIX
+from registry import connection_registry
+from server_threads import ForwardingServerThread
+
+from benchmarks.common import (
+    LOCALHOST,
+    get_free_port,
+    start_daemon,
+    wait_for_listener,
+    recv_exact,
+    LoopbackBulkSourceThread,
+)
+
+
+class MigrationListenerThread(threading.Thread):
+    """
+    Stands in for both the new proxy and every client's MIGRATION_PORT listener
+    """
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, daemon=True)
+        self.dock_socket = socket.create_server((LOCALHOST, port), backlog=socket.SOMAXCONN)
+        self.received = 0
+
+    def run(self):
+        while True:
+            conn, _ = self.dock_socket.accept()
+            with conn:
+                while conn.recv(64 * 1024):
+                    pass
+            self.received += 1
+
+
+def benchmark_migration(clients=500, client_rtt_ms=20):
+    from migration import MigrationNotifier
+
+    class SlowLinkNotifier(MigrationNotifier):
+        # loopback connects are instant, so charge each notification a round trip
+        def notify_client(self, *args):
+            threading.Event().wait(client_rtt_ms / 1000)
+            return super().notify_client(*args)
+
+    port = get_free_port()
+    listener = MigrationListenerThread(port)
+    listener.start()
+
+    print(f"{clients} clients, {client_rtt_ms} ms simulated round trip per client")
+    print(f"{'workers':<10}{'total s':>10}{'p50 ms':>10}{'p99 ms':>10}{'failed':>8}")
+    for workers in (1, 16, 64, 256):
+        notifier = SlowLinkNotifier(workers=workers, migration_port=port)
+        pairs = [socket.socketpair() for _ in range(clients)]
+        client_list = [((LOCALHOST, i), a, b) for i, (a, b) in enumerate(pairs)]
+        total, histogram, failed, _ = notifier.migrate(LOCALHOST, b"[Peer]", client_list)
+        summary = histogram.summary()
+        print(
+            f"{workers:<10}{total:>10.3f}{summary['p50'] * 1000:>10.1f}"
+            f"{summary['p99'] * 1000:>10.1f}{len(failed):>8}"
+        )
+    print(histogram.render())
+
+
+class PacedSourceThread(LoopbackBulkSourceThread):
+    """
+    Streams chunk_size bytes every interval to every connection until it closes,
+    so a handover is not hidden behind a saturated CPU
+    """
+
+    def __init__(self, port, chunk_size=64 * 1024, interval=0.01):
+        LoopbackBulkSourceThread.__init__(self, port, 0)
+        self.chunk = bytes(chunk_size)
+        self.interval = interval
+
+    def stream(self, conn: socket.socket):
+        with conn:
+            if not conn.recv(1):
+                return
+            while True:
+                try:
+                    conn.sendall(self.chunk)
+                except OSError:
+                    return
+                sleep(self.interval)
+
+
+class MovingDownloader(threading.Thread):
+    """
+    A client streaming from a forwarder that can be moved to another one. Moving
+    connects to the new forwarder before letting go of the old connection.
+    """
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, daemon=True)
+        self.received = 0
+        self.longest_gap = 0
+        self.last_byte_at = None
+        self.lock = threading.Lock()
+        self.sock = self.connect(port)
+
+    def connect(self, port):
+        s = socket.create_connection((LOCALHOST, port))
+        s.sendall(b"x")
+        return s
+
+    def move(self, port):
+        new_sock = self.connect(port)
+        with self.lock:
+            old_sock, self.sock = self.sock, new_sock
+        # shutdown wakes the recv blocked on it in run()
+        try:
+            old_sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        old_sock.close()
+        start_daemon(threading.Thread(target=self.read, args=(new_sock,)))
+
+    def read(self, sock):
+        buffer = bytearray(256 * 1024)
+        while True:
+            try:
+                n = sock.recv_into(buffer)
+            except OSError:
+                return
+            if not n:
+                return
+            now = time()
+            with self.lock:
+                if self.last_byte_at is not None:
+                    self.longest_gap = max(self.longest_gap, now - self.last_byte_at)
+                self.last_byte_at = now
+                self.received += n
+
+    def run(self):
+        self.read(self.sock)
+
+
+class MigrationStandInThread(threading.Thread):
+    """
+    Answers migration notices for every downloader: after switch_delay (the time
+    a real client needs to move its tunnel) it moves the next downloader to the
+    new forwarder and confirms
+    """
+
+    def __init__(self, port, downloaders, new_port, switch_delay):
+        threading.Thread.__init__(self, daemon=True)
+        self.dock_socket = socket.create_server((LOCALHOST, port), backlog=socket.SOMAXCONN)
+        self.downloaders = list(downloaders)
+        self.lock = threading.Lock()
+        self.new_port = new_port
+        self.switch_delay = switch_delay
+
+    def run(self):
+        while True:
+            conn, _ = self.dock_socket.accept()
+            start_daemon(threading.Thread(target=self.handle, args=(conn,)))
+
+    def handle(self, conn):
+        with conn:
+            if conn.recv(1024).startswith(b"[Peer]"):
+                return
+            sleep(self.switch_delay)
+            with self.lock:
+                downloader = self.downloaders.pop()
+            downloader.move(self.new_port)
+            conn.sendall(b"ok")
+
+
+def benchmark_handover(clients=20, switch_ms=200):
+    """
+    Throughput of streaming clients while their forwarder migrates them. After
+    moving, a client sends nothing more to the old forwarder; make_before_break
+    only lets the old relay deliver what it already had in flight.
+    """
+    from migration import MigrationNotifier
+    from relay_stats import relay_counters
+
+    nat_port = get_free_port()
+    start_daemon(PacedSourceThread(nat_port))
+    wait_for_listener(nat_port)
+
+    print(f"{clients} clients streaming, {switch_ms} ms for a client to move")
+    print(f"{'mode':<20}{'dip MB/s':>10}{'steady MB/s':>12}{'max gap ms':>12}{'lost KiB':>10}{'total s':>9}")
+    for mode in ("break", "make_before_break"):
+        old_port, new_port, migration_port = get_free_port(), get_free_port(), get_free_port()
+        for port in (old_port, new_port):
+            start_daemon(ForwardingServerThread((LOCALHOST, port), (LOCALHOST, nat_port)))
+            wait_for_listener(port)
+        downloaders = [MovingDownloader(old_port) for _ in range(clients)]
+        for downloader in downloaders:
+            downloader.start()
+        # the wait_for_listener probes and the last round's clients leave on their own
+        while len(connection_registry) != clients:
+            sleep(0.01)
+        migrating = connection_registry.take_all()
+        MigrationStandInThread(migration_port, downloaders, new_port, switch_ms / 1000).start()
+
+        def total_received():
+            return sum(d.received for d in downloaders)
+
+        sleep(1)
+        before = total_received()
+        sleep(1)
+        steady = (total_received() - before) / 10**6
+        _, dropped_before = relay_counters.snapshot()
+
+        samples = []
+        sampling = threading.Event()
+
+        def sample():
+            last = total_received()
+            while not sampling.wait(0.1):
+                now = total_received()
+                samples.append((now - last) * 10 / 10**6)
+                last = now
+
+        sampler = start_daemon(threading.Thread(target=sample))
+        notifier = MigrationNotifier(migration_port=migration_port, mode=mode)
+        total, _, failed, lost = notifier.migrate(LOCALHOST, b"[Peer]", migrating)
+        sleep(0.5)
+        sampling.set()
+        sampler.join()
+        _, dropped_after = relay_counters.snapshot()
+
+        print(
+            f"{mode:<20}{min(samples):>10.1f}{steady:>12.1f}"
+            f"{max(d.longest_gap for d in downloaders) * 1000:>12.1f}"
+            f"{(dropped_after - dropped_before) / 1024:>10.1f}{total:>9.2f}"
+        )
+        for downloader in downloaders:
+            downloader.sock.shutdown(socket.SHUT_RDWR)
+            downloader.sock.close()
+
+
+class PathBreakerThread(threading.Thread):
+    """
+    Resets every connection through the forwarder each interval, as a proxy
+    migration does to clients that were not told in time
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.breaks = 0
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            for connection in connection_registry.connections():
+                for sock in (connection.client_socket, connection.nat_socket):
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            self.breaks += 1
+
+
+def legacy_bulk_download(port, deadline, stats, file_bytes):
+    """
+    The old client loop: one BEEGMode request per chunk, a partial chunk is thrown
+    away on a reset, and it sleeps 10 ms before trying again
+    """
+    offset = 0
+    sock = None
+    while time() < deadline:
+        try:
+            if sock is None:
+                sock = socket.create_connection((LOCALHOST, port), timeout=0.2)
+            sock.sendall(f"BEEGMode {offset}".encode())
+            (length,) = LENGTH_PREFIX.unpack(recv_exact(sock, LENGTH_PREFIX.size))
+            data = recv_exact(sock, length)
+            stats["corrupt"] += data != file_bytes[offset % len(file_bytes) :][:length]
+            offset += length
+        except OSError:
+            if sock is not None:
+                sock.close()
+            sock = None
+            sleep(0.01)
+    stats["received"] = offset
+
+
+def session_bulk_download(port, deadline, stats, file_bytes):
+    from sessions import ResumableDownload
+
+    download = ResumableDownload(LOCALHOST, port)
+    download.connect()
+    while time() < deadline:
+        try:
+            start = download.offset % len(file_bytes)
+            frame = download.receive()
+            stats["corrupt"] += frame != file_bytes[start : start + len(frame)]
+        except OSError:
+            reconnect_started = time()
+            download.reconnect(deadline)
+            stats["gaps"].append(time() - reconnect_started)
+    stats["received"] = download.offset
+    download.close()
+
+
+def benchmark_resume(seconds=5, interrupt_ms=250):
+    from nat import nat_server_with_bulk_downloads
+
+    file_bytes = os.urandom(16 * 1024 * 1024)
+    beeg_file = tempfile.NamedTemporaryFile(suffix=".img")
+    beeg_file.write(file_bytes)
+    beeg_file.flush()
+    nat_port, proxy_port = get_free_port(), get_free_port()
+    start_daemon(
+        threading.Thread(
+            target=nat_server_with_bulk_downloads, args=(LOCALHOST, nat_port, beeg_file.name)
+        )
+    )
+    wait_for_listener(nat_port)
+    start_daemon(ForwardingServerThread((LOCALHOST, proxy_port), (LOCALHOST, nat_port)))
+    wait_for_listener(proxy_port)
+    breaker = PathBreakerThread(interrupt_ms / 1000)
+    breaker.start()
+
+    print(f"{seconds}s download, every connection reset each {interrupt_ms} ms")
+    print(f"{'client':<10}{'MB/s':>10}{'corrupt':>9}{'resets':>8}{'resume ms':>11}")
+    for name, download in (
+        ("legacy", legacy_bulk_download),
+        ("session", session_bulk_download),
+    ):
+        stats = {"corrupt": 0, "gaps": []}
+        breaks_before = breaker.breaks
+        download(proxy_port, time() + seconds, stats, file_bytes)
+        gaps = stats["gaps"]
+        print(
+            f"{name:<10}{stats['received'] / seconds / 10**6:>10.1f}{stats['corrupt']:>9}"
+            f"{breaker.breaks - breaks_before:>8}"
+            f"{(sum(gaps) / len(gaps) * 1000 if gaps else float('nan')):>11.2f}"
+        )
+    beeg_file.close()
@@ -0,0 +1,209 @@
+"""
+Benchmarks of the NAT servers: HTTP requests, BEEG bulk downloads and the
+KV store.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+from buffers import LENGTH_PREFIX
+
+from benchmarks.common import (
+    LOCALHOST,
+    get_free_port,
+    start_daemon,
+    wait_for_listener,
+    percentile,
+)
+
+
+class StandInHTTPHandler(BaseHTTPRequestHandler):
+    """
+    Keep-alive HTTP server standing in for the destinations the NAT fetches from
+    """
+
+    protocol_version = "HTTP/1.1"
+    body = b"x" * 80 * 1024
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_stand_in(handler=StandInHTTPHandler):
+    port = get_free_port()
+    http_server = ThreadingHTTPServer((LOCALHOST, port), handler)
+    http_server.daemon_threads = True
+    start_daemon(threading.Thread(target=http_server.serve_forever))
+    return f"http://{LOCALHOST}:{port}/"
+
+
+async def simulated_client(port, url: bytes, request_count, depth, latencies):
+    """
+    Keeps up to `depth` requests outstanding on one connection. Requests are only
+    newline-terminated when pipelining, so depth 1 also works against NATThread.
+    """
+    reader, writer = await asyncio.open_connection(LOCALHOST, port)
+    window = asyncio.Semaphore(depth)
+    sent_at = deque()
+    request = url + b"\n" if depth > 1 else url
+
+    async def send_requests():
+        for _ in range(request_count):
+            await window.acquire()
+            sent_at.append(time())
+            writer.write(request)
+            await writer.drain()
+
+    sender = asyncio.create_task(send_requests())
+    for _ in range(request_count):
+        (length,) = LENGTH_PREFIX.unpack(await reader.readexactly(LENGTH_PREFIX.size))
+        await reader.readexactly(length)
+        latencies.append(time() - sent_at.popleft())
+        window.release()
+    await sender
+    writer.close()
+
+
+async def run_simulated_clients(port, url, clients, request_count, depth):
+    latencies = []
+    await asyncio.gather(
+        *(
+            simulated_client(port, url, request_count, depth, latencies)
+            for _ in range(clients)
+        )
+    )
+    return latencies
+
+
+async def bulk_downloader(port, chunk_count, file_size, received):
+    reader, writer = await asyncio.open_connection(LOCALHOST, port)
+    offset = 0
+    for _ in range(chunk_count):
+        writer.write(f"BEEGMode {offset}".encode())
+        (length,) = LENGTH_PREFIX.unpack(await reader.readexactly(LENGTH_PREFIX.size))
+        await reader.readexactly(length)
+        offset = (offset + length) % file_size
+        received.append(length)
+    writer.close()
+
+
+async def run_bulk_downloaders(port, downloaders, chunk_count, file_size):
+    received = []
+    await asyncio.gather(
+        *(
+            bulk_downloader(port, chunk_count, file_size, received)
+            for _ in range(downloaders)
+        )
+    )
+    return sum(received)
+
+
+def benchmark_nat(clients=100, requests_per_client=20, depth=1):
+    from nat import nat_server
+    from nat_async import async_nat_server
+    from nat_cache import response_cache
+
+    url = start_http_stand_in().encode()
+    servers = {"async": async_nat_server}
+    if depth == 1:
+        servers = {"threaded": nat_server, **servers}
+
+    print(f"{clients} clients x {requests_per_client} requests, pipeline depth {depth}")
+    print(f"{'mode':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode, serve in servers.items():
+        response_cache.clear()
+        port = get_free_port()
+        start_daemon(threading.Thread(target=serve, args=(LOCALHOST, port)))
+        wait_for_listener(port)
+
+        start_time = time()
+        latencies = asyncio.run(
+            run_simulated_clients(port, url, clients, requests_per_client, depth)
+        )
+        elapsed = time() - start_time
+        latencies.sort()
+        print(
+            f"{mode:<10}{len(latencies) / elapsed:>10.1f}"
+            f"{percentile(latencies, 0.5) * 1000:>10.1f}"
+            f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+        )
+    print(f"response cache: {response_cache.stats()}")
+
+
+def benchmark_beeg(chunks_per_client=20, file_mb=64):
+    from nat import nat_server_with_bulk_downloads
+
+    beeg_file = tempfile.NamedTemporaryFile(suffix=".img")
+    beeg_file.write(os.urandom(file_mb * 1024 * 1024))
+    beeg_file.flush()
+    file_size = file_mb * 1024 * 1024
+
+    port = get_free_port()
+    start_daemon(
+        threading.Thread(
+            target=nat_server_with_bulk_downloads,
+            args=(LOCALHOST, port, beeg_file.name),
+        )
+    )
+    wait_for_listener(port)
+
+    print(f"{chunks_per_client} chunks per downloader from a {file_mb} MiB file")
+    print(f"{'downloaders':<12}{'MB/s':>12}")
+    for downloaders in (1, 10, 100, 1000):
+        start_time = time()
+        transferred = asyncio.run(
+            run_bulk_downloaders(port, downloaders, chunks_per_client, file_size)
+        )
+        elapsed = time() - start_time
+        print(f"{downloaders:<12}{transferred / elapsed / 10**6:>12.1f}")
+    beeg_file.close()
+
+
+def benchmark_kv(clients=50, requests_per_client=200, redis_rtt_ms=1):
+    from kv_store import FakeRedis, KVStore
+    from nat import nat_server_with_kv_store
+    from settings import KV_TEST_KEY
+
+    request = f"GET {KV_TEST_KEY}".encode()
+    print(
+        f"{clients} clients x {requests_per_client} requests, "
+        f"{redis_rtt_ms} ms simulated Redis round trip"
+    )
+    print(f"{'depth':<8}{'cache':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'trips':>8}")
+    for depth in (1, 16):
+        for cache_ttl in (0, 5):
+            fake_redis = FakeRedis(round_trip_delay=redis_rtt_ms / 1000)
+            kv_store = KVStore(fake_redis, cache_ttl=cache_ttl)
+            port = get_free_port()
+            start_daemon(
+                threading.Thread(
+                    target=nat_server_with_kv_store, args=(LOCALHOST, port, kv_store)
+                )
+            )
+            wait_for_listener(port)
+            fake_redis.round_trips = 0
+
+            start_time = time()
+            latencies = asyncio.run(
+                run_simulated_clients(port, request, clients, requests_per_client, depth)
+            )
+            elapsed = time() - start_time
+            latencies.sort()
+            print(
+                f"{depth:<8}{'on' if cache_ttl else 'off':<8}"
+                f"{len(latencies) / elapsed:>10.1f}"
+                f"{percentile(latencies, 0.5) * 1000:>10.1f}"
+                f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+                f"{fake_redis.round_trips:>8}"
+            )
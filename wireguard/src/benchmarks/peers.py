@@ -0,0 +1,86 @@
+"""
+Benchmarks of installing WireGuard peers and editing their config files.
+"""
+import os
+import tempfile
+from time import time
+
+
+def benchmark_peers(peers=1000):
+    """
+    wg and ip need root and a real interface, so both paths run `true`/`cat` in
+    their place: this measures the process launches and the Python-side work
+    """
+    import subprocess
+    from peer_install import peer_delta, route_commands
+    from wgconfig import WireGuardConfig
+
+    config = "[Interface]\nPrivateKey = x\n" + "".join(
+        f"[Peer]\nPublicKey = key{i}=\nAllowedIPs = 10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}/32\n"
+        for i in range(peers)
+    )
+
+    start_time = time()
+    for _ in WireGuardConfig.parse(config).peers:
+        subprocess.run("true", shell=True)
+        subprocess.run("true", shell=True)
+    per_peer = time() - start_time
+
+    start_time = time()
+    wanted = WireGuardConfig.parse(config)
+    new_peers = peer_delta(wanted, {})
+    subprocess.run(["cat"], input=wanted.render_peers(new_peers), text=True, stdout=subprocess.DEVNULL)
+    subprocess.run(["cat"], input=route_commands(new_peers), text=True, stdout=subprocess.DEVNULL)
+    bulk = time() - start_time
+
+    print(f"{peers} peers: 2 shells per peer {per_peer:.3f}s, bulk {bulk:.3f}s")
+
+
+def benchmark_wgconfig(peers=10000, rounds=20):
+    from wgconfig import Peer, WireGuardConfig
+
+    config_text = "[Interface]\nAddress = 10.27.0.20\nPrivateKey = x\nListenPort = 51820\n" + "".join(
+        f"[Peer]\nPublicKey = key{i}=\nAllowedIPs = 10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}/32\n"
+        for i in range(peers)
+    )
+    target = f"key{peers // 2}="
+    path = tempfile.NamedTemporaryFile(suffix=".conf", delete=False).name
+
+    def string_splitting():
+        # what MigratingAgent and the client did: split on "Peer", scan every line
+        sections = config_text.split("Peer")
+        for i, section in enumerate(sections[1:], 1):
+            lines = section.split("\n")
+            if any(target in line for line in lines if "PublicKey" in line):
+                lines.append("Endpoint = 1.2.3.4:51820")
+                sections[i] = "\n".join(lines)
+        with open(path, "w") as f:
+            f.write("Peer".join(sections))
+
+    def parse():
+        WireGuardConfig.parse(config_text)
+
+    config = WireGuardConfig.parse(config_text)
+    config.save(path)
+
+    def indexed_update():
+        config.update_peer(target, Endpoint=f"1.2.3.4:{int(time()) % 65536}")
+        config.peer_for_ip("10.0.0.7/32")
+        config.save(path)
+
+    def incremental_add():
+        config.add_peer(Peer({"PublicKey": f"new{time()}=", "AllowedIPs": "10.99.0.1/32"}))
+        config.save(path)
+
+    print(f"{peers} peers, mean of {rounds} rounds")
+    for name, step in (
+        ("split on Peer + rewrite", string_splitting),
+        ("parse into WireGuardConfig", parse),
+        ("update 1 peer + rewrite", indexed_update),
+        ("add 1 peer + append", incremental_add),
+    ):
+        start_time = time()
+        for _ in range(rounds):
+            step()
+        print(f"{name:<30}{(time() - start_time) / rounds * 1000:>10.2f} ms")
+    os.unlink(path)
@@ -0,0 +1,72 @@
+"""
+Benchmark of answering the controller's polls.
+"""
+import socket
+from time import sleep, time
+
+from buffers import LENGTH_PREFIX
+from registry import ConnectionRegistry
+
+from benchmarks.common import (
+    LOCALHOST,
+    get_free_port,
+    start_daemon,
+    wait_for_listener,
+    recv_exact,
+)
+
+
+def benchmark_polling(clients=10000, polls=50, churn_percent=1):
+    import json
+    import psutil
+    from metrics import MetricsSampler
+    from server_threads import PollingHandler
+
+    def legacy_poll(registry):
+        # what PollingHandler measured per poll before the sampler
+        report = {"utility": psutil.cpu_percent(interval=0.01)}
+        before = psutil.net_io_counters()
+        sleep(0.01)
+        report["throughput"] = (psutil.net_io_counters().bytes_sent - before.bytes_sent) / 0.01
+        report["connected_clients"] = registry.addresses()
+        return json.dumps(report).encode()
+
+    registry = ConnectionRegistry()
+    connections = [
+        registry.add((f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", 40000), None, None)
+        for i in range(clients)
+    ]
+    sampler = MetricsSampler(registry)
+    port = get_free_port()
+    start_daemon(PollingHandler((LOCALHOST, port), sampler))
+    wait_for_listener(port)
+
+    def poll(request: bytes):
+        # answered with one length-prefixed frame, as the controller reads it
+        with socket.create_connection((LOCALHOST, port)) as s:
+            s.sendall(request)
+            (length,) = LENGTH_PREFIX.unpack(recv_exact(s, LENGTH_PREFIX.size))
+            return recv_exact(s, length)
+
+    version = json.loads(poll(b"delta 0"))["clients"]["version"]
+    # some clients leave and others arrive between two polls
+    churn = clients * churn_percent // 100
+    for connection in connections[:churn]:
+        registry.remove(connection)
+    for i in range(churn):
+        registry.add((f"172.16.{i // 256}.{i % 256}", 40000), None, None)
+    sampler.sample()
+
+    print(f"{clients} clients, {churn} replaced since the poller's last version, {polls} polls")
+    print(f"{'poll':<16}{'ms/poll':>10}{'bytes':>10}")
+    for name, answer in (
+        ("legacy", lambda: legacy_poll(registry)),
+        ("sampler full", lambda: poll(b"hello")),
+        ("sampler delta", lambda: poll(f"delta {version}".encode())),
+    ):
+        start_time = time()
+        for _ in range(polls):
+            response = answer()
+        print(f"{name:<16}{(time() - start_time) / polls * 1000:>10.2f}{len(response):>10}")
+    delta = json.loads(poll(f"delta {version}".encode()))["clients"]
+    print(f"delta: +{len(delta['added'])} -{len(delta['removed'])}, full={delta['full']}")
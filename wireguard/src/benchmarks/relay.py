@@ -0,0 +1,274 @@
+"""
+Benchmarks of the TCP relay: forwarding, bulk relaying, the connection
+registry and the worker processes.
+"""
+import os
+import selectors
+import socket
+import threading
+from time import sleep, time, process_time
+
+from registry import ConnectionRegistry
+from server_threads import (
+    ForwardingServerThread,
+    SelectorForwardingServerThread,
+    RELAY_THREADS,
+)
+
+from benchmarks.common import (
+    LOCALHOST,
+    get_free_port,
+    start_daemon,
+    wait_for_listener,
+    recv_exact,
+    LoopbackEchoThread,
+    LoopbackBulkSourceThread,
+    drain,
+)
+
+
+def pump_payload(sockets, payload_size):
+    """
+    Sends payload_size bytes on every socket and waits for all of it to be echoed.
+    Returns the number of bytes that made the round trip.
+    """
+    selector = selectors.DefaultSelector()
+    payload = memoryview(b"x" * payload_size)
+    remaining = {}
+    for s in sockets:
+        s.setblocking(False)
+        remaining[s] = [payload, payload_size]
+        selector.register(s, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    received = 0
+    while remaining:
+        for key, mask in selector.select(timeout=10):
+            s = key.fileobj
+            state = remaining[s]
+            if mask & selectors.EVENT_WRITE and state[0]:
+                try:
+                    sent = s.send(state[0])
+                    state[0] = state[0][sent:]
+                except BlockingIOError:
+                    pass
+                if not state[0]:
+                    selector.modify(s, selectors.EVENT_READ)
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = s.recv(65536)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    raise ConnectionResetError("relay closed a connection early")
+                received += len(data)
+                state[1] -= len(data)
+                if state[1] <= 0:
+                    selector.unregister(s)
+                    del remaining[s]
+    for s in sockets:
+        s.setblocking(True)
+    return received
+
+
+def benchmark_forwarding(clients=1000, payload_kb=256):
+    nat_port = get_free_port()
+    start_daemon(LoopbackEchoThread(nat_port))
+    wait_for_listener(nat_port)
+
+    modes = {
+        "threaded": ForwardingServerThread,
+        "selector": SelectorForwardingServerThread,
+    }
+    results = []
+    for mode, server_class in modes.items():
+        proxy_port = get_free_port()
+        start_daemon(server_class((LOCALHOST, proxy_port), (LOCALHOST, nat_port)))
+        wait_for_listener(proxy_port)
+
+        start_time = time()
+        sockets = []
+        for _ in range(clients):
+            s = socket.create_connection((LOCALHOST, proxy_port))
+            s.sendall(b"x")
+            recv_exact(s, 1)
+            sockets.append(s)
+        connect_time = time() - start_time
+
+        start_time = time()
+        transferred = pump_payload(sockets, payload_kb * 1024)
+        transfer_time = time() - start_time
+
+        for s in sockets:
+            s.close()
+        results.append(
+            (mode, clients / connect_time, transferred / transfer_time / 10**6)
+        )
+
+    print(f"{clients} clients, {payload_kb} KiB echoed per client")
+    print(f"{'mode':<10}{'conn/s':>12}{'MB/s':>12}")
+    for mode, conn_rate, throughput in results:
+        print(f"{mode:<10}{conn_rate:>12.1f}{throughput:>12.2f}")
+
+
+def benchmark_relay(clients=4, megabytes_per_client=512):
+    size = megabytes_per_client * 1024 * 1024
+    nat_port = get_free_port()
+    start_daemon(LoopbackBulkSourceThread(nat_port, size))
+    wait_for_listener(nat_port)
+
+    targets = {"direct": nat_port}
+    for relay_mode in RELAY_THREADS:
+        proxy_port = get_free_port()
+        start_daemon(
+            ForwardingServerThread(
+                (LOCALHOST, proxy_port), (LOCALHOST, nat_port), relay_mode
+            )
+        )
+        wait_for_listener(proxy_port)
+        targets[relay_mode] = proxy_port
+
+    print(f"{clients} clients downloading {megabytes_per_client} MiB each")
+    print(f"{'mode':<12}{'MB/s':>12}{'cpu s/GB':>12}")
+    for mode, port in targets.items():
+        results = [0] * clients
+        start_time, start_cpu = time(), process_time()
+        downloaders = [
+            start_daemon(threading.Thread(target=drain, args=(port, size, results, i)))
+            for i in range(clients)
+        ]
+        for downloader in downloaders:
+            downloader.join()
+        elapsed, cpu = time() - start_time, process_time() - start_cpu
+        transferred = sum(results)
+        print(
+            f"{mode:<12}{transferred / elapsed / 10**6:>12.1f}"
+            f"{cpu / (transferred / 10**9):>12.2f}"
+        )
+
+
+def benchmark_registry(connections=100000, live=10000, threads=8):
+    import psutil
+
+    def churn_lists(addresses, sockets, count, base):
+        # the old bookkeeping: an O(n) membership scan per accept, nothing removed
+        for i in range(count):
+            address = ("10.27.0.2", base + i)
+            if address not in addresses:
+                addresses.append(address)
+                sockets.append(None)
+
+    def churn_registry(registry, count, base):
+        for i in range(count):
+            connection = registry.add(("10.27.0.2", base + i), None, None)
+            registry.remove(connection)
+
+    print(f"{threads} threads accepting {live} connections each, next to {live} live ones")
+    print(f"{'bookkeeping':<14}{'accepts/s':>12}")
+    addresses = [("10.27.1.2", i) for i in range(live)]
+    sockets = [None] * live
+    registry = ConnectionRegistry()
+    for address in addresses:
+        registry.add(address, None, None)
+    for name, target, args in (
+        ("lists", churn_lists, (addresses, sockets)),
+        ("registry", churn_registry, (registry,)),
+    ):
+        workers = [
+            threading.Thread(target=target, args=(*args, live, i * live))
+            for i in range(threads)
+        ]
+        start_time = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        print(f"{name:<14}{threads * live / (time() - start_time):>12.0f}")
+
+    nat_port = get_free_port()
+    start_daemon(LoopbackEchoThread(nat_port))
+    wait_for_listener(nat_port)
+    process = psutil.Process()
+    print(f"\n{connections} connections opened and closed through each forwarder, 200 at a time")
+    print(f"{'forwarder':<10}{'done':>8}{'registered':>12}{'threads':>9}{'rss MiB':>9}")
+    for name, server_class in (
+        ("threaded", ForwardingServerThread),
+        ("selector", SelectorForwardingServerThread),
+    ):
+        registry = ConnectionRegistry()
+        proxy_port = get_free_port()
+        start_daemon(
+            server_class((LOCALHOST, proxy_port), (LOCALHOST, nat_port), registry=registry)
+        )
+        wait_for_listener(proxy_port)
+        done = 0
+        while done < connections:
+            batch = [socket.create_connection((LOCALHOST, proxy_port)) for _ in range(200)]
+            for s in batch:
+                s.sendall(b"x")
+            for s in batch:
+                recv_exact(s, 1)
+                s.close()
+            done += len(batch)
+            if done % (connections // 5) == 0:
+                deadline = time() + 5
+                while len(registry) and time() < deadline:
+                    sleep(0.01)
+                print(
+                    f"{name:<10}{done:>8}{len(registry):>12}{threading.active_count():>9}"
+                    f"{process.memory_info().rss / 2**20:>9.1f}"
+                )
+
+
+def run_bulk_source(port, size):
+    LoopbackBulkSourceThread(port, size).run()
+
+
+def benchmark_workers(clients=16, megabytes_per_client=256):
+    import multiprocessing
+    from relay_stats import close_sockets
+    from workers import ForwardingWorkerPool
+
+    size = megabytes_per_client * 1024 * 1024
+    nat_port = get_free_port()
+    # the stand-in NAT gets its own process, so it is not what limits the workers
+    multiprocessing.get_context("spawn").Process(
+        target=run_bulk_source, args=(nat_port, size), daemon=True
+    ).start()
+    wait_for_listener(nat_port)
+
+    print(f"{clients} clients downloading {megabytes_per_client} MiB each, {os.cpu_count()} CPUs")
+    print(f"{'workers':<9}{'MB/s':>10}{'counted':>9}{'taken':>7}{'closed':>8}")
+    for workers in (1, 2, 4):
+        proxy_port = get_free_port()
+        pool = ForwardingWorkerPool((LOCALHOST, proxy_port), (LOCALHOST, nat_port), workers)
+        pool.start()
+        len(pool)  # every worker answers once it is up
+        wait_for_listener(proxy_port)
+
+        results = [0] * clients
+        start_time = time()
+        downloaders = [
+            start_daemon(threading.Thread(target=drain, args=(proxy_port, size, results, i)))
+            for i in range(clients)
+        ]
+        for downloader in downloaders:
+            downloader.join()
+        throughput = sum(results) / (time() - start_time) / 10**6
+
+        # the aggregate view: idle clients spread over the workers, as a migration sees them
+        idle = [socket.create_connection((LOCALHOST, proxy_port)) for _ in range(50)]
+        deadline = time() + 5
+        while (counted := len(pool)) < len(idle) and time() < deadline:
+            sleep(0.01)
+        taken = pool.take_all()
+        for _, client_socket, nat_socket in taken:
+            close_sockets(client_socket, nat_socket)
+        # closing the taken copies must end the workers' relays for those clients
+        closed = 0
+        for s in idle:
+            s.settimeout(5)
+            closed += s.recv(1) == b""
+            s.close()
+        print(f"{workers:<9}{throughput:>10.1f}{counted:>9}{len(taken):>7}{closed:>8}")
+        for process in pool.processes:
+            process.terminate()
@@ -0,0 +1,151 @@
+"""
+Benchmarks of the framed tunnel protocol and the stream multiplexer on it.
+"""
+import os
+import socket
+import threading
+from collections import deque
+from time import sleep, time
+
+from benchmarks.common import (
+    LOCALHOST,
+    get_free_port,
+    start_daemon,
+    wait_for_listener,
+    percentile,
+)
+
+
+def benchmark_framing(frames=200000, requests=400, handler_ms=5):
+    import random
+    from buffers import RequestSplitter
+    from framing import FETCH, FrameParser, FramedClient, pack_header
+    from nat_threads import FramedThread
+
+    print(f"parsing {frames} frames fed in 64 KiB reads")
+    print(f"{'payload':<10}{'framed/s':>14}{'newline/s':>14}")
+    for payload_size in (16, 256, 4096):
+        payload = b"x" * payload_size
+        count = min(frames, 256 * 1024 * 1024 // payload_size // 4)
+        framed = (pack_header(FETCH, 0, payload_size) + payload) * count
+        text = (payload + b"\n") * count
+
+        parser = FrameParser()
+        parsed = 0
+        start_time = time()
+        for i in range(0, len(framed), 64 * 1024):
+            parser.feed(framed[i : i + 64 * 1024])
+            for _ in parser.frames():
+                parsed += 1
+        framed_rate = parsed / (time() - start_time)
+        parser.close()
+
+        splitter = RequestSplitter()
+        splitter.pipelined = True
+        split = 0
+        start_time = time()
+        for i in range(0, len(text), 64 * 1024):
+            split += len(splitter.feed(text[i : i + 64 * 1024]))
+        text_rate = split / (time() - start_time)
+        assert parsed == split == count
+        print(f"{payload_size:<10}{framed_rate:>14.0f}{text_rate:>14.0f}")
+
+    def slow_handler(payload):
+        # upstream latency varies, so later requests often finish first
+        sleep(random.uniform(0, 2 * handler_ms / 1000))
+        return bytes(payload)
+
+    port = get_free_port()
+
+    def serve():
+        listener = socket.create_server((LOCALHOST, port), backlog=socket.SOMAXCONN)
+        while True:
+            client_socket, client_address = listener.accept()
+            FramedThread(client_socket, client_address, {FETCH: slow_handler}).start()
+
+    start_daemon(threading.Thread(target=serve))
+    wait_for_listener(port)
+
+    print(f"\n{requests} requests on one connection, handler takes ~{handler_ms} ms")
+    print(f"{'in flight':<10}{'req/s':>10}{'out of order':>14}")
+    for in_flight in (1, 8, 64):
+        client = FramedClient(socket.create_connection((LOCALHOST, port)))
+        pending = deque()
+        completed = []
+        start_time = time()
+        for i in range(requests):
+            future = client.request(FETCH, str(i).encode())
+            future.add_done_callback(lambda f: completed.append(int(f.result())))
+            pending.append(future)
+            if len(pending) >= in_flight:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+        elapsed = time() - start_time
+        client.sock.close()
+        assert sorted(completed) == list(range(requests))
+        reordered = sum(1 for a, b in zip(completed, completed[1:]) if b < a)
+        print(f"{in_flight:<10}{requests / elapsed:>10.1f}{reordered:>14}")
+
+
+def benchmark_mux(small_requests=50, big_mb=32, rounds=5):
+    from framing import FETCH, FramedClient
+    from mux import MuxClient
+    from nat_threads import FramedThread
+
+    big = os.urandom(big_mb * 1024 * 1024)
+    small = os.urandom(8 * 1024)
+    handlers = {FETCH: lambda payload: big if payload == b"big" else small}
+    port = get_free_port()
+
+    def serve():
+        listener = socket.create_server((LOCALHOST, port), backlog=socket.SOMAXCONN)
+        while True:
+            client_socket, client_address = listener.accept()
+            FramedThread(client_socket, client_address, handlers).start()
+
+    start_daemon(threading.Thread(target=serve))
+    wait_for_listener(port)
+
+    def framed_round(sock):
+        client = FramedClient(sock)
+        start_time = time()
+        big_response = client.request(FETCH, b"big")
+        pending = [client.request(FETCH, b"small") for _ in range(small_requests)]
+        latencies = []
+        for future in pending:
+            future.result()
+            latencies.append(time() - start_time)
+        big_response.result()
+        return latencies, time() - start_time
+
+    def mux_round(sock):
+        client = MuxClient(sock)
+        start_time = time()
+        big_stream = client.open_stream(FETCH, b"big")
+        streams = [client.open_stream(FETCH, b"small") for _ in range(small_requests)]
+        latencies = []
+        for stream in streams:
+            stream.read_all()
+            latencies.append(time() - start_time)
+        big_stream.read_all()
+        return latencies, time() - start_time
+
+    print(
+        f"one connection: a {big_mb} MiB response, then {small_requests} 8 KiB ones "
+        f"requested right behind it, {rounds} rounds"
+    )
+    print(f"{'client':<8}{'small p50 ms':>14}{'small p99 ms':>14}{'round ms':>10}")
+    for name, run_round in (("framed", framed_round), ("mux", mux_round)):
+        latencies, round_times = [], []
+        for _ in range(rounds):
+            with socket.create_connection((LOCALHOST, port)) as sock:
+                round_latencies, round_time = run_round(sock)
+            latencies += round_latencies
+            round_times.append(round_time)
+        latencies.sort()
+        print(
+            f"{name:<8}{percentile(latencies, 0.5) * 1000:>14.1f}"
+            f"{percentile(latencies, 0.99) * 1000:>14.1f}"
+            f"{sum(round_times) / rounds * 1000:>10.1f}"
+        )
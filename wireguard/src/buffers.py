@@ -0,0 +1,187 @@
+import threading
+from struct import Struct
+
+from settings import MIN_RELAY_BUFFER_SIZE, MAX_RELAY_BUFFER_SIZE, FRAME_MAX_SIZE
+
+# Every response over the tunnel is prefixed with its length as a big-endian u64
+LENGTH_PREFIX = Struct(">Q")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def size_class(size):
+    """
+    Rounds size up to the power of two the pool keeps buffers for
+    """
+    return 1 << max(size - 1, 0).bit_length()
+
+
+class BufferPool:
+    """
+    Free lists of preallocated bytearrays, one per power-of-two size
+    """
+
+    def __init__(self, max_free_per_size=64):
+        self.lock = threading.Lock()
+        self.free = {}
+        self.max_free_per_size = max_free_per_size
+
+    def acquire(self, size):
+        size = size_class(size)
+        with self.lock:
+            buffers = self.free.get(size)
+            if buffers:
+                return buffers.pop()
+        return bytearray(size)
+
+    def release(self, buffer: bytearray):
+        with self.lock:
+            buffers = self.free.setdefault(len(buffer), [])
+            if len(buffers) < self.max_free_per_size:
+                buffers.append(buffer)
+
+
+buffer_pool = BufferPool()
+
+
+def recv_exact_into(sock, view: memoryview, on_recv=None):
+    """
+    Fills view from sock, calling on_recv(n) after every partial read
+    """
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionResetError("connection closed mid-message")
+        received += n
+        if on_recv:
+            on_recv(n)
+
+
+class RequestSplitter:
+    """
+    Pipelined requests are newline-terminated. Until a connection sends its first
+    newline, every read is taken as one whole request, which is what the existing
+    clients send.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+        self.pipelined = False
+
+    def feed(self, data) -> list:
+        # `in` on a memoryview compares single bytes, so search a bytes copy
+        data = bytes(data)
+        if not self.pipelined:
+            if b"\n" not in data:
+                return [data]
+            self.pipelined = True
+        self.pending += data
+        *requests, rest = self.pending.split(b"\n")
+        self.pending[:] = rest
+        return [bytes(request) for request in requests if request.strip()]
+
+
+def send_frame(sock, payload):
+    if len(payload) <= MIN_RELAY_BUFFER_SIZE:
+        # one segment, so Nagle does not hold the payload back behind the header
+        sock.sendall(LENGTH_PREFIX.pack(len(payload)) + payload)
+        return
+    sock.sendall(LENGTH_PREFIX.pack(len(payload)))
+    sock.sendall(payload)
+
+
+class AdaptiveBuffer:
+    """
+    A pooled receive buffer that doubles while reads keep filling it and halves
+    after a run of reads that use less than a quarter of it. A view returned by
+    recv_into is only valid until the next call.
+    """
+
+    SHRINK_AFTER = 16
+
+    def __init__(
+        self,
+        min_size=MIN_RELAY_BUFFER_SIZE,
+        max_size=MAX_RELAY_BUFFER_SIZE,
+        pool=buffer_pool,
+    ):
+        self.min_size = size_class(min_size)
+        self.max_size = size_class(max_size)
+        self.pool = pool
+        self.buffer = pool.acquire(self.min_size)
+        self.view = memoryview(self.buffer)
+        self.last_read = 0
+        self.small_reads = 0
+
+    def resize(self, size):
+        self.view.release()
+        self.pool.release(self.buffer)
+        self.buffer = self.pool.acquire(size)
+        self.view = memoryview(self.buffer)
+
+    def adapt(self):
+        size = len(self.buffer)
+        if self.last_read == size and size < self.max_size:
+            self.small_reads = 0
+            self.resize(size * 2)
+        elif self.last_read < size // 4 and size > self.min_size:
+            self.small_reads += 1
+            if self.small_reads >= self.SHRINK_AFTER:
+                self.small_reads = 0
+                self.resize(size // 2)
+        else:
+            self.small_reads = 0
+
+    def recv_into(self, sock) -> memoryview:
+        self.adapt()
+        self.last_read = sock.recv_into(self.buffer)
+        return self.view[: self.last_read]
+
+    def close(self):
+        self.view.release()
+        self.pool.release(self.buffer)
+        self.buffer = None
+
+
+class FrameReader:
+    """
+    Reads length-prefixed frames into one preallocated buffer, grown only when a
+    frame does not fit. A view returned by read_frame is only valid until the next
+    call. A frame announcing more than max_size bytes is refused rather than
+    allocated for.
+    """
+
+    def __init__(
+        self,
+        initial_size=MIN_RELAY_BUFFER_SIZE,
+        pool=buffer_pool,
+        max_size=FRAME_MAX_SIZE,
+    ):
+        self.pool = pool
+        self.max_size = max_size
+        self.header = bytearray(LENGTH_PREFIX.size)
+        self.header_view = memoryview(self.header)
+        self.buffer = pool.acquire(initial_size)
+        self.view = memoryview(self.buffer)
+
+    def read_frame(self, sock, on_recv=None) -> memoryview:
+        recv_exact_into(sock, self.header_view)
+        (length,) = LENGTH_PREFIX.unpack(self.header)
+        if length > self.max_size:
+            raise ProtocolError(f"frame of {length} bytes is over the limit")
+        if length > len(self.buffer):
+            self.view.release()
+            self.pool.release(self.buffer)
+            self.buffer = self.pool.acquire(length)
+            self.view = memoryview(self.buffer)
+        frame = self.view[:length]
+        recv_exact_into(sock, frame, on_recv)
+        return frame
+
+    def close(self):
+        self.view.release()
+        self.pool.release(self.buffer)
+        self.buffer = None
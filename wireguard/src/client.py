@@ -4,8 +4,14 @@ from settings import *
 from utils import *
 import subprocess
 from time import sleep, time
-from struct import unpack
 from logger import log
+from buffers import FrameReader
+from framing import FETCH, KV, FramedClient, ProtocolError
+from mux import MuxClient
+from relay_stats import close_sockets
+from sessions import ResumableDownload
+from wgconfig import Peer, WireGuardConfig
+from endpoint_swap import swap_endpoint, restart_interface
 import sys
 
 
@@ -31,35 +37,54 @@ class MigrationHandler(threading.Thread):
 
             data = mig_socket.recv(1024)
             log(f"migration info: {data}")
-            new_endpoint = data.decode()
+            # "<address>:<port>", optionally followed by the new proxy's public key
+            new_endpoint, *new_public_key = data.decode().split()
             new_endpoint_address, new_endpoint_port = new_endpoint.split(":")
             new_endpoint_port = int(new_endpoint_port)
 
-            with open(WIREGUARD_CONFIG_LOCATION, "rb") as f:
-                old_config = f.read()
-
-            splitted_config = old_config.decode().split("Peer")
-            lines_in_peer = splitted_config[1].split("\n")
-            for i in range(len(lines_in_peer)):
-                line = lines_in_peer[i]
-                if "PublicKey" in line:
-                    pass
-                    # NOTE: We can add public key replacement here as well.
-                if "Endpoint" in line:
-                    splitted_line = line.split("=")
-                    splitted_line[1] = new_endpoint
-                    lines_in_peer[i] = "= ".join(splitted_line)
-            new_config = "Peer".join([splitted_config[0], "\n".join(lines_in_peer)])
-            with open(WIREGUARD_CONFIG_LOCATION, "w") as f:
-                f.write(new_config)
-
-            # subprocess.run(f'wg syncconf {WIREGUARD_INTERFACE_NAME} <(wg-quick strip {WIREGUARD_INTERFACE_NAME})', shell=True)
-            subprocess.run(f"wg-quick down wg0", shell=True)
-            subprocess.run(f"wg-quick up wg0", shell=True)
+            config = WireGuardConfig.load(WIREGUARD_CONFIG_LOCATION)
+            peer = config.first_peer()
+            old_public_key = peer.public_key
+            config.update_peer(old_public_key, Endpoint=new_endpoint)
+            if new_public_key:
+                options = config.remove_peer(old_public_key).options
+                peer = config.add_peer(Peer({**options, "PublicKey": new_public_key[0]}))
+            config.save(WIREGUARD_CONFIG_LOCATION)
+
+            if CLIENT_MIGRATION_MODE == "hot":
+                try:
+                    timings = swap_endpoint(
+                        old_public_key,
+                        new_endpoint,
+                        ",".join(peer.allowed_ips),
+                        new_public_key[0] if new_public_key else None,
+                    )
+                except (subprocess.CalledProcessError, OSError) as e:
+                    # the config file is already updated, so a restart picks it up
+                    log(f"hot swap failed ({e}), restarting the interface", pr=True)
+                    timings = restart_interface()
+            else:
+                # subprocess.run(f'wg syncconf {WIREGUARD_INTERFACE_NAME} <(wg-quick strip {WIREGUARD_INTERFACE_NAME})', shell=True)
+                timings = restart_interface()
             global client_socket, host, port
+            old_socket = client_socket
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             client_socket.connect((host, port))
             log(f"Connected to {new_endpoint_address}:{new_endpoint_port}")
+            # on the new path now: let the old proxy stop forwarding for us. The
+            # shutdown wakes the tunnel's reader thread, which fails the requests
+            # still waiting on the old socket
+            close_sockets(old_socket)
+            try:
+                mig_socket.sendall(b"ok")
+            except OSError:
+                pass
+            mig_socket.close()
+            log(
+                f"{CLIENT_MIGRATION_MODE} migration blackout: {time() - start_time:.3f}s, "
+                f"steps: {timings}",
+                pr=True,
+            )
             # with open(MIGRATION_DURATION_LOG_PATH, 'a+') as f:
             #     f.write(str(time() - start_time))
             #     f.write('\n')
@@ -68,6 +93,34 @@ class MigrationHandler(threading.Thread):
             # response = requests.post(url, json=data)
 
 
+tunnel = None
+
+
+def tunnel_request(frame_type, message: str, reader: FrameReader):
+    """
+    Sends one request over client_socket and returns the response, framed,
+    multiplexed or in the old text protocol depending on TUNNEL_PROTOCOL
+    """
+    if TUNNEL_PROTOCOL == "text":
+        client_socket.send(message.encode("utf-8"))
+        return reader.read_frame(client_socket)
+    # a TimeoutError ends up where a dead socket's error does in the text protocol
+    return current_tunnel().fetch(
+        frame_type, message.encode("utf-8"), TUNNEL_REQUEST_TIMEOUT
+    )
+
+
+def current_tunnel():
+    global tunnel
+    if tunnel is None or tunnel.sock is not client_socket:
+        # first request, or a migration replaced the socket
+        if TUNNEL_PROTOCOL == "mux":
+            tunnel = MuxClient(client_socket)
+        else:
+            tunnel = FramedClient(client_socket)
+    return tunnel
+
+
 def tcp_client(host, port):
     try:
         global client_socket
@@ -93,10 +146,10 @@ def tcp_client(host, port):
 
 
 def efficacy_test_bulk_download(host, port, migration, test_duration=300):
-    global client_socket
-    client_socket.connect((host, port))
-    log(f"Connected to {host}:{port}")
     start_time = time()
+    download = ResumableDownload(host, port)
+    download.connect()
+    log(f"Connected to {host}:{port}")
     measure_thread = TrafficGetterThread(start_time=start_time, duration=300)
     measure_thread.start()
     measure_thread_2 = TrafficMeasurementPythonThread(
@@ -107,37 +160,22 @@ def efficacy_test_bulk_download(host, port, migration, test_duration=300):
     #     testing_migration_senderr = TestingMigrationSenderThread(start_time=start_time, duration=test_duration)
     #     testing_migration_senderr.start()
     i = 0
-    amount_of_data_gathered = 0
-    while time() - start_time < test_duration:
-        try:
-            while time() - start_time < test_duration:
-                message = f"BEEGMode {amount_of_data_gathered}"
-                client_socket.send(message.encode("utf-8"))
-                bs = client_socket.recv(8)
-                (length,) = unpack(">Q", bs)
-                data = b""
-                while len(data) < length:
-                    to_read = length - len(data)
-                    client_socket.settimeout(0.2)
-                    new_data = client_socket.recv(4096 if to_read > 4096 else to_read)
-                    data += new_data
-                    amount_of_data_gathered += len(new_data)
-
-                    if time() - start_time > i * 20:
-                        log(f"here at {20*i}s, got {len(data)}data", pr=True)
-                        i += 1
-                # Note: We might have to add this back later
-                # sleep(0.1)
-        except ConnectionRefusedError:
-            log("Connection to the server failed. Make sure the server is running.")
+    deadline = start_time + test_duration
 
-        except ConnectionResetError:
-            log("migrating...")
-
-        except Exception as e:
-            log("the pipe is not ready yet, sleeping for 0.01 sec")
-            log(f"error: {e}")
-            sleep(0.01)
+    while time() < deadline:
+        try:
+            data = download.receive()
+
+            if time() - start_time > i * 20:
+                log(f"here at {20*i}s, got {len(data)}data, at byte {download.offset}", pr=True)
+                i += 1
+        except OSError as e:
+            # partial frames are kept, so the session resumes from download.offset
+            log(f"migrating... ({e}) resuming at byte {download.offset}")
+            reconnect_started = time()
+            if download.reconnect(deadline):
+                log(f"resumed after {time() - reconnect_started:.3f}s")
+    download.close()
     log(f"test is done, total time was: {time() - start_time} secs")
 
 
@@ -159,22 +197,16 @@ def efficacy_test_wikipedia(host, port, migration, test_duration=999999):
     #     )
     #     testing_migration_senderr.start()
     i = 0
+    reader = FrameReader()
     while time() - start_time < test_duration:
         try:
             while time() - start_time < test_duration:
                 message = "https://www.wikipedia.org/"
-                client_socket.send(message.encode("utf-8"))
-                bs = client_socket.recv(8)
-                (length,) = unpack(">Q", bs)
-                data = b""
-                while len(data) < length:
-                    to_read = length - len(data)
-                    new_data = client_socket.recv(4096 if to_read > 4096 else to_read)
-                    data += new_data
-
-                    if time() - start_time > i * 20:
-                        log(f"here at {20*i}s, got {len(data)}data", pr=True)
-                        i += 1
+                data = tunnel_request(FETCH, message, reader)
+
+                if time() - start_time > i * 20:
+                    log(f"here at {20*i}s, got {len(data)}data", pr=True)
+                    i += 1
 
                 sleep(0.1)
         except ConnectionRefusedError:
@@ -190,6 +222,57 @@ def efficacy_test_wikipedia(host, port, migration, test_duration=999999):
     log(f"test is done, total time was: {time() - start_time} secs", pr=True)
 
 
+def efficacy_test_page_loads(host, port, migration, test_duration=300, resources=20):
+    """
+    Browser-like: every "page" is fetched together with `resources` more URLs, all
+    at once as streams of one multiplexed connection
+    """
+    global client_socket
+    client_socket.connect((host, port))
+    log(f"Connected to {host}:{port}")
+    start_time = time()
+    measure_thread = TrafficMeasurementPythonThread(
+        start_time=start_time, duration=test_duration
+    )
+    measure_thread.start()
+    urls = ["https://www.wikipedia.org/"] + [
+        f"https://www.wikipedia.org/?resource={i}" for i in range(resources)
+    ]
+    i = 0
+    page_tunnel = None
+    while time() - start_time < test_duration:
+        try:
+            page_start = time()
+            if page_tunnel is None or page_tunnel.sock is not client_socket:
+                # a migration replaced the socket
+                page_tunnel = MuxClient(client_socket)
+            streams = [page_tunnel.open_stream(FETCH, url.encode()) for url in urls]
+            try:
+                received = sum(
+                    len(stream.read_all(TUNNEL_REQUEST_TIMEOUT)) for stream in streams
+                )
+            except TimeoutError:
+                # no response is coming on these, e.g. the tunnel went away
+                for stream in streams:
+                    page_tunnel.forget(stream)
+                raise
+            if time() - start_time > i * 20:
+                log(
+                    f"here at {20*i}s, page of {len(urls)} took {time() - page_start:.3f}s, "
+                    f"got {received}data",
+                    pr=True,
+                )
+                i += 1
+            sleep(0.1)
+        except (ConnectionResetError, ProtocolError):
+            log("migrating...")
+            sleep(0.01)
+        except Exception as e:
+            log(f"error: {e}")
+            sleep(0.01)
+    log(f"test is done, total time was: {time() - start_time} secs", pr=True)
+
+
 def efficacy_test_kv_store(host, port, migration, test_duration=300):
     last_ack = -1
     global client_socket
@@ -206,21 +289,15 @@ def efficacy_test_kv_store(host, port, migration, test_duration=300):
     #     testing_migration_senderr = TestingMigrationSenderThread(start_time=start_time, duration=test_duration)
     #     testing_migration_senderr.start()
     i = 0
+    reader = FrameReader()
     while time() - start_time < test_duration:
         try:
             while time() - start_time < test_duration:
                 message = "GET testing_key"
-                client_socket.send(message.encode("utf-8"))
-                bs = client_socket.recv(8)
-                (length,) = unpack(">Q", bs)
-                data = b""
-                while len(data) < length:
-                    to_read = length - len(data)
-                    new_data = client_socket.recv(4096 if to_read > 4096 else to_read)
-                    data += new_data
-                    if time() - start_time > i * 20:
-                        log(f"here at {20*i}s, got {len(data)}data", pr=True)
-                        i += 1
+                data = tunnel_request(KV, message, reader)
+                if time() - start_time > i * 20:
+                    log(f"here at {20*i}s, got {len(data)}data", pr=True)
+                    i += 1
 
                 sleep(0.1)
         except ConnectionRefusedError:
@@ -246,22 +323,16 @@ def mass_test_simple_client(host, port, test_duration=1500):
     # testing_data_sender = TestingDataSenderThread(start_time=start_time, duration=test_duration)
     # testing_data_sender.start()
     i = 0
+    reader = FrameReader()
     while time() - start_time < test_duration:
         try:
             while time() - start_time < test_duration:
                 message = "https://www.wikipedia.org/"
-                client_socket.send(message.encode("utf-8"))
-                bs = client_socket.recv(8)
-                (length,) = unpack(">Q", bs)
-                data = b""
-                while len(data) < length:
-                    to_read = length - len(data)
-                    new_data = client_socket.recv(4096 if to_read > 4096 else to_read)
-                    data += new_data
-
-                    if time() - start_time > i * 20:
-                        log(f"here at {20*i}s, got {len(data)}data", pr=True)
-                        i += 1
+                data = tunnel_request(FETCH, message, reader)
+
+                if time() - start_time > i * 20:
+                    log(f"here at {20*i}s, got {len(data)}data", pr=True)
+                    i += 1
 
                 sleep(0.5)
         except ConnectionRefusedError:
@@ -297,7 +368,13 @@ if __name__ == "__main__":
         handler.start()
         host = "10.27.0.20"
         port = 8088
-        efficacy_test_wikipedia(host, port, migration=True)
+        efficacy_tests = {
+            "wikipedia": efficacy_test_wikipedia,
+            "bulk_download": efficacy_test_bulk_download,
+            "kv_store": efficacy_test_kv_store,
+            "page_loads": efficacy_test_page_loads,
+        }
+        efficacy_tests[EFFICACY_TEST](host, port, migration=True)
         # NOTE: Code for all the previous tests
         # choice = input(
         #     "the format is False: no mig - True: with mig. \n0 and 1 for wiki, 2 and 3 for bulk, 4 and 5 for kv.\nstart? "
@@ -314,5 +391,7 @@ if __name__ == "__main__":
         #     efficacy_test_kv_store(host, port, migration=False)
         # elif choice == "5":
         #     efficacy_test_kv_store(host, port, migration=True)
+        # elif choice == "6":
+        #     efficacy_test_page_loads(host, port, migration=True)
         # else:
         #     tcp_client(host, port)
@@ -0,0 +1,114 @@
+import subprocess
+from time import sleep, time
+
+from settings import (
+    WIREGUARD_INTERFACE_NAME,
+    HANDSHAKE_WARMUP_TIMEOUT,
+    HANDSHAKE_POLL_INTERVAL,
+    PERSISTENT_KEEPALIVE,
+)
+
+
+def wg(*args, interface=WIREGUARD_INTERFACE_NAME) -> str:
+    return subprocess.run(
+        ["wg", args[0], interface, *args[1:]],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+
+def latest_handshakes(interface=WIREGUARD_INTERFACE_NAME) -> dict:
+    """
+    Public key -> unix time of the last completed handshake, 0 if none yet
+    """
+    handshakes = {}
+    for line in wg("show", "latest-handshakes", interface=interface).splitlines():
+        public_key, _, timestamp = line.partition("\t")
+        handshakes[public_key] = int(timestamp or 0)
+    return handshakes
+
+
+def wait_for_handshake(public_key, after, interface, timeout=HANDSHAKE_WARMUP_TIMEOUT):
+    """
+    Polls until public_key completes a handshake newer than `after`. Returns
+    whether it did within timeout.
+    """
+    deadline = time() + timeout
+    while time() < deadline:
+        if latest_handshakes(interface).get(public_key, 0) > after:
+            return True
+        sleep(HANDSHAKE_POLL_INTERVAL)
+    return False
+
+
+def swap_endpoint(
+    public_key,
+    new_endpoint,
+    allowed_ips,
+    new_public_key=None,
+    interface=WIREGUARD_INTERFACE_NAME,
+):
+    """
+    Points the running interface at a new proxy without taking it down. With a
+    new key, the new peer is added beside the old one with no allowed IPs and
+    warmed up with a keepalive; traffic moves over only once it has handshaken.
+    With the same key the peer is removed and added back at the new endpoint:
+    switching the endpoint in place would keep the session keys, which the new
+    proxy does not have, so it would drop everything until WireGuard rekeys on
+    its own (15 seconds or more). Returns the step timings in seconds.
+    """
+    timings = {}
+    start_time = time()
+    before = latest_handshakes(interface).get(new_public_key or public_key, 0)
+
+    if new_public_key and new_public_key != public_key:
+        wg(
+            "set", "peer", new_public_key,
+            "endpoint", new_endpoint,
+            "persistent-keepalive", "1",
+            "allowed-ips", "",
+            interface=interface,
+        )
+        timings["warmed"] = wait_for_handshake(new_public_key, before, interface)
+        timings["handshake"] = time() - start_time
+        # moving the allowed IPs is the switch; the old peer stops getting traffic
+        wg(
+            "set", "peer", new_public_key,
+            "persistent-keepalive", str(PERSISTENT_KEEPALIVE),
+            "allowed-ips", allowed_ips,
+            "peer", public_key, "remove",
+            interface=interface,
+        )
+        timings["switch"] = time() - start_time
+    else:
+        # dropping the peer drops its session, so the keepalive starts a handshake
+        wg("set", "peer", public_key, "remove", interface=interface)
+        wg(
+            "set", "peer", public_key,
+            "endpoint", new_endpoint,
+            "persistent-keepalive", "1",
+            "allowed-ips", allowed_ips,
+            interface=interface,
+        )
+        timings["switch"] = time() - start_time
+        timings["warmed"] = wait_for_handshake(public_key, before, interface)
+        timings["handshake"] = time() - start_time
+        wg(
+            "set", "peer", public_key,
+            "persistent-keepalive", str(PERSISTENT_KEEPALIVE),
+            interface=interface,
+        )
+
+    timings["total"] = time() - start_time
+    return timings
+
+
+def restart_interface(interface=WIREGUARD_INTERFACE_NAME):
+    """
+    The old path: tear the interface down and bring it back from the config file
+    """
+    start_time = time()
+    subprocess.run(f"wg-quick down {interface}", shell=True)
+    subprocess.run(f"wg-quick up {interface}", shell=True)
+    return {"total": time() - start_time}
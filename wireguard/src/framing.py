@@ -0,0 +1,199 @@
+"""
+Binary framing for requests over the tunnel. Every frame is a FRAME_HEADER
+(version, type, flags, request id, payload length) followed by the payload, so
+messages survive TCP splitting and coalescing, and a connection can have many
+requests in flight with responses coming back in any order, matched by id.
+"""
+import socket
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from struct import Struct
+
+from buffers import ProtocolError, buffer_pool, size_class
+from settings import FRAME_MAX_SIZE, MIN_RELAY_BUFFER_SIZE
+
+FRAME_VERSION = 1
+FRAME_HEADER = Struct(">BBHII")
+
+# request types
+FETCH = 1  # payload: URL
+BEEG = 2  # payload: BEEG_REQUEST
+KV = 3  # payload: "GET <key>" or "MGET <key> ..."
+# response types
+RESPONSE = 128
+ERROR = 129
+# multiplexed streams (mux.py); the request id field carries the stream id
+STREAM_OPEN = 16  # payload: request type byte, then the request
+STREAM_DATA = 17  # part of a response, FIN set on the last one
+WINDOW_UPDATE = 18  # payload: WINDOW_INCREMENT
+STREAM_RESET = 19  # payload: reason
+
+FIN = 1
+WINDOW_INCREMENT = Struct(">I")
+
+BEEG_REQUEST = Struct(">QI")  # offset, byte count
+
+
+def pack_header(frame_type, request_id, length, flags=0):
+    return FRAME_HEADER.pack(FRAME_VERSION, frame_type, flags, request_id, length)
+
+
+def write_frame(sock: socket.socket, frame_type, request_id, payload=b"", flags=0):
+    """
+    Sends header and payload with one sendmsg, without joining them first
+    """
+    header = pack_header(frame_type, request_id, len(payload), flags)
+    sent = sock.sendmsg([header, payload])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sent = len(header)
+    if sent - len(header) < len(payload):
+        sock.sendall(memoryview(payload)[sent - len(header) :])
+
+
+class FrameParser:
+    """
+    Reads frames into one pooled buffer. Payloads are handed out as memoryviews of
+    that buffer, so they are only valid until the next recv_into or feed.
+    """
+
+    def __init__(self, initial_size=MIN_RELAY_BUFFER_SIZE, max_size=FRAME_MAX_SIZE):
+        self.max_size = max_size
+        self.buffer = buffer_pool.acquire(initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def make_room(self):
+        # keep the unparsed tail, moved to the front of a big enough buffer
+        needed = self.end - self.start
+        if needed >= FRAME_HEADER.size:
+            _, _, _, _, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            needed = FRAME_HEADER.size + length
+        if needed > len(self.buffer):
+            old_buffer, old_view = self.buffer, self.view
+            self.buffer = buffer_pool.acquire(size_class(needed))
+            self.view = memoryview(self.buffer)
+            self.view[: self.end - self.start] = old_view[self.start : self.end]
+            old_view.release()
+            buffer_pool.release(old_buffer)
+        elif self.start:
+            self.view[: self.end - self.start] = self.view[self.start : self.end]
+        self.end -= self.start
+        self.start = 0
+
+    def recv_into(self, sock: socket.socket) -> int:
+        if self.end == len(self.buffer) or self.start:
+            self.make_room()
+        n = sock.recv_into(self.view[self.end :])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self.make_room()
+        while self.end + len(data) > len(self.buffer):
+            # grow first so a burst of small frames fits as well as one big one
+            self.start = 0
+            old_buffer, old_view = self.buffer, self.view
+            self.buffer = buffer_pool.acquire(len(old_buffer) * 2)
+            self.view = memoryview(self.buffer)
+            self.view[: self.end] = old_view[: self.end]
+            old_view.release()
+            buffer_pool.release(old_buffer)
+        self.view[self.end : self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """
+        Yields (type, request id, flags, payload view) for every complete frame
+        """
+        while self.end - self.start >= FRAME_HEADER.size:
+            version, frame_type, flags, request_id, length = FRAME_HEADER.unpack_from(
+                self.buffer, self.start
+            )
+            if version != FRAME_VERSION:
+                raise ProtocolError(f"unsupported frame version {version}")
+            if length > self.max_size:
+                raise ProtocolError(f"frame of {length} bytes is over the limit")
+            payload_start = self.start + FRAME_HEADER.size
+            if self.end - payload_start < length:
+                return
+            self.start = payload_start + length
+            yield frame_type, request_id, flags, self.view[payload_start : self.start]
+
+    def close(self):
+        self.view.release()
+        buffer_pool.release(self.buffer)
+        self.buffer = None
+
+
+class FramedClient:
+    """
+    Client end of a framed connection. request() can be called from any number of
+    threads; a reader thread completes each returned Future when its response
+    arrives, in whatever order the NAT answers.
+    """
+
+    def __init__(self, sock: socket.socket):
+        # requests are small and many are in flight, Nagle would hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.closed = None
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    def request(self, frame_type, payload: bytes) -> Future:
+        future = Future()
+        with self.lock:
+            if self.closed is not None:
+                future.set_exception(self.closed)
+                return future
+            request_id = future.request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            self.pending[request_id] = future
+            try:
+                write_frame(self.sock, frame_type, request_id, payload)
+            except OSError as e:
+                del self.pending[request_id]
+                future.set_exception(e)
+        return future
+
+    def fetch(self, frame_type, payload: bytes, timeout=None) -> bytes:
+        """
+        request() and wait for the response, raising TimeoutError if it has not
+        come within timeout seconds
+        """
+        future = self.request(frame_type, payload)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            with self.lock:
+                self.pending.pop(future.request_id, None)
+            raise TimeoutError(f"request {future.request_id} timed out")
+
+    def read_responses(self):
+        parser = FrameParser()
+        error = ConnectionResetError("connection closed")
+        try:
+            while parser.recv_into(self.sock):
+                for frame_type, request_id, _, payload in parser.frames():
+                    with self.lock:
+                        future = self.pending.pop(request_id, None)
+                    if future is None:
+                        continue
+                    if frame_type == ERROR:
+                        future.set_exception(ProtocolError(bytes(payload).decode()))
+                    else:
+                        future.set_result(bytes(payload))
+        except (OSError, ProtocolError) as e:
+            error = e
+        finally:
+            parser.close()
+            with self.lock:
+                self.closed = error
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(error)
@@ -0,0 +1,173 @@
+import threading
+from time import sleep
+
+import redis
+
+from buffers import LENGTH_PREFIX
+from nat_cache import ResponseCache
+from settings import (
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_PASSWORD,
+    REDIS_MAX_CONNECTIONS,
+    KV_LOCAL_CACHE_TTL,
+    KV_LOCAL_CACHE_MAX_BYTES,
+)
+
+
+def create_redis_client():
+    """
+    A client on one shared, bounded connection pool; threads wait for a free
+    connection instead of opening their own
+    """
+    pool = redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        password=REDIS_PASSWORD,
+        max_connections=REDIS_MAX_CONNECTIONS,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+class FakeRedisPipeline:
+    def __init__(self, fake):
+        self.fake = fake
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append((self.fake.lookup, key))
+        return self
+
+    def mget(self, keys):
+        self.commands.append((lambda keys: [self.fake.lookup(k) for k in keys], keys))
+        return self
+
+    def set(self, key, value):
+        self.commands.append((lambda item: self.fake.store(*item), (key, value)))
+        return self
+
+    def execute(self):
+        self.fake.round_trip()
+        with self.fake.lock:
+            return [command(argument) for command, argument in self.commands]
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the subset of redis.Redis the KV mode uses, so it can
+    run and be benchmarked offline. Every call or pipeline execute sleeps for
+    round_trip_delay to model the network hop to a real server.
+    """
+
+    def __init__(self, round_trip_delay=0.0):
+        self.round_trip_delay = round_trip_delay
+        self.lock = threading.Lock()
+        self.data = {}
+        self.round_trips = 0
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.round_trip_delay:
+            sleep(self.round_trip_delay)
+
+    def lookup(self, key):
+        # caller holds the lock
+        return self.data.get(key)
+
+    def store(self, key, value):
+        # caller holds the lock
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    def get(self, key):
+        return self.pipeline().get(key).execute()[0]
+
+    def mget(self, keys):
+        return self.pipeline().mget(keys).execute()[0]
+
+    def set(self, key, value):
+        return self.pipeline().set(key, value).execute()[0]
+
+    def pipeline(self, transaction=False):
+        return FakeRedisPipeline(self)
+
+
+def parse_kv_request(request: bytes):
+    """
+    "GET <key>" or "MGET <key> [<key> ...]" -> (command, keys), or None
+    """
+    words = request.decode(errors="replace").split()
+    if len(words) < 2:
+        return None
+    command = words[0].upper()
+    if command == "GET" and len(words) == 2:
+        return command, words[1:]
+    if command == "MGET":
+        return command, words[1:]
+    return None
+
+
+def encode_mget(values) -> bytes:
+    """
+    An MGET response is its values back to back, each with its own length prefix
+    """
+    parts = []
+    for value in values:
+        parts.append(LENGTH_PREFIX.pack(len(value)))
+        parts.append(value)
+    return b"".join(parts)
+
+
+class KVStore:
+    """
+    Answers parsed GET/MGET requests from Redis, sending every key that misses
+    the local read-through cache in a single pipelined round trip
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        cache_ttl=KV_LOCAL_CACHE_TTL,
+        cache_max_bytes=KV_LOCAL_CACHE_MAX_BYTES,
+    ):
+        self.redis_client = redis_client
+        self.cache_ttl = cache_ttl
+        self.cache = None
+        if cache_ttl > 0:
+            self.cache = ResponseCache(cache_max_bytes, cache_ttl)
+
+    def fetch_values(self, keys) -> dict:
+        values = {}
+        missing = []
+        for key in keys:
+            cached = self.cache.lookup(key) if self.cache else None
+            if cached is None:
+                missing.append(key)
+            else:
+                values[key] = cached
+
+        if missing:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.mget(missing)
+            (fetched,) = pipeline.execute()
+            for key, value in zip(missing, fetched):
+                value = value or b""
+                values[key] = value
+                if self.cache and value:
+                    self.cache.put(key, value, self.cache_ttl)
+        return values
+
+    def execute(self, parsed_requests) -> list:
+        """
+        Returns one response payload per (command, keys) request, in order
+        """
+        keys = {key for _, request_keys in parsed_requests for key in request_keys}
+        values = self.fetch_values(list(keys))
+        responses = []
+        for command, request_keys in parsed_requests:
+            if command == "GET":
+                responses.append(values[request_keys[0]])
+            else:
+                responses.append(encode_mget(values[key] for key in request_keys))
+        return responses
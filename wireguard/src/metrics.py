@@ -0,0 +1,171 @@
+import json
+import threading
+from collections import deque
+from math import exp
+from time import sleep, time
+
+import psutil
+
+from registry import connection_registry
+from settings import METRICS_SAMPLE_INTERVAL, METRICS_WINDOWS, METRICS_CLIENT_HISTORY
+
+NIC_COUNTERS = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv")
+
+
+class Ewma:
+    """
+    Exponentially weighted moving average with a time constant of `window`
+    seconds, for samples taken at uneven intervals
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.value = None
+
+    def update(self, sample, elapsed):
+        if self.value is None:
+            self.value = sample
+        else:
+            alpha = 1 - exp(-elapsed / self.window)
+            self.value += alpha * (sample - self.value)
+        return self.value
+
+
+class ClientChanges:
+    """
+    The set of connected client IPs, with a version that goes up on every change
+    and the last `history` changes, so a poller can ask for what changed since the
+    version it already has
+    """
+
+    def __init__(self, history=METRICS_CLIENT_HISTORY):
+        self.version = 0
+        self.clients = set()
+        self.changes = deque(maxlen=history)
+
+    def update(self, clients: set):
+        added = clients - self.clients
+        removed = self.clients - clients
+        if added or removed:
+            self.version += 1
+            self.changes.append((self.version, added, removed))
+            self.clients = clients
+
+    def full(self):
+        return {"version": self.version, "full": True, "clients": sorted(self.clients)}
+
+    def since(self, version):
+        if version == self.version:
+            return {"version": self.version, "full": False, "added": [], "removed": []}
+        if not self.changes or version < self.changes[0][0] - 1 or version > self.version:
+            return self.full()
+        added, removed = set(), set()
+        for change_version, change_added, change_removed in self.changes:
+            if change_version <= version:
+                continue
+            # a client that left and came back (or the reverse) nets out
+            added = (added - change_removed) | change_added
+            removed = (removed - change_added) | change_removed
+        return {
+            "version": self.version,
+            "full": False,
+            "added": sorted(added),
+            "removed": sorted(removed),
+        }
+
+
+class MetricsSampler(threading.Thread):
+    """
+    Samples CPU, per-interface byte and packet counters and connections every
+    `interval` seconds, keeping EWMAs and rates over each of `windows` seconds.
+    Polls are answered from the last sample, without measuring anything.
+
+    A poll of "hello" gets the whole client list, as before; "delta <version>"
+    gets the clients added and removed since that version.
+    """
+
+    def __init__(
+        self,
+        registry=connection_registry,
+        interval=METRICS_SAMPLE_INTERVAL,
+        windows=METRICS_WINDOWS,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self.windows = windows
+        self.lock = threading.Lock()
+        self.cpu = [Ewma(w) for w in windows]
+        self.connections = [Ewma(w) for w in windows]
+        # (time, per-interface counters), as far back as the longest window
+        self.history = deque()
+        self.clients = ClientChanges()
+        self.report = {}
+        self.encoded_report = b"{}"
+        self.sample()
+
+    def rates(self, now, counters):
+        rates = {}
+        for nic, values in counters.items():
+            rates[nic] = {name: {} for name in NIC_COUNTERS}
+            for window in self.windows:
+                # the oldest sample still inside the window
+                horizon = window + self.interval / 2
+                then, old = next(
+                    ((t, c) for t, c in self.history if now - t <= horizon),
+                    (now, counters),
+                )
+                elapsed = now - then
+                for name in NIC_COUNTERS:
+                    old_value = getattr(old.get(nic, values), name)
+                    rate = (getattr(values, name) - old_value) / elapsed if elapsed else 0
+                    rates[nic][name][f"{window}s"] = rate
+        return rates
+
+    def sample(self):
+        now = time()
+        elapsed = now - self.history[-1][0] if self.history else self.interval
+        cpu = psutil.cpu_percent(interval=None)
+        counters = psutil.net_io_counters(pernic=True)
+        addresses = self.registry.addresses()
+        interfaces = self.rates(now, counters)
+        self.history.append((now, counters))
+        while now - self.history[0][0] > max(self.windows) + self.interval:
+            self.history.popleft()
+
+        cpu_averages = {f"{e.window}s": e.update(cpu, elapsed) for e in self.cpu}
+        connection_averages = {
+            f"{e.window}s": e.update(len(addresses), elapsed) for e in self.connections
+        }
+        shortest = f"{min(self.windows)}s"
+        report = {
+            "sampled_at": now,
+            # the keys the controller always read, now over the shortest window
+            "utility": cpu_averages[shortest],
+            "throughput": sum(nic["bytes_sent"][shortest] for nic in interfaces.values()),
+            "cpu": cpu_averages,
+            "interfaces": interfaces,
+            "connections": {"now": len(addresses), **connection_averages},
+        }
+        with self.lock:
+            self.clients.update({address[0] for address in addresses})
+            report["connected_clients"] = sorted(self.clients.clients)
+            self.report = report
+            self.encoded_report = json.dumps(report).encode()
+
+    def answer(self, request: bytes) -> bytes:
+        words = request.decode(errors="replace").split()
+        with self.lock:
+            if len(words) == 2 and words[0] == "delta" and words[1].isdigit():
+                report = {k: v for k, v in self.report.items() if k != "connected_clients"}
+                report["clients"] = self.clients.since(int(words[1]))
+                return json.dumps(report).encode()
+            return self.encoded_report
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"ERROR: metrics sample failed: {e}")
@@ -0,0 +1,194 @@
+import selectors
+import socket
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time
+
+from settings import (
+    MIGRATION_PORT,
+    WIREGUARD_PORT,
+    MIGRATION_NOTIFY_WORKERS,
+    MIGRATION_NOTIFY_TIMEOUT,
+    PROXY_MIGRATION_MODE,
+    MIGRATION_DRAIN_TIMEOUT,
+)
+from relay_stats import close_counting_loss, close_sockets
+
+
+class LatencyHistogram:
+    """
+    Counts latencies into fixed millisecond buckets and keeps the raw samples for
+    percentiles
+    """
+
+    BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.samples = []
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[bisect_left(self.BUCKETS_MS, seconds * 1000)] += 1
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return 0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def summary(self):
+        return {
+            "count": len(self.samples),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": max(self.samples, default=0),
+        }
+
+    def render(self):
+        lines = []
+        lower = 0
+        for upper, count in zip(self.BUCKETS_MS + [None], self.counts):
+            if count:
+                label = f"{lower}-{upper} ms" if upper else f">{lower} ms"
+                lines.append(f"{label:>14} {count:>6} {'#' * min(count, 60)}")
+            lower = upper
+        return "\n".join(lines)
+
+
+class MigrationNotifier:
+    """
+    Moves every client of this proxy to a new one, sending the new endpoint to up
+    to `workers` clients at a time. Every connection gives up after `timeout`
+    seconds so an unreachable client cannot hold the others back.
+
+    "break" says goodbye to every client and closes its connections while the
+    peer config goes to the new proxy. "make_before_break" keeps forwarding while
+    clients move, closing each client's connections once it confirms it is on the
+    new proxy, or after drain_timeout.
+
+    The overlap only covers the TCP relays already in flight here: once a client
+    swaps its endpoint, its WireGuard packets reach the new proxy, so this one
+    carries nothing new for it. What keeps going is delivery over its existing
+    relay connections until it confirms, instead of those bytes being dropped
+    the moment it is told to move.
+    """
+
+    def __init__(
+        self,
+        workers=MIGRATION_NOTIFY_WORKERS,
+        timeout=MIGRATION_NOTIFY_TIMEOUT,
+        migration_port=MIGRATION_PORT,
+        mode=PROXY_MIGRATION_MODE,
+        drain_timeout=MIGRATION_DRAIN_TIMEOUT,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.migration_port = migration_port
+        self.mode = mode
+        self.drain_timeout = drain_timeout
+
+    def send_peer_config(self, new_proxy_ip, config: bytes):
+        with socket.create_connection(
+            (new_proxy_ip, self.migration_port), timeout=self.timeout
+        ) as s:
+            s.sendall(config)
+
+    def notify_client(self, address, new_endpoint: bytes, config_sent):
+        """
+        Sends the new endpoint and returns the still open notification connection
+        """
+        config_sent.result()
+        s = socket.create_connection(
+            (address[0], self.migration_port), timeout=self.timeout
+        )
+        try:
+            s.sendall(new_endpoint)
+        except OSError:
+            s.close()
+            raise
+        return s
+
+    def say_goodbye(self, client_socket, nat_socket):
+        try:
+            client_socket.send("bye!".encode())
+        except OSError:
+            pass
+        return close_counting_loss(client_socket, nat_socket)
+
+    def drain(self, confirmations: dict, start_time, histogram):
+        """
+        Keeps the in-flight relays forwarding until each client answers on its
+        notification connection, then closes its relay sockets. A confirmed client
+        has left its old connections, so only those still open at drain_timeout
+        count as dropped.
+        """
+        lost = 0
+        selector = selectors.DefaultSelector()
+        for s in confirmations:
+            selector.register(s, selectors.EVENT_READ)
+        deadline = start_time + self.drain_timeout
+        while confirmations and (remaining := deadline - time()) > 0:
+            for key, _ in selector.select(remaining):
+                _, client_socket, nat_socket = confirmations.pop(key.fileobj)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                histogram.record(time() - start_time)
+                close_sockets(client_socket, nat_socket)
+        for s, (address, client_socket, nat_socket) in confirmations.items():
+            print(f"{address} did not confirm within {self.drain_timeout}s")
+            s.close()
+            lost += close_counting_loss(client_socket, nat_socket)
+        selector.close()
+        return lost
+
+    def migrate(self, new_proxy_ip, config: bytes, clients: list):
+        """
+        clients are (address, client_socket, nat_socket) tuples. Returns the total
+        time, the per-client latency histogram (until told for "break", until
+        confirmed for "make_before_break"), the addresses that could not be told
+        and the bytes dropped unread.
+        """
+        start_time = time()
+        histogram = LatencyHistogram()
+        failed = []
+        lost = 0
+        confirmations = {}
+        make_before_break = self.mode == "make_before_break"
+        new_endpoint = f"{new_proxy_ip}:{WIREGUARD_PORT}".encode()
+
+        with ThreadPoolExecutor(max_workers=self.workers + 1) as executor:
+            config_sent = executor.submit(self.send_peer_config, new_proxy_ip, config)
+            if not make_before_break:
+                for _, client_socket, nat_socket in clients:
+                    lost += self.say_goodbye(client_socket, nat_socket)
+
+            notifications = {
+                executor.submit(
+                    self.notify_client, client[0], new_endpoint, config_sent
+                ): client
+                for client in clients
+            }
+            for notification in as_completed(notifications):
+                client = notifications[notification]
+                try:
+                    s = notification.result()
+                except OSError as e:
+                    failed.append(client[0])
+                    print(f"could not notify {client[0]}: {e}")
+                    if make_before_break:
+                        lost += close_counting_loss(client[1], client[2])
+                    continue
+                if make_before_break:
+                    confirmations[s] = client
+                else:
+                    s.close()
+                    histogram.record(time() - start_time)
+
+        if confirmations:
+            lost += self.drain(confirmations, start_time, histogram)
+        return time() - start_time, histogram, failed, lost
@@ -0,0 +1,249 @@
+"""
+Many logical streams over one framed connection. A client opens a stream per
+request; the NAT answers each in MUX_CHUNK_SIZE DATA frames, taking turns
+between streams, so a big response does not block the small ones queued behind
+it. Each stream has its own window: the NAT sends at most MUX_STREAM_WINDOW
+bytes the client has not read yet, and the client returns credit with
+WINDOW_UPDATE as it reads.
+"""
+import socket
+import threading
+from collections import deque
+
+from framing import (
+    STREAM_OPEN,
+    STREAM_DATA,
+    WINDOW_UPDATE,
+    STREAM_RESET,
+    FIN,
+    WINDOW_INCREMENT,
+    FrameParser,
+    ProtocolError,
+    write_frame,
+)
+from settings import MUX_CHUNK_SIZE, MUX_STREAM_WINDOW
+
+
+class OutgoingStream:
+    def __init__(self, window):
+        self.credit = window
+        self.data = None
+        self.sent = 0
+
+
+class StreamScheduler(threading.Thread):
+    """
+    NAT side. Writes stream responses as they become ready, one chunk per stream
+    in turn, skipping streams that are out of credit until the client grants more.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        send_lock: threading.Lock,
+        chunk_size=MUX_CHUNK_SIZE,
+        window=MUX_STREAM_WINDOW,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.send_lock = send_lock
+        self.chunk_size = chunk_size
+        self.window = window
+        self.cond = threading.Condition()
+        self.streams = {}
+        # streams with data and credit, in the order they get their next turn
+        self.ready = deque()
+        self.closed = False
+
+    def schedule(self, stream_id):
+        # caller holds cond
+        stream = self.streams[stream_id]
+        if stream.data is not None and stream.credit > 0 and stream_id not in self.ready:
+            self.ready.append(stream_id)
+            self.cond.notify()
+
+    def open(self, stream_id):
+        with self.cond:
+            self.streams[stream_id] = OutgoingStream(self.window)
+
+    def add(self, stream_id, data):
+        with self.cond:
+            if stream_id in self.streams:
+                self.streams[stream_id].data = memoryview(data)
+                self.schedule(stream_id)
+
+    def grant(self, stream_id, credit):
+        with self.cond:
+            if stream_id in self.streams:
+                self.streams[stream_id].credit += credit
+                self.schedule(stream_id)
+
+    def reset(self, stream_id):
+        with self.cond:
+            self.streams.pop(stream_id, None)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                stream_id = self.ready.popleft()
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    continue
+                count = min(self.chunk_size, stream.credit, len(stream.data) - stream.sent)
+                chunk = stream.data[stream.sent : stream.sent + count]
+                stream.sent += count
+                stream.credit -= count
+                last = stream.sent == len(stream.data)
+                if last:
+                    del self.streams[stream_id]
+                else:
+                    self.schedule(stream_id)
+            try:
+                with self.send_lock:
+                    write_frame(self.sock, STREAM_DATA, stream_id, chunk, FIN if last else 0)
+            except OSError:
+                return
+
+
+class Stream:
+    """
+    Client side of one stream. Chunks are queued by the MuxClient reader thread
+    and handed out by read(), which returns b"" once the response is complete.
+    """
+
+    def __init__(self, client, stream_id):
+        self.client = client
+        self.id = stream_id
+        self.cond = threading.Condition()
+        self.chunks = deque()
+        self.finished = False
+        self.error = None
+        self.unacknowledged = 0
+
+    def push(self, chunk, fin):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.finished = fin
+            self.cond.notify()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify()
+
+    def read(self, timeout=None) -> bytes:
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.chunks or self.finished or self.error, timeout
+            ):
+                raise TimeoutError(f"stream {self.id} timed out")
+            if not self.chunks:
+                if self.finished:
+                    return b""
+                raise self.error
+            chunk = self.chunks.popleft()
+            done = self.finished and not self.chunks
+        if done:
+            self.client.forget(self)
+        else:
+            self.client.consumed(self, len(chunk))
+        return chunk
+
+    def read_all(self, timeout=None) -> bytes:
+        parts = []
+        while chunk := self.read(timeout):
+            parts.append(chunk)
+        return b"".join(parts)
+
+
+class MuxClient:
+    """
+    Client end of a multiplexed connection. open_stream() can be called from any
+    thread; responses are read from their own Stream, at whatever pace each
+    reader likes, without holding up the other streams.
+    """
+
+    def __init__(self, sock: socket.socket, window=MUX_STREAM_WINDOW):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.window = window
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.next_id = 0
+        self.closed = None
+        self.reader = threading.Thread(target=self.read_frames, daemon=True)
+        self.reader.start()
+
+    def open_stream(self, request_type, payload: bytes) -> Stream:
+        with self.lock:
+            stream = Stream(self, self.next_id)
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            if self.closed is not None:
+                stream.fail(self.closed)
+                return stream
+            self.streams[stream.id] = stream
+            try:
+                write_frame(self.sock, STREAM_OPEN, stream.id, bytes([request_type]) + payload)
+            except OSError as e:
+                del self.streams[stream.id]
+                stream.fail(e)
+        return stream
+
+    def fetch(self, request_type, payload: bytes, timeout=None) -> bytes:
+        stream = self.open_stream(request_type, payload)
+        try:
+            return stream.read_all(timeout)
+        except TimeoutError:
+            self.forget(stream)
+            raise
+
+    def consumed(self, stream: Stream, n):
+        stream.unacknowledged += n
+        # return credit in batches, not per chunk
+        if stream.unacknowledged < self.window // 2:
+            return
+        credit, stream.unacknowledged = stream.unacknowledged, 0
+        with self.lock:
+            if self.closed is None:
+                try:
+                    write_frame(self.sock, WINDOW_UPDATE, stream.id, WINDOW_INCREMENT.pack(credit))
+                except OSError:
+                    pass
+
+    def forget(self, stream: Stream):
+        with self.lock:
+            self.streams.pop(stream.id, None)
+
+    def read_frames(self):
+        parser = FrameParser()
+        error = ConnectionResetError("connection closed")
+        try:
+            while parser.recv_into(self.sock):
+                for frame_type, stream_id, flags, payload in parser.frames():
+                    with self.lock:
+                        stream = self.streams.get(stream_id)
+                    if stream is None:
+                        continue
+                    if frame_type == STREAM_DATA:
+                        stream.push(bytes(payload), bool(flags & FIN))
+                    elif frame_type == STREAM_RESET:
+                        self.forget(stream)
+                        stream.fail(ProtocolError(bytes(payload).decode()))
+        except (OSError, ProtocolError) as e:
+            error = e
+        finally:
+            parser.close()
+            with self.lock:
+                self.closed = error
+                streams, self.streams = self.streams, {}
+            for stream in streams.values():
+                stream.fail(error)
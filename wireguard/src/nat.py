@@ -2,7 +2,21 @@ import socket
 import os
 import requests
 
-from nat_threads import EchoThread, NATThread, KVThread, BEEGThread
+from nat_threads import (
+    EchoThread,
+    NATThread,
+    KVThread,
+    BEEGThread,
+    BulkFile,
+    NATPollingHandler,
+    FramedThread,
+    fetch_request,
+    kv_request_handler,
+)
+from framing import FETCH, BEEG, KV
+from kv_store import KVStore, create_redis_client
+from settings import NAT_POLLING_ENDPOINT, KV_TEST_KEY, KV_TEST_VALUE
+from nat_async import async_nat_server
 
 
 def echo_server(host, port):
@@ -31,14 +45,20 @@ def nat_server(host, port):
         client_socket, client_address = nat_socket.accept()
         print(f"Accepted connection from {client_address}")
 
-        thr = NATThread(client_socket, client_address)
+        thr = FramedThread(
+            client_socket,
+            client_address,
+            {FETCH: fetch_request},
+            NATThread(client_socket, client_address),
+        )
         thr.start()
 
 
 def nat_server_with_bulk_downloads(host, port, beeg_file_path):
+    bulk_file = BulkFile(beeg_file_path)
     nat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     nat_socket.bind((host, port))
-    nat_socket.listen(5)
+    nat_socket.listen(socket.SOMAXCONN)
 
     print("going beeg")
 
@@ -46,14 +66,25 @@ def nat_server_with_bulk_downloads(host, port, beeg_file_path):
         client_socket, client_address = nat_socket.accept()
         print(f"Accepted connection from {client_address}")
 
-        thr = BEEGThread(client_socket, client_address, beeg_file_path)
+        thr = FramedThread(
+            client_socket,
+            client_address,
+            {BEEG: bulk_file.read_request},
+            BEEGThread(client_socket, client_address, bulk_file),
+        )
         thr.start()
 
 
-def nat_server_with_kv_store(host, port):
+def nat_server_with_kv_store(host, port, kv_store: KVStore = None):
     nat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     nat_socket.bind((host, port))
-    nat_socket.listen(5)
+    nat_socket.listen(socket.SOMAXCONN)
+
+    # one pooled client and one seeding write for the whole server, not per connection
+    kv_store = kv_store or KVStore(create_redis_client())
+    kv_store.redis_client.set(KV_TEST_KEY, KV_TEST_VALUE)
+
+    handlers = {KV: kv_request_handler(kv_store)}
 
     print("going kv")
 
@@ -61,7 +92,12 @@ def nat_server_with_kv_store(host, port):
         client_socket, client_address = nat_socket.accept()
         print(f"Accepted connection from {client_address}")
 
-        thr = KVThread(client_socket, client_address)
+        thr = FramedThread(
+            client_socket,
+            client_address,
+            handlers,
+            KVThread(client_socket, client_address, kv_store),
+        )
         thr.start()
 
 
@@ -93,7 +129,7 @@ if __name__ == "__main__":
 
     choice = int(
         input(
-            "input 0 for echo, 1 for NAT server, 2 for beeg file, 3 for kv: "
+            "input 0 for echo, 1 for NAT server, 2 for beeg file, 3 for kv, 4 for async NAT server: "
         ).strip()
     )
 
@@ -102,6 +138,7 @@ if __name__ == "__main__":
         echo_server(host, port)
     elif choice == 1:
         print("nat server...", end=" ")
+        NATPollingHandler(NAT_POLLING_ENDPOINT).start()
         nat_server(host, port)
     elif choice == 2:
         print("beeg server...", end=" ")
@@ -109,5 +146,9 @@ if __name__ == "__main__":
     elif choice == 3:
         print("kv server...", end=" ")
         nat_server_with_kv_store(host, port)
+    elif choice == 4:
+        print("async nat server...", end=" ")
+        NATPollingHandler(NAT_POLLING_ENDPOINT).start()
+        async_nat_server(host, port)
     else:
         print("incorrect choice!")
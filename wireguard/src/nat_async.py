@@ -0,0 +1,204 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from buffers import LENGTH_PREFIX, RequestSplitter
+from framing import (
+    FRAME_VERSION,
+    FETCH,
+    RESPONSE,
+    ERROR,
+    STREAM_OPEN,
+    STREAM_RESET,
+    WINDOW_UPDATE,
+    FrameParser,
+    ProtocolError,
+    pack_header,
+)
+from nat_cache import ResponseCache, response_cache
+from settings import (
+    NAT_HTTP_WORKERS,
+    NAT_HTTP_POOL_HOSTS,
+    NAT_HTTP_CONNECTIONS_PER_HOST,
+    NAT_MAX_PIPELINED_REQUESTS,
+)
+
+
+class PooledHTTPFetcher:
+    """
+    One keep-alive requests.Session shared by every tunneled client, so repeated
+    fetches reuse DNS results and TCP/TLS connections. At most
+    NAT_HTTP_CONNECTIONS_PER_HOST connections are opened to any one host; further
+    fetches wait for a free one. Responses are served from `cache` when fresh.
+    """
+
+    def __init__(
+        self,
+        workers=NAT_HTTP_WORKERS,
+        pool_hosts=NAT_HTTP_POOL_HOSTS,
+        connections_per_host=NAT_HTTP_CONNECTIONS_PER_HOST,
+        cache: ResponseCache = response_cache,
+    ):
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=connections_per_host,
+            pool_block=True,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def fetch_upstream(self, url):
+        response = self.session.get(url)
+        return response.text.encode(), response.headers, response.status_code
+
+    def get(self, url) -> bytes:
+        return self.cache.get(url, self.fetch_upstream)
+
+    async def fetch(self, url) -> bytes:
+        """
+        The body for url; a failed fetch raises, for the caller to answer as its
+        protocol can
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.get, url)
+
+
+class AsyncNATServer:
+    """
+    Serves every tunneled client from one event loop. Each connection may have up
+    to NAT_MAX_PIPELINED_REQUESTS requests in flight; they are fetched concurrently.
+    Text requests are answered in the order they were sent, framed ones (see
+    framing.py) as soon as each is ready. Multiplexed streams are refused with a
+    STREAM_RESET.
+
+    A failed request gets an ERROR frame with the reason, as FramedThread sends,
+    or an empty response in the text protocol, which has no way to say why; the
+    other requests on the connection carry on.
+    """
+
+    def __init__(self, fetcher: PooledHTTPFetcher = None):
+        self.fetcher = fetcher or PooledHTTPFetcher()
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        print(f"Accepted connection from {client_address}")
+        try:
+            data = await reader.read(64 * 1024)
+        except ConnectionError:
+            data = b""
+        if not data:
+            writer.close()
+        # framed connections open with FRAME_VERSION, a byte no text request starts with
+        elif data[0] == FRAME_VERSION:
+            await self.handle_framed(reader, writer, data)
+        else:
+            await self.handle_text(reader, writer, data)
+
+    async def handle_text(self, reader, writer, data):
+        in_flight = asyncio.Queue(maxsize=NAT_MAX_PIPELINED_REQUESTS)
+        responder = asyncio.create_task(self.respond(in_flight, writer))
+        splitter = RequestSplitter()
+        try:
+            while data:
+                for request in splitter.feed(data):
+                    url = request.decode(errors="replace").strip()
+                    await in_flight.put(asyncio.create_task(self.fetch_text(url)))
+                data = await reader.read(64 * 1024)
+        except ConnectionError:
+            pass
+        finally:
+            await in_flight.put(None)
+            await responder
+            writer.close()
+
+    async def respond(self, in_flight: asyncio.Queue, writer):
+        while (fetch := await in_flight.get()) is not None:
+            if writer.is_closing():
+                # drop the rest, but keep draining the queue so the reader never blocks
+                fetch.cancel()
+                continue
+            message = await fetch
+            try:
+                writer.write(LENGTH_PREFIX.pack(len(message)))
+                writer.write(message)
+                await writer.drain()
+            except ConnectionError:
+                # the reader sees the connection end and stops taking requests
+                writer.close()
+
+    async def fetch_text(self, url) -> bytes:
+        try:
+            return await self.fetcher.fetch(url)
+        except Exception as e:
+            # the text protocol has no way to say why
+            print(f"Request error for {url}: {e}")
+            return b""
+
+    async def handle_framed(self, reader, writer, data):
+        slots = asyncio.Semaphore(NAT_MAX_PIPELINED_REQUESTS)
+        fetches = set()
+        parser = FrameParser()
+        try:
+            while data:
+                parser.feed(data)
+                for frame_type, request_id, _, payload in parser.frames():
+                    if frame_type == FETCH:
+                        await slots.acquire()
+                        # the payload view is reused by the next feed
+                        fetch = asyncio.create_task(
+                            self.respond_frame(
+                                request_id, bytes(payload), writer, slots
+                            )
+                        )
+                        fetches.add(fetch)
+                        fetch.add_done_callback(fetches.discard)
+                    elif frame_type == STREAM_OPEN:
+                        self.write_frame(
+                            writer, STREAM_RESET, request_id, b"streams not served"
+                        )
+                    elif frame_type not in (WINDOW_UPDATE, STREAM_RESET):
+                        error = f"unknown type {frame_type}".encode()
+                        self.write_frame(writer, ERROR, request_id, error)
+                data = await reader.read(64 * 1024)
+        except (ConnectionError, ProtocolError) as e:
+            print(f"framed connection closed: {e}")
+        finally:
+            if fetches:
+                await asyncio.gather(*fetches)
+            parser.close()
+            writer.close()
+
+    def write_frame(self, writer, frame_type, request_id, payload):
+        writer.write(pack_header(frame_type, request_id, len(payload)))
+        writer.write(payload)
+
+    async def respond_frame(self, request_id, payload: bytes, writer, slots):
+        try:
+            try:
+                url = payload.decode().strip()
+                frame_type, message = RESPONSE, await self.fetcher.fetch(url)
+            except Exception as e:
+                frame_type, message = ERROR, str(e).encode()
+            if writer.is_closing():
+                return
+            self.write_frame(writer, frame_type, request_id, message)
+            await writer.drain()
+        except ConnectionError:
+            writer.close()
+        finally:
+            slots.release()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+
+def async_nat_server(host, port):
+    print("yes")
+    asyncio.run(AsyncNATServer().serve(host, port))
@@ -0,0 +1,177 @@
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from time import time
+
+from settings import NAT_CACHE_MAX_BYTES, NAT_CACHE_DEFAULT_TTL
+
+
+# statuses cached only when the response says for how long
+CACHEABLE_ERROR_STATUSES = (301, 404)
+
+
+def get_ttl(headers, default_ttl, status=200):
+    """
+    Seconds a response may be served from cache, going by Cache-Control and then
+    Expires. 2xx responses that say nothing get default_ttl; 301 and 404 are only
+    cached with explicit freshness, and anything else (a transient 5xx or 429)
+    not at all.
+    """
+    if not 200 <= status < 300:
+        if status not in CACHEABLE_ERROR_STATUSES:
+            return 0
+        default_ttl = 0
+    cache_control = headers.get("Cache-Control", "").lower()
+    directives = {}
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name] = value.strip('"')
+
+    if {"no-store", "no-cache", "private"} & directives.keys():
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return max(int(directives[name]), 0)
+            except ValueError:
+                return 0
+
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            # an invalid Expires means already expired
+            return 0
+        return max(expires - time(), 0)
+
+    return default_ttl
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, expires_at):
+        self.body = body
+        self.expires_at = expires_at
+
+
+class InFlightFetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    Shared, thread-safe cache of upstream responses keyed by URL. Bounded by the
+    total size of the cached bodies, evicting the least recently used first.
+    Concurrent misses for the same URL wait on a single upstream fetch.
+    """
+
+    def __init__(self, max_bytes=NAT_CACHE_MAX_BYTES, default_ttl=NAT_CACHE_DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, url, fetch):
+        """
+        Returns the body for url, calling fetch(url) -> (body, headers, status)
+        on a miss
+        """
+        with self.lock:
+            body = self.fresh_body(url)
+            if body is not None:
+                self.hits += 1
+                return body
+
+            waiting_for = self.in_flight.get(url)
+            if waiting_for is None:
+                self.misses += 1
+                leader = self.in_flight[url] = InFlightFetch()
+            else:
+                self.coalesced += 1
+
+        if waiting_for is not None:
+            waiting_for.done.wait()
+            if waiting_for.error is not None:
+                raise waiting_for.error
+            return waiting_for.body
+
+        try:
+            body, headers, status = fetch(url)
+            leader.body = body
+            self.put(url, body, get_ttl(headers, self.default_ttl, status))
+            return body
+        except Exception as e:
+            leader.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+            leader.done.set()
+
+    def lookup(self, url):
+        """
+        Returns the cached body for url, or None without fetching anything
+        """
+        with self.lock:
+            body = self.fresh_body(url)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return body
+
+    def fresh_body(self, url):
+        # caller holds the lock
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if entry.expires_at <= time():
+            self.remove(url)
+            return None
+        self.entries.move_to_end(url)
+        return entry.body
+
+    def put(self, url, body: bytes, ttl):
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if url in self.entries:
+                self.remove(url)
+            self.entries[url] = CacheEntry(body, time() + ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.evictions += 1
+
+    def remove(self, url):
+        # caller holds the lock
+        entry = self.entries.pop(url)
+        self.size -= len(entry.body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+response_cache = ResponseCache()
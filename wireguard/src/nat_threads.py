@@ -1,11 +1,45 @@
 import threading
-from struct import pack
 import socket
 import requests
 import os
+import mmap
+import json
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 import redis
 
+from buffers import AdaptiveBuffer, RequestSplitter, LENGTH_PREFIX, send_frame
+from framing import (
+    FRAME_VERSION,
+    BEEG_REQUEST,
+    RESPONSE,
+    ERROR,
+    STREAM_OPEN,
+    WINDOW_UPDATE,
+    STREAM_RESET,
+    WINDOW_INCREMENT,
+    FrameParser,
+    ProtocolError,
+    write_frame,
+)
+from kv_store import KVStore, parse_kv_request
+from mux import StreamScheduler
+from nat_cache import response_cache
+from sessions import (
+    HELLO,
+    DATA_HEADER,
+    AckReader,
+    parse_session_request,
+    session_table,
+)
+from settings import (
+    BEEG_CHUNK_SIZE,
+    BEEG_MAX_CHUNK_SIZE,
+    SESSION_CHUNK_SIZE,
+    SESSION_WINDOW,
+    NAT_FRAMED_WORKERS,
+)
+
 
 def get_public_ip():
     try:
@@ -32,12 +66,33 @@ class EchoThread(threading.Thread):
         self.client_address = client_address
 
     def run(self):
-        while data := self.client_socket.recv(1024):
-            self.client_socket.send(data)
+        buffer = AdaptiveBuffer()
+        while data := buffer.recv_into(self.client_socket):
+            self.client_socket.sendall(data)
+        buffer.close()
 
         print(f"Connection from {self.client_address} closed.")
 
 
+def fetch_url(url):
+    response = requests.get(url)
+    return response.text.encode(), response.headers, response.status_code
+
+
+def fetch_request(payload):
+    return response_cache.get(bytes(payload).decode(), fetch_url)
+
+
+def kv_request_handler(kv_store: KVStore):
+    def handle(payload):
+        request = parse_kv_request(bytes(payload))
+        if request is None:
+            raise ValueError("malformed kv request")
+        return kv_store.execute([request])[0]
+
+    return handle
+
+
 class NATThread(threading.Thread):
     def __init__(self, client_socket: socket.socket, client_address: str):
         threading.Thread.__init__(self)
@@ -45,76 +100,348 @@ class NATThread(threading.Thread):
         self.client_address = client_address
 
     def run(self):
+        buffer = AdaptiveBuffer()
         with self.client_socket:
-            while data := self.client_socket.recv(1024):
-                url = data.decode()
-                response = requests.get(url)
-                message = response.text.encode()
-                length = pack(">Q", len(message))
+            while data := buffer.recv_into(self.client_socket):
+                url = str(data, "utf-8")
+                send_frame(self.client_socket, response_cache.get(url, fetch_url))
+        buffer.close()
+
+
+class BulkFile:
+    """
+    The bulk download file, mapped once and shared by every BEEGThread. Ranges are
+    sent with os.sendfile, or as memoryview slices of the mapping where sendfile is
+    not available, so nothing is copied into Python.
+
+    An empty file, which cannot be mapped, is served as such: every request is
+    answered with no bytes.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.size = os.path.getsize(path)
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        else:
+            self.map = None
+            self.view = memoryview(b"")
+
+    def position(self, offset):
+        """
+        Where offset falls in the file, which requests wrap around
+        """
+        return offset % self.size if self.size else 0
 
-                self.client_socket.sendall(length)
-                self.client_socket.sendall(message)
+    def send_range(self, sock: socket.socket, offset, count):
+        """
+        Sends one length-prefixed response holding [offset, offset + count), cut
+        short at the end of the file
+        """
+        count = max(0, min(count, self.size - offset))
+        sock.sendall(LENGTH_PREFIX.pack(count))
+        self.send_bytes(sock, offset, count)
+
+    def read_request(self, payload):
+        """
+        Answers a framed BEEG request with a slice of the mapping
+        """
+        offset, count = BEEG_REQUEST.unpack(payload)
+        offset = self.position(offset)
+        count = min(count, BEEG_MAX_CHUNK_SIZE, self.size - offset)
+        return self.view[offset : offset + count]
+
+    def send_bytes(self, sock: socket.socket, offset, count):
+        if hasattr(os, "sendfile"):
+            end = offset + count
+            while offset < end:
+                offset += os.sendfile(sock.fileno(), self.file.fileno(), offset, end - offset)
+        else:
+            sock.sendall(self.view[offset : offset + count])
+
+
+SESSION_PREFIX = b"SESSION "
+# longer than any session request line
+MAX_SESSION_REQUEST = 1024
 
 
 class BEEGThread(threading.Thread):
+    """
+    Serves "BEEGMode <offset> [<chunk_size>]" requests from the shared BulkFile.
+    Newline-terminated requests may be pipelined; they are answered in order.
+    A connection that opens with "SESSION ..." gets a resumable session stream
+    instead (see sessions.py).
+    """
+
     def __init__(
-        self, client_socket: socket.socket, client_address: str, beeg_file_path
+        self, client_socket: socket.socket, client_address: str, bulk_file: BulkFile
     ):
         threading.Thread.__init__(self)
         self.client_socket = client_socket
         self.client_address = client_address
-        self.beeg_file_path = beeg_file_path
+        self.bulk_file = bulk_file
+
+    def parse_request(self, request: bytes):
+        """
+        Returns (offset, chunk_size), or None for a malformed request. A chunk
+        size below 1 gets chunk_size 0, which is answered with an empty frame.
+        """
+        client_request = request.decode().split()
+        if len(client_request) < 2:
+            print("wierd request, skipping...")
+            return None
+        try:
+            offset = self.bulk_file.position(int(client_request[1]))
+            chunk_size = BEEG_CHUNK_SIZE
+            if len(client_request) > 2:
+                chunk_size = min(int(client_request[2]), BEEG_MAX_CHUNK_SIZE)
+        except ValueError:
+            print("client request was jibberish")
+            return None
+        if chunk_size < 1:
+            print(f"bad chunk size {chunk_size}, sending an empty frame")
+            return offset, 0
+        return offset, chunk_size
+
+    def serve_session(self, request: bytes, rest: bytes):
+        parsed = parse_session_request(request)
+        if parsed is None:
+            print("wierd session request, closing...")
+            return
+        session = session_table.open(*parsed)
+        sent = session.acked
+        self.client_socket.sendall(HELLO.pack(session.id, sent))
+
+        acks = AckReader()
+        acked = acks.feed(rest)
+        while True:
+            if acked >= 0:
+                session_table.ack(session, acked)
+            # an empty file has nothing to stream, so only wait for the client
+            window_full = (
+                sent - session.acked >= SESSION_WINDOW or not self.bulk_file.size
+            )
+            try:
+                # only wait for an ACK once the window is used up
+                data = self.client_socket.recv(4096, 0 if window_full else socket.MSG_DONTWAIT)
+                if not data:
+                    return
+                acked = acks.feed(data)
+                continue
+            except BlockingIOError:
+                acked = -1
+            position = self.bulk_file.position(sent)
+            count = min(SESSION_CHUNK_SIZE, self.bulk_file.size - position)
+            self.client_socket.sendall(DATA_HEADER.pack(sent, count))
+            self.bulk_file.send_bytes(self.client_socket, position, count)
+            sent += count
+
+    def read_opening(self, buffer: AdaptiveBuffer) -> bytes:
+        """
+        The connection's first bytes, read until they tell a session from BEEG
+        requests and, for a session, hold its whole request line, however the
+        client's writes were split
+        """
+        data = bytes(buffer.recv_into(self.client_socket))
+        while data and (
+            SESSION_PREFIX.startswith(data)
+            or data.startswith(SESSION_PREFIX)
+            and b"\n" not in data
+            and len(data) < MAX_SESSION_REQUEST
+        ):
+            more = self.client_socket.recv(MAX_SESSION_REQUEST)
+            if not more:
+                break
+            data += more
+        return data
 
     def run(self):
-        beeg_file_size = os.path.getsize(self.beeg_file_path)
-        chunk_size = int(0.5 * (10**6))  # request sizes
+        buffer = AdaptiveBuffer()
+        splitter = RequestSplitter()
         with self.client_socket:
-            while data := self.client_socket.recv(1024):
-                client_request = data.decode().split()
-                if len(client_request) < 2:
-                    print("wierd request, skipping...")
-                    break
+            data = self.read_opening(buffer)
+            if data.startswith(SESSION_PREFIX):
+                request, _, rest = data.partition(b"\n")
+                buffer.close()
                 try:
-                    client_loc = int(client_request[1]) % beeg_file_size
-                except ValueError:
-                    print("client request was jibberish")
+                    self.serve_session(request, rest)
+                except OSError:
+                    # the client moved on; it resumes from its own offset
+                    pass
+                return
+            while data:
+                requests_in_read = [self.parse_request(r) for r in splitter.feed(data)]
+                for parsed in requests_in_read:
+                    if parsed is None:
+                        break
+                    self.bulk_file.send_range(self.client_socket, *parsed)
+                if None in requests_in_read:
                     break
+                data = buffer.recv_into(self.client_socket)
+        buffer.close()
 
-                with open(self.beeg_file_path, "rb") as f:
-                    f.seek(client_loc)
-                    data = f.read(chunk_size)
 
-                length = pack(">Q", len(data))
+class KVThread(threading.Thread):
+    """
+    Answers "GET <key>" and "MGET <key> ..." requests from the shared KVStore.
+    All requests that arrive in one read go to Redis in one pipelined round trip
+    and are answered in order.
+    """
 
-                self.client_socket.sendall(length)
-                self.client_socket.sendall(data)
+    def __init__(self, client_socket: socket.socket, client_address: str, kv_store: KVStore):
+        threading.Thread.__init__(self)
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.kv_store = kv_store
 
+    def run(self):
+        buffer = AdaptiveBuffer()
+        splitter = RequestSplitter()
+        try:
+            with self.client_socket:
+                while data := buffer.recv_into(self.client_socket):
+                    parsed = [parse_kv_request(r) for r in splitter.feed(data)]
+                    valid = [request for request in parsed if request is not None]
+                    responses = iter(self.kv_store.execute(valid) if valid else [])
+                    for request in parsed:
+                        # malformed requests still get a (empty) frame to keep the order
+                        payload = b"" if request is None else next(responses)
+                        send_frame(self.client_socket, payload)
+        except (OSError, redis.RedisError) as e:
+            print(f"KV connection from {self.client_address} closed: {e}")
+        finally:
+            buffer.close()
 
-class KVThread(threading.Thread):
-    def __init__(self, client_socket: socket.socket, client_address: str):
+
+framed_executor = ThreadPoolExecutor(max_workers=NAT_FRAMED_WORKERS)
+
+
+def is_framed(sock: socket.socket):
+    """
+    Framed connections open with FRAME_VERSION, a byte no text request starts with
+    """
+    return sock.recv(1, socket.MSG_PEEK) == bytes([FRAME_VERSION])
+
+
+class FramedThread(threading.Thread):
+    """
+    Serves a framed connection (see framing.py) with `handlers`, a dict of frame
+    type -> function(payload) -> response. Requests run on the shared executor and
+    each response goes out as soon as it is ready, tagged with its request id, so a
+    slow request does not hold up the ones behind it. Requests opened as streams
+    (see mux.py) are answered through a StreamScheduler instead, in chunks. A
+    connection that does not open with a frame is served by `fallback`, the old
+    text protocol thread.
+    """
+
+    def __init__(
+        self,
+        client_socket: socket.socket,
+        client_address: str,
+        handlers: dict,
+        fallback: threading.Thread = None,
+    ):
         threading.Thread.__init__(self)
         self.client_socket = client_socket
         self.client_address = client_address
+        self.handlers = handlers
+        self.fallback = fallback
+        self.send_lock = threading.Lock()
+        self.scheduler = None
+
+    def send(self, frame_type, request_id, payload):
+        try:
+            with self.send_lock:
+                write_frame(self.client_socket, frame_type, request_id, payload)
+        except OSError:
+            # the connection is gone; run() notices and closes it
+            pass
+
+    def respond(self, handler, request_id, payload):
+        try:
+            response = handler(payload)
+        except Exception as e:
+            self.send(ERROR, request_id, str(e).encode())
+            return
+        self.send(RESPONSE, request_id, response)
+
+    def respond_stream(self, handler, stream_id, payload):
+        try:
+            response = handler(payload)
+        except Exception as e:
+            self.scheduler.reset(stream_id)
+            self.send(STREAM_RESET, stream_id, str(e).encode())
+            return
+        self.scheduler.add(stream_id, response)
+
+    def open_stream(self, stream_id, payload):
+        if self.scheduler is None:
+            self.scheduler = StreamScheduler(self.client_socket, self.send_lock)
+            self.scheduler.start()
+        handler = self.handlers.get(payload[0]) if payload else None
+        if handler is None:
+            self.send(STREAM_RESET, stream_id, b"unknown request type")
+            return
+        self.scheduler.open(stream_id)
+        framed_executor.submit(self.respond_stream, handler, stream_id, bytes(payload[1:]))
+
+    def handle(self, frame_type, request_id, payload):
+        if frame_type == STREAM_OPEN:
+            self.open_stream(request_id, payload)
+        elif frame_type == WINDOW_UPDATE and self.scheduler is not None:
+            self.scheduler.grant(request_id, WINDOW_INCREMENT.unpack(payload)[0])
+        elif frame_type == STREAM_RESET and self.scheduler is not None:
+            self.scheduler.reset(request_id)
+        elif (handler := self.handlers.get(frame_type)) is None:
+            self.send(ERROR, request_id, f"unknown type {frame_type}".encode())
+        else:
+            # the view is reused by the next read, the request is not done by then
+            framed_executor.submit(self.respond, handler, request_id, bytes(payload))
 
     def run(self):
-        key = "testing_key"
-        redis_client = redis.StrictRedis(
-            host="3.80.71.88",
-            port=6379,
-            password="foobared",
-            decode_responses=True,
-        )
-        redis_client.set(
-            key,
-            "0833a59570177bc10f98bcfcd24e2c977c33262125319d44ff88fa42cb83534eabfc9ea63e8d7f324d3331af204ff00410cc5d77a3a494c64b2e59290960c2ddeab78525d8a3af9204d8fde813affbaf",
-        )
-        with self.client_socket:
-            while data := self.client_socket.recv(1024):
-                # ? unused variable, and data from socket is just ignored?
-                client_request = data.decode()
-                data = redis_client.get(key).encode()
+        if self.fallback is not None and not is_framed(self.client_socket):
+            self.fallback.run()
+            return
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        parser = FrameParser()
+        try:
+            with self.client_socket:
+                while parser.recv_into(self.client_socket):
+                    for frame_type, request_id, _, payload in parser.frames():
+                        self.handle(frame_type, request_id, payload)
+        except (OSError, ProtocolError) as e:
+            print(f"framed connection from {self.client_address} closed: {e}")
+        finally:
+            parser.close()
+            if self.scheduler is not None:
+                self.scheduler.close()
+
+
+class NATPollingHandler(threading.Thread):
+    """
+    Answers polls on the NAT with the response cache counters
+    """
+
+    def __init__(self, listen_endpoint: tuple):
+        threading.Thread.__init__(self)
+        self.listen_endpoint = listen_endpoint
+
+    def run(self):
+        try:
+            dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            dock_socket.bind((self.listen_endpoint[0], self.listen_endpoint[1]))
+            dock_socket.listen(5)
+
+            while True:
+                poller_socket, poller_address = dock_socket.accept()
+                poller_socket.recv(1024)
 
-                length = pack(">Q", len(data))
+                report = {"cache": response_cache.stats()}
+                poller_socket.sendall(json.dumps(report).encode())
+                poller_socket.close()
 
-                self.client_socket.sendall(length)
-                self.client_socket.sendall(data)
+        finally:
+            dock_socket.close()
+            new_server = NATPollingHandler(self.listen_endpoint)
+            new_server.start()
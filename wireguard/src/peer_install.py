@@ -0,0 +1,139 @@
+import ipaddress
+import subprocess
+from time import time
+
+from settings import WIREGUARD_INTERFACE_NAME, WIREGUARD_CONFIG_LOCATION
+from wgconfig import Peer, WireGuardConfig, split_allowed_ips
+
+
+def live_peers(interface=WIREGUARD_INTERFACE_NAME) -> dict:
+    """
+    Public key -> allowed IPs of the peers the interface has right now
+    """
+    output = subprocess.run(
+        ["wg", "show", interface, "allowed-ips"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return parse_allowed_ips(output)
+
+
+def parse_allowed_ips(output: str) -> dict:
+    """
+    The output of `wg show <interface> allowed-ips` as public key -> allowed IPs
+    """
+    peers = {}
+    for line in output.splitlines():
+        public_key, _, allowed_ips = line.partition("\t")
+        if allowed_ips == "(none)":
+            allowed_ips = ""
+        peers[public_key] = ", ".join(allowed_ips.split())
+    return peers
+
+
+def networks(allowed_ips: list) -> set:
+    """
+    Allowed IPs as networks, so "10.27.0.25" from a config and "10.27.0.25/32"
+    from `wg show` compare equal
+    """
+    return {ipaddress.ip_network(ip, strict=False) for ip in allowed_ips}
+
+
+def peer_delta(wanted: WireGuardConfig, live: dict) -> list:
+    """
+    The peers in wanted that the interface is missing or has other allowed IPs for
+    """
+    return [
+        peer
+        for public_key, peer in wanted.peers.items()
+        if public_key not in live
+        or networks(split_allowed_ips(live[public_key])) != networks(peer.allowed_ips)
+    ]
+
+
+def set_allowed_ips_command(peers: list, interface=WIREGUARD_INTERFACE_NAME) -> list:
+    """
+    One `wg set` replacing the allowed IPs of every peer, which `wg addconf`
+    would only add to
+    """
+    command = ["wg", "set", interface]
+    for peer in peers:
+        command += ["peer", peer.public_key, "allowed-ips", ",".join(peer.allowed_ips)]
+    return command
+
+
+def route_commands(peers: list, interface=WIREGUARD_INTERFACE_NAME) -> str:
+    return "".join(
+        f"route replace {allowed_ip} dev {interface}\n"
+        for peer in peers
+        for allowed_ip in peer.allowed_ips
+    )
+
+
+def install_peers(
+    config_text: str,
+    interface=WIREGUARD_INTERFACE_NAME,
+    config_location=WIREGUARD_CONFIG_LOCATION,
+):
+    """
+    Adds the peers of a migrated config to the interface with one `wg addconf`,
+    their routes with one `ip -batch`, and their sections to the config file with
+    one write. Peers the interface already has get their allowed IPs replaced with
+    one `wg set` when they differ, and are skipped otherwise.
+    """
+    timings = {}
+    start_time = time()
+    wanted = WireGuardConfig.parse(config_text)
+    timings["parse"] = time() - start_time
+
+    step_time = time()
+    live = live_peers(interface)
+    changed_peers = peer_delta(wanted, live)
+    timings["delta"] = time() - step_time
+    if not changed_peers:
+        return changed_peers, timings
+    new_peers = [peer for peer in changed_peers if peer.public_key not in live]
+    updated_peers = [peer for peer in changed_peers if peer.public_key in live]
+
+    if new_peers:
+        # the same key and allowed IPs `wg set` was given per peer before
+        sections = "".join(
+            Peer(
+                {"PublicKey": peer.public_key, "AllowedIPs": ", ".join(peer.allowed_ips)}
+            ).render()
+            for peer in new_peers
+        )
+        step_time = time()
+        subprocess.run(
+            ["wg", "addconf", interface, "/dev/stdin"],
+            input=sections,
+            text=True,
+            check=True,
+        )
+        timings["wg addconf"] = time() - step_time
+    if updated_peers:
+        step_time = time()
+        subprocess.run(set_allowed_ips_command(updated_peers, interface), check=True)
+        timings["wg set"] = time() - step_time
+
+    step_time = time()
+    # -force keeps going past a bad line instead of dropping the remaining routes
+    routes = subprocess.run(
+        ["ip", "-4", "-force", "-batch", "-"],
+        input=route_commands(changed_peers, interface),
+        text=True,
+        capture_output=True,
+    )
+    if routes.returncode != 0:
+        print(f"ERROR: some routes were not added: {routes.stderr.strip()}")
+    timings["ip -batch"] = time() - step_time
+
+    step_time = time()
+    config = WireGuardConfig.load(config_location)
+    for peer in changed_peers:
+        config.add_peer(peer)
+    config.save(config_location)
+    timings["config write"] = time() - step_time
+    timings["total"] = time() - start_time
+    return changed_peers, timings
@@ -1,11 +1,23 @@
 from server_threads import (
     MigrationHandler,
     ForwardingServerThread,
+    SelectorForwardingServerThread,
     PollingHandler,
 )
-from settings import MIGRATION_PORT, WIREGUARD_CONFIG_LOCATION, WIREGUARD_PORT
+from metrics import MetricsSampler
+from telemetry import TelemetryPusher
+from registry import connection_registry
+from migration import MigrationNotifier
+from relay_stats import RelayThroughputThread, relay_counters
+from workers import ForwardingWorkerPool
+from wgconfig import WireGuardConfig
+from settings import (
+    WIREGUARD_CONFIG_LOCATION,
+    FORWARDING_MODE,
+    FORWARDING_WORKERS,
+    RELAY_MODE,
+)
 import requests
-from time import time
 import socket
 
 
@@ -46,36 +58,25 @@ class Proxy:
         self.broker_endpoint = broker_endpoint
         self.migration_endpoint = migration_endpoint
         self.polling_endpoint = polling_endpoint
+        self.notifier = MigrationNotifier()
+        # a ForwardingWorkerPool once run() starts worker processes
+        self.connections = connection_registry
 
     def migrate(self, new_proxy_ip):
-        start_time = time()
-        # migrate address
-        global client_addresses, client_sockets, nat_sockets
-        with open(WIREGUARD_CONFIG_LOCATION, "rb") as f:
-            data = f.read()
-        new_proxy_address = new_proxy_ip
-        new_proxy_socket = MIGRATION_PORT
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((new_proxy_address, new_proxy_socket))
-        s.sendall(data)
-
-        print(f"sending migration notice to {len(client_addresses)} clients")
-
-        for i in range(len(client_addresses)):
-            address = client_addresses[i]
-            cli_sock = client_sockets[i]
-            dest_sock = nat_sockets[i]
-            cli_sock.send("bye!".encode())
-            cli_sock.close()
-            dest_sock.close()
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((address[0], MIGRATION_PORT))
-            s.sendall(f"{new_proxy_address}:{WIREGUARD_PORT}".encode())
-            s.close()
-        print("sent to all successfully! GGs.")
-
-        nat_sockets = []
-        migration_time = time() - start_time
+        # only the peers: the new proxy has its own [Interface] and private key
+        data = WireGuardConfig.load(WIREGUARD_CONFIG_LOCATION).render_peers().encode()
+
+        clients = self.connections.take_all()
+
+        print(f"sending migration notice to {len(clients)} clients")
+        migration_time, histogram, failed, lost = self.notifier.migrate(
+            new_proxy_ip, data, clients
+        )
+        print(
+            f"{self.notifier.mode}: moved {len(clients) - len(failed)}/{len(clients)} "
+            f"clients in {migration_time:.3f}s, {lost} bytes dropped: {histogram.summary()}"
+        )
+        print(histogram.render())
         # url = f"http://{CONTROLLER_IP_ADDRESS}:8000/assignments/postavgproxy"
 
         data = {"avg": migration_time}
@@ -85,17 +86,41 @@ class Proxy:
         # if response.status_code == 200:
         #     print(f'sent data successfully. val was: {migration_time}. Done here')
 
-    def run(self):
+    def run(
+        self,
+        forwarding_mode=FORWARDING_MODE,
+        relay_mode=RELAY_MODE,
+        workers=FORWARDING_WORKERS,
+    ):
         ip = get_public_ip()
         print(f"my endpoint is: {ip}:51820")
 
-        forwarding_server = ForwardingServerThread(
-            self.wireguard_endpoint, self.nat_endpoint
-        )
+        counters = relay_counters
+        if workers > 1:
+            forwarding_server = ForwardingWorkerPool(
+                self.wireguard_endpoint,
+                self.nat_endpoint,
+                workers,
+                forwarding_mode,
+                relay_mode,
+            )
+            self.connections = counters = forwarding_server
+        elif forwarding_mode == "selector":
+            forwarding_server = SelectorForwardingServerThread(
+                self.wireguard_endpoint, self.nat_endpoint
+            )
+        else:
+            forwarding_server = ForwardingServerThread(
+                self.wireguard_endpoint, self.nat_endpoint, relay_mode
+            )
         migration_handler = MigrationHandler(self.migration_endpoint)
-        polling_handler = PollingHandler(self.polling_endpoint)
+        sampler = MetricsSampler(self.connections)
+        sampler.start()
+        TelemetryPusher(sampler).start()
+        polling_handler = PollingHandler(self.polling_endpoint, sampler)
         polling_handler.start()
         migration_handler.start()
+        RelayThroughputThread(counters=counters).start()
         forwarding_server.start()
 
         dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -0,0 +1,84 @@
+import threading
+
+from settings import REGISTRY_SHARDS
+
+
+class Connection:
+    """
+    One client <-> NAT socket pair the forwarder is relaying
+    """
+
+    __slots__ = ("address", "client_socket", "nat_socket")
+
+    def __init__(self, address, client_socket, nat_socket):
+        self.address = address
+        self.client_socket = client_socket
+        self.nat_socket = nat_socket
+
+    def as_tuple(self):
+        return self.address, self.client_socket, self.nat_socket
+
+
+class ConnectionRegistry:
+    """
+    Live connections by client address (ip, port), spread over `shards` dicts with
+    a lock each, so accepts, closes and polls on different threads rarely wait for
+    one another. The relays remove a connection when they close it.
+    """
+
+    def __init__(self, shards=REGISTRY_SHARDS):
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.shards = [{} for _ in range(shards)]
+
+    def shard(self, address):
+        index = hash(address) % len(self.shards)
+        return self.locks[index], self.shards[index]
+
+    def add(self, address, client_socket, nat_socket) -> Connection:
+        connection = Connection(address, client_socket, nat_socket)
+        lock, connections = self.shard(address)
+        with lock:
+            connections[address] = connection
+        return connection
+
+    def remove(self, connection: Connection):
+        """
+        Removes connection, unless its address was already taken by a newer one
+        """
+        lock, connections = self.shard(connection.address)
+        with lock:
+            if connections.get(connection.address) is connection:
+                del connections[connection.address]
+
+    def get(self, address):
+        lock, connections = self.shard(address)
+        with lock:
+            return connections.get(address)
+
+    def __len__(self):
+        return sum(len(connections) for connections in self.shards)
+
+    def connections(self):
+        result = []
+        for lock, connections in zip(self.locks, self.shards):
+            with lock:
+                result.extend(connections.values())
+        return result
+
+    def addresses(self):
+        return [connection.address for connection in self.connections()]
+
+    def take_all(self):
+        """
+        Empties the registry and returns what was in it, as (address,
+        client_socket, nat_socket) tuples, for a migration
+        """
+        result = []
+        for lock, connections in zip(self.locks, self.shards):
+            with lock:
+                result.extend(connection.as_tuple() for connection in connections.values())
+                connections.clear()
+        return result
+
+
+connection_registry = ConnectionRegistry()
@@ -0,0 +1,93 @@
+import fcntl
+import socket
+import struct
+import termios
+import threading
+from time import sleep, time
+
+from settings import RELAY_THROUGHPUT_LOG_PATH
+
+
+class RelayCounters:
+    """
+    Bytes the forwarder delivered, and bytes it threw away unread when it closed a
+    connection (as happens to in-flight data when a migration says goodbye)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.relayed = 0
+        self.dropped = 0
+
+    def add_relayed(self, n):
+        with self.lock:
+            self.relayed += n
+
+    def add_dropped(self, n):
+        with self.lock:
+            self.dropped += n
+
+    def snapshot(self):
+        with self.lock:
+            return self.relayed, self.dropped
+
+
+relay_counters = RelayCounters()
+
+
+def unread_bytes(sock: socket.socket):
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock, termios.FIONREAD, b"\0\0\0\0"))[0]
+    except OSError:
+        return 0
+
+
+def close_sockets(*sockets):
+    """
+    Shuts the sockets down before closing them, so a relay thread blocked in recv
+    on one of them wakes up and exits
+    """
+    for sock in sockets:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+
+def close_counting_loss(*sockets):
+    """
+    Closes the sockets, adding whatever was received but not yet relayed to the
+    dropped counter. Returns the number of bytes lost.
+    """
+    lost = 0
+    for sock in sockets:
+        if sock.fileno() != -1:
+            lost += unread_bytes(sock)
+            close_sockets(sock)
+    relay_counters.add_dropped(lost)
+    return lost
+
+
+class RelayThroughputThread(threading.Thread):
+    """
+    Writes "<unix time> <bytes relayed> <bytes dropped>" for every second to a
+    file, like TrafficMeasurementPythonThread does for wg0 on the client
+    """
+
+    def __init__(self, path=RELAY_THROUGHPUT_LOG_PATH, counters=relay_counters):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.counters = counters
+
+    def run(self):
+        with open(self.path, "w"):
+            pass
+
+        old_relayed, old_dropped = self.counters.snapshot()
+        while True:
+            sleep(1)
+            relayed, dropped = self.counters.snapshot()
+            with open(self.path, "a") as file:
+                file.write(f"{time():.0f} {relayed - old_relayed} {dropped - old_dropped}\n")
+            old_relayed, old_dropped = relayed, dropped
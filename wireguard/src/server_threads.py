@@ -1,14 +1,19 @@
+import os
 import threading
 import socket
+import selectors
 import subprocess
-from settings import WIREGUARD_CONFIG_LOCATION
-import psutil
-from time import sleep
-import json
-
-client_addresses = []
-client_sockets = []
-nat_sockets = []
+from settings import (
+    RELAY_MAX_PENDING_BYTES,
+    RELAY_MODE,
+    SPLICE_CHUNK_SIZE,
+)
+from functools import partial
+from buffers import AdaptiveBuffer, send_frame
+from peer_install import install_peers
+from metrics import MetricsSampler
+from registry import ConnectionRegistry, connection_registry
+from relay_stats import relay_counters, close_sockets
 
 
 class ForwardThread(threading.Thread):
@@ -17,49 +22,118 @@ class ForwardThread(threading.Thread):
         source_socket: socket.socket,
         destination_socket: socket.socket,
         description: str,
+        on_close=None,
     ):
         threading.Thread.__init__(self)
         self.source_socket = source_socket
         self.destination_socket = destination_socket
         self.description = description
+        self.on_close = on_close
 
     def run(self):
-        with self.source_socket, self.destination_socket:
-            while data := self.source_socket.recv(1024):
+        buffer = AdaptiveBuffer()
+        try:
+            while data := buffer.recv_into(self.source_socket):
                 self.destination_socket.sendall(data)
+                relay_counters.add_relayed(len(data))
+        except OSError:
+            # the other direction closed both sockets
+            pass
+        finally:
+            buffer.close()
+            self.close_pair()
+
+    def close_pair(self):
+        # close alone does not wake the other direction out of its recv, shutdown does
+        close_sockets(self.source_socket, self.destination_socket)
+        if self.on_close:
+            self.on_close()
+
+
+class SpliceForwardThread(ForwardThread):
+    """
+    Moves bytes socket -> pipe -> socket with os.splice, so they never enter Python.
+    Falls back to ForwardThread's loop where splice is unavailable.
+    """
+
+    def run(self):
+        if not hasattr(os, "splice"):
+            super().run()
+            return
+
+        pipe_read, pipe_write = os.pipe()
+        source_fd = self.source_socket.fileno()
+        destination_fd = self.destination_socket.fileno()
+        try:
+            while n := os.splice(source_fd, pipe_write, SPLICE_CHUNK_SIZE):
+                relay_counters.add_relayed(n)
+                while n > 0:
+                    n -= os.splice(pipe_read, destination_fd, n)
+        except OSError:
+            # the other direction closed both sockets
+            pass
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+            self.close_pair()
+
+
+RELAY_THREADS = {
+    "recv_into": ForwardThread,
+    "splice": SpliceForwardThread,
+}
+
+
+def listen_socket(listen_endpoint: tuple, reuse_port=False):
+    """
+    With reuse_port, several forwarding processes can bind the same endpoint and
+    the kernel spreads incoming connections over them (see workers.py)
+    """
+    dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    dock_socket.bind((listen_endpoint[0], listen_endpoint[1]))
+    return dock_socket
 
 
 class ForwardingServerThread(threading.Thread):
-    def __init__(self, listen_endpoint: tuple, forward_endpoint: tuple):
+    def __init__(
+        self,
+        listen_endpoint: tuple,
+        forward_endpoint: tuple,
+        relay_mode=RELAY_MODE,
+        registry: ConnectionRegistry = connection_registry,
+        reuse_port=False,
+    ):
         threading.Thread.__init__(self)
 
         self.listen_endpoint = listen_endpoint
         self.forward_endpoint = forward_endpoint
+        self.relay_thread = RELAY_THREADS[relay_mode]
+        self.registry = registry
+        self.reuse_port = reuse_port
 
     def run(self):
-        global client_addresses, client_sockets, nat_sockets
         try:
-            dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            dock_socket.bind((self.listen_endpoint[0], self.listen_endpoint[1]))
-            dock_socket.listen(5)
+            dock_socket = listen_socket(self.listen_endpoint, self.reuse_port)
+            # a whole proxy's worth of clients reconnects at once after a migration
+            dock_socket.listen(socket.SOMAXCONN)
             while True:
                 client_socket, client_address = dock_socket.accept()
-                if client_address not in client_addresses:
-                    client_addresses.append(client_address)
-                    client_sockets.append(client_socket)
-
-                if len(client_addresses) % 10 == 0:
-                    print(len(client_addresses))
                 nat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 nat_socket.connect(
                     (self.forward_endpoint[0], self.forward_endpoint[1])
                 )
-                nat_sockets.append(nat_socket)
-                way1 = ForwardThread(
-                    client_socket, nat_socket, "client -> server"
+                connection = self.registry.add(client_address, client_socket, nat_socket)
+                if len(self.registry) % 10 == 0:
+                    print(len(self.registry))
+                # whichever direction stops first closes both sockets
+                forget = partial(self.registry.remove, connection)
+                way1 = self.relay_thread(
+                    client_socket, nat_socket, "client -> server", forget
                 )
-                way2 = ForwardThread(
-                    nat_socket, client_socket, "server -> client"
+                way2 = self.relay_thread(
+                    nat_socket, client_socket, "server -> client", forget
                 )
                 way1.start()
                 way2.start()
@@ -68,6 +142,163 @@ class ForwardingServerThread(threading.Thread):
             print(str(e))
 
 
+class RelaySide:
+    """
+    One socket of a client <-> NAT pair, plus the bytes waiting to be written to it
+    """
+
+    def __init__(self, sock: socket.socket, connected=True):
+        self.sock = sock
+        self.connection = None
+        self.peer = None
+        self.pending = bytearray()
+        self.connected = connected
+        self.eof = False
+        self.events = 0
+
+
+class SelectorForwardingServerThread(threading.Thread):
+    """
+    Relays every client <-> NAT socket pair from a single selector loop, instead of
+    a ForwardThread per direction. Reading from a side pauses while its peer has
+    more than RELAY_MAX_PENDING_BYTES queued.
+    """
+
+    def __init__(
+        self,
+        listen_endpoint: tuple,
+        forward_endpoint: tuple,
+        registry: ConnectionRegistry = connection_registry,
+        reuse_port=False,
+    ):
+        threading.Thread.__init__(self)
+
+        self.listen_endpoint = listen_endpoint
+        self.forward_endpoint = forward_endpoint
+        self.registry = registry
+        self.reuse_port = reuse_port
+        self.selector = selectors.DefaultSelector()
+        self.buffer = AdaptiveBuffer()
+
+    def run(self):
+        try:
+            dock_socket = listen_socket(self.listen_endpoint, self.reuse_port)
+            dock_socket.listen(socket.SOMAXCONN)
+            dock_socket.setblocking(False)
+            self.selector.register(dock_socket, selectors.EVENT_READ, None)
+            while True:
+                for key, mask in self.selector.select():
+                    if key.data is None:
+                        self.accept(dock_socket)
+                        continue
+                    side = key.data
+                    if side.sock.fileno() == -1:
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.on_writable(side)
+                    if mask & selectors.EVENT_READ and side.sock.fileno() != -1:
+                        self.on_readable(side)
+        except Exception as e:
+            print("ERROR: a fatal error has happened")
+            print(str(e))
+
+    def accept(self, dock_socket: socket.socket):
+        try:
+            client_socket, client_address = dock_socket.accept()
+        except BlockingIOError:
+            return
+        nat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        nat_socket.setblocking(False)
+        nat_socket.connect_ex((self.forward_endpoint[0], self.forward_endpoint[1]))
+        client_socket.setblocking(False)
+        connection = self.registry.add(client_address, client_socket, nat_socket)
+        if len(self.registry) % 10 == 0:
+            print(len(self.registry))
+
+        client_side = RelaySide(client_socket)
+        nat_side = RelaySide(nat_socket, connected=False)
+        client_side.connection = nat_side.connection = connection
+        client_side.peer = nat_side
+        nat_side.peer = client_side
+        self.update_interest(client_side)
+        self.update_interest(nat_side)
+
+    def on_readable(self, side: RelaySide):
+        try:
+            data = self.buffer.recv_into(side.sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_pair(side)
+            return
+        if not data:
+            side.eof = True
+            if not side.peer.pending:
+                self.close_pair(side)
+                return
+        else:
+            side.peer.pending += data
+            self.flush(side.peer)
+        if side.sock.fileno() != -1:
+            self.update_interest(side)
+            self.update_interest(side.peer)
+
+    def on_writable(self, side: RelaySide):
+        if not side.connected:
+            if side.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.close_pair(side)
+                return
+            side.connected = True
+        self.flush(side)
+        if side.sock.fileno() == -1:
+            return
+        if side.peer.eof and not side.pending:
+            self.close_pair(side)
+            return
+        self.update_interest(side)
+        self.update_interest(side.peer)
+
+    def flush(self, side: RelaySide):
+        if not side.connected or not side.pending:
+            return
+        try:
+            sent = side.sock.send(side.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_pair(side)
+            return
+        del side.pending[:sent]
+        relay_counters.add_relayed(sent)
+
+    def update_interest(self, side: RelaySide):
+        events = 0
+        if side.connected and not side.eof and (
+            len(side.peer.pending) < RELAY_MAX_PENDING_BYTES
+        ):
+            events |= selectors.EVENT_READ
+        if not side.connected or side.pending:
+            events |= selectors.EVENT_WRITE
+        if events == side.events:
+            return
+        if side.events == 0:
+            self.selector.register(side.sock, events, side)
+        elif events == 0:
+            self.selector.unregister(side.sock)
+        else:
+            self.selector.modify(side.sock, events, side)
+        side.events = events
+
+    def close_pair(self, side: RelaySide):
+        self.registry.remove(side.connection)
+        for s in (side, side.peer):
+            if s.events:
+                self.selector.unregister(s.sock)
+                s.events = 0
+            relay_counters.add_dropped(len(s.pending))
+            s.sock.close()
+
+
 class MigratingAgent(threading.Thread):
     def __init__(self, client_socket: socket.socket):
         threading.Thread.__init__(self)
@@ -75,42 +306,20 @@ class MigratingAgent(threading.Thread):
 
     def run(self):
         # log(f"==== recieving migration data")
-        full_file_data = b""
-        while data := self.client_socket.recv(1024):
+        full_file_data = bytearray()
+        while data := self.client_socket.recv(64 * 1024):
             full_file_data += data
         self.client_socket.shutdown(socket.SHUT_RD)
 
-        migration_string = full_file_data.decode()
-        peers = migration_string.split("Peer")
-        if len(peers) == 1:
-            # log("ERROR: Migrated data was empty!")
+        try:
+            new_peers, timings = install_peers(full_file_data.decode())
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"ERROR: could not install migrated peers: {e}")
             return
-        peers = peers[1:]
-
-        # Update wireguard w0
-        for peer in peers:
-            lines_in_peer = peer.split("\n")
-            public_key = ""
-            allowed_ips = ""
-            for line in lines_in_peer:
-                if "PublicKey" in line:
-                    public_key = line[line.find("=") + 1 :].strip()
-                if "AllowedIPs" in line:
-                    allowed_ips = line[line.find("=") + 1 :].strip()
-
-            subprocess.run(
-                f'wg set wg0 peer "{public_key}" allowed-ips {allowed_ips}',
-                shell=True,
-            )
-            subprocess.run(f"ip -4 route add {allowed_ips} dev wg0", shell=True)
-
-        # Update config file
-        new_peers = ["["]
-        new_peers.extend(peers)
-        new_peers_string = "\n" + "Peer".join(new_peers)
-        with open(WIREGUARD_CONFIG_LOCATION, "a") as f:
-            f.write(new_peers_string)
-        # log("SUCCESS: updated config file")
+        print(
+            f"installed {len(new_peers)} migrated peers: "
+            + ", ".join(f"{step} {seconds * 1000:.1f}ms" for step, seconds in timings.items())
+        )
 
 
 class MigrationHandler(threading.Thread):
@@ -136,21 +345,15 @@ class MigrationHandler(threading.Thread):
             new_server.start()
 
 
-def calculate_network_throughput(interval=0.01):
-    net_io_before = psutil.net_io_counters()
-    sleep(interval)
-    net_io_after = psutil.net_io_counters()
-    sent_throughput = (
-        net_io_after.bytes_sent - net_io_before.bytes_sent
-    ) / interval
-
-    return sent_throughput
-
-
 class PollingHandler(threading.Thread):
-    def __init__(self, listen_endpoint: tuple):
+    """
+    Answers polls from the controller with the MetricsSampler's last report
+    """
+
+    def __init__(self, listen_endpoint: tuple, sampler: MetricsSampler):
         threading.Thread.__init__(self)
         self.listen_endpoint = listen_endpoint
+        self.sampler = sampler
 
     def run(self):
         try:
@@ -161,20 +364,16 @@ class PollingHandler(threading.Thread):
 
             while True:
                 poller_socket, poller_address = dock_socket.accept()
-                data = poller_socket.recv(1024)
-
-                cpu_utilization = psutil.cpu_percent(interval=0.01)
-                throughput = calculate_network_throughput()
-                report = {}
-                report["utility"] = cpu_utilization
-                report["throughput"] = throughput
-                report["connected_clients"] = client_addresses
-
-                message_to_send = json.dumps(report)
-                poller_socket.sendall(message_to_send.encode())
-                poller_socket.close()
+                try:
+                    with poller_socket:
+                        data = poller_socket.recv(1024)
+                        # length-prefixed, so the controller knows when it has it all
+                        send_frame(poller_socket, self.sampler.answer(data))
+                except OSError as e:
+                    # a poller that hung up early must not take the listener down
+                    print(f"poll from {poller_address} failed: {e}")
 
         finally:
             dock_socket.close()
-            new_server = PollingHandler(self.listen_endpoint)
+            new_server = PollingHandler(self.listen_endpoint, self.sampler)
             new_server.start()
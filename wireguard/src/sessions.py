@@ -0,0 +1,209 @@
+import os
+import socket
+import threading
+from struct import Struct
+from time import sleep, time
+
+from buffers import buffer_pool, recv_exact_into
+from settings import (
+    SESSION_ACK_BYTES,
+    SESSION_CONNECT_TIMEOUT,
+    SESSION_IDLE_TIMEOUT,
+    SESSION_TTL,
+)
+
+# Resumable bulk download sessions. The client opens with one line,
+#   "SESSION NEW <offset>\n" or "SESSION RESUME <session id hex> <offset>\n",
+# and the NAT answers with HELLO (session id, offset it streams from) followed by
+# DATA frames (stream offset, length, payload) for as long as the connection
+# lasts. The client sends "ACK <offset>\n" every SESSION_ACK_BYTES; the NAT never
+# runs more than a window ahead of the last ACK, so after a migration only that
+# unacknowledged tail can be in doubt, and the client resumes from the exact
+# byte it has.
+HELLO = Struct(">16sQ")
+DATA_HEADER = Struct(">QI")
+
+
+class Session:
+    def __init__(self, session_id: bytes, offset):
+        self.id = session_id
+        self.acked = offset
+        self.last_seen = time()
+
+
+class SessionTable:
+    """
+    Sessions by id, shared by every BEEGThread. Sessions nobody has resumed or
+    acknowledged for `ttl` seconds are forgotten.
+    """
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def open(self, session_id, offset) -> Session:
+        """
+        Resumes session_id from offset, or starts a new session there when the id is
+        None or unknown (e.g. the NAT restarted)
+        """
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(os.urandom(16), offset)
+                self.sessions[session.id] = session
+            # the client knows what it has; anything past it is resent
+            session.acked = offset
+            session.last_seen = time()
+            return session
+
+    def ack(self, session: Session, offset):
+        with self.lock:
+            session.acked = max(session.acked, offset)
+            session.last_seen = time()
+
+    def expire(self):
+        # caller holds the lock
+        now = time()
+        for session_id in [
+            sid for sid, s in self.sessions.items() if now - s.last_seen > self.ttl
+        ]:
+            del self.sessions[session_id]
+
+
+session_table = SessionTable()
+
+
+def parse_session_request(request: bytes):
+    """
+    Returns (session id or None, offset), or None for a malformed request,
+    including an offset that does not fit the u64 the HELLO echoes it in
+    """
+    words = request.decode(errors="replace").split()
+    try:
+        if len(words) == 3 and words[1] == "NEW":
+            session_id, offset = None, int(words[2])
+        elif len(words) == 4 and words[1] == "RESUME":
+            session_id, offset = bytes.fromhex(words[2]), int(words[3])
+        else:
+            return None
+    except ValueError:
+        return None
+    if not 0 <= offset < 1 << 64:
+        return None
+    return session_id, offset
+
+
+class AckReader:
+    """
+    Collects "ACK <offset>" lines from a session connection
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def feed(self, data) -> int:
+        """
+        Returns the highest offset acknowledged in data, or -1 for none
+        """
+        self.pending += data
+        *lines, rest = self.pending.split(b"\n")
+        self.pending[:] = rest
+        acked = -1
+        for line in lines:
+            words = line.split()
+            if len(words) == 2 and words[0] == b"ACK" and words[1].isdigit():
+                acked = max(acked, int(words[1]))
+        return acked
+
+
+class ResumableDownload:
+    """
+    Client side of a session. Keeps its offset byte-exact, counting partial frames,
+    so a new connection picks up at the first byte not yet received.
+    """
+
+    def __init__(self, host, port, offset=0, frame_size=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.offset = offset
+        self.session_id = None
+        self.sock = None
+        self.acked = offset
+        self.buffer = buffer_pool.acquire(frame_size)
+        self.view = memoryview(self.buffer)
+        self.header = bytearray(max(HELLO.size, DATA_HEADER.size))
+        self.header_view = memoryview(self.header)
+
+    def connect(self, timeout=SESSION_CONNECT_TIMEOUT):
+        self.close_socket()
+        sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        try:
+            if self.session_id is None:
+                request = f"SESSION NEW {self.offset}\n"
+            else:
+                request = f"SESSION RESUME {self.session_id.hex()} {self.offset}\n"
+            sock.sendall(request.encode())
+            recv_exact_into(sock, self.header_view[: HELLO.size])
+            self.session_id, start = HELLO.unpack_from(self.header)
+            if start != self.offset:
+                raise ConnectionError(f"session resumed at {start}, expected {self.offset}")
+        except BaseException:
+            sock.close()
+            raise
+        # a path that goes quiet this long is taken as gone, e.g. mid-migration
+        sock.settimeout(SESSION_IDLE_TIMEOUT)
+        self.sock = sock
+        self.acked = self.offset
+
+    def reconnect(self, deadline):
+        """
+        Retries right away, backing off only while connects keep failing fast
+        (e.g. refused while the tunnel moves)
+        """
+        backoff = 0.001
+        while time() < deadline:
+            try:
+                self.connect()
+                return True
+            except OSError:
+                sleep(backoff)
+                backoff = min(backoff * 2, 0.05)
+        return False
+
+    def receive(self, on_recv=None) -> memoryview:
+        """
+        Reads the next DATA frame. The view is only valid until the next call.
+        """
+
+        def advance(n):
+            self.offset += n
+            if on_recv:
+                on_recv(n)
+
+        recv_exact_into(self.sock, self.header_view[: DATA_HEADER.size])
+        frame_offset, length = DATA_HEADER.unpack_from(self.header)
+        if frame_offset != self.offset:
+            raise ConnectionError(f"got data for {frame_offset}, expected {self.offset}")
+        if length > len(self.buffer):
+            self.view.release()
+            buffer_pool.release(self.buffer)
+            self.buffer = buffer_pool.acquire(length)
+            self.view = memoryview(self.buffer)
+        frame = self.view[:length]
+        recv_exact_into(self.sock, frame, advance)
+        if self.offset - self.acked >= SESSION_ACK_BYTES:
+            self.sock.sendall(f"ACK {self.offset}\n".encode())
+            self.acked = self.offset
+        return frame
+
+    def close_socket(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        self.close_socket()
+        self.view.release()
+        buffer_pool.release(self.buffer)
@@ -14,6 +14,85 @@ BROKER_ENDPOINT = ("0.0.0.0", BROKER_PORT)
 MIGRATION_ENDPOINT = ("0.0.0.0", MIGRATION_PORT)
 WIREGUARD_PORT = 51820
 
+# "threaded" runs a ForwardThread pair per client, "selector" relays every
+# client through a single event loop thread.
+FORWARDING_MODE = "threaded"
+# Forwarding processes sharing the WireGuard TCP endpoint through SO_REUSEPORT
+# (workers.py); 1 forwards in the proxy process itself
+FORWARDING_WORKERS = 1
+# How each ForwardThread moves bytes: "recv_into" (one pooled, adaptively sized
+# buffer per direction) or "splice" (kernel-side through a pipe, Linux only).
+RELAY_MODE = "recv_into"
+SPLICE_CHUNK_SIZE = 64 * 1024
+# Bounds for the pooled receive buffers in buffers.py
+MIN_RELAY_BUFFER_SIZE = 4 * 1024
+MAX_RELAY_BUFFER_SIZE = 256 * 1024
+# Per direction, reading from a socket pauses once this many bytes are queued.
+RELAY_MAX_PENDING_BYTES = 256 * 1024
+# Lock shards of the forwarder's connection registry (registry.py)
+REGISTRY_SHARDS = 64
+# Proxy metrics for polls (metrics.py): seconds between samples, the windows
+# averages and rates are kept over, and how many client list changes a
+# "delta <version>" poll can be answered from
+METRICS_SAMPLE_INTERVAL = 1
+METRICS_WINDOWS = (1, 10, 60)
+METRICS_CLIENT_HISTORY = 64
+
+# asyncio NAT server (nat_async.py)
+NAT_HTTP_WORKERS = 64
+NAT_HTTP_POOL_HOSTS = 32
+NAT_HTTP_CONNECTIONS_PER_HOST = 16
+NAT_MAX_PIPELINED_REQUESTS = 16
+
+# Tunnel requests (framing.py): "framed" sends versioned binary frames, several in
+# flight per connection; "mux" also splits responses into flow-controlled streams
+# (mux.py); "text" is the old one request per read
+TUNNEL_PROTOCOL = "framed"
+# Seconds a framed or multiplexed request waits for its response, so requests in
+# flight when the tunnel drops do not hang the caller
+TUNNEL_REQUEST_TIMEOUT = 10
+# Largest payload a frame, or a length-prefixed text protocol response, may announce
+FRAME_MAX_SIZE = 64 * 1024 * 1024
+# Threads answering requests from every framed connection of a NAT server
+NAT_FRAMED_WORKERS = 64
+# Multiplexed streams (mux.py): responses go out in chunks of MUX_CHUNK_SIZE,
+# taking turns between streams, and at most MUX_STREAM_WINDOW bytes of a stream
+# may be unread by the client
+MUX_CHUNK_SIZE = 16 * 1024
+MUX_STREAM_WINDOW = 256 * 1024
+
+# Upstream response cache shared by the NAT server modes (nat_cache.py)
+NAT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds to keep responses that carry no Cache-Control or Expires header
+NAT_CACHE_DEFAULT_TTL = 30
+# Bulk download (BEEG) mode: default and largest bytes served per request
+BEEG_CHUNK_SIZE = 500000
+BEEG_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# Resumable bulk download sessions (sessions.py): bytes per DATA frame, how far
+# the NAT may run ahead of the client's last ACK, and how often the client ACKs
+SESSION_CHUNK_SIZE = 256 * 1024
+SESSION_WINDOW = 8 * 1024 * 1024
+SESSION_ACK_BYTES = 1024 * 1024
+SESSION_TTL = 300
+# Client side: seconds to wait for a connect, and for data before reconnecting
+SESSION_CONNECT_TIMEOUT = 0.2
+SESSION_IDLE_TIMEOUT = 0.5
+# KV store mode
+REDIS_HOST = "3.80.71.88"
+REDIS_PORT = 6379
+REDIS_PASSWORD = "foobared"
+REDIS_MAX_CONNECTIONS = 64
+KV_TEST_KEY = "testing_key"
+KV_TEST_VALUE = "0833a59570177bc10f98bcfcd24e2c977c33262125319d44ff88fa42cb83534eabfc9ea63e8d7f324d3331af204ff00410cc5d77a3a494c64b2e59290960c2ddeab78525d8a3af9204d8fde813affbaf"
+# Seconds values stay in the NAT's local read-through cache, 0 to disable it
+KV_LOCAL_CACHE_TTL = 0
+KV_LOCAL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+NAT_POLLING_PORT = 8122
+NAT_POLLING_ENDPOINT = ("0.0.0.0", NAT_POLLING_PORT)
+
+# Which test client.py runs with migration: "wikipedia", "bulk_download",
+# "kv_store" or "page_loads" (a page and its resources as multiplexed streams)
+EFFICACY_TEST = "wikipedia"
 # TESTING_MIGRATION_TIMES = [10, 40, 70, 100, 130, 160, 190, 220, 250, 280]
 TESTING_MIGRATION_TIMES = [10, 110, 180, 230, 260, 280, 290]
 # NOTE: The first entry is always the main proxy
@@ -30,4 +109,29 @@ TESTING_MIGRATION_DESTS = [
 # WHERE_TO_MIGRATE_NEXT = ["18.209.112.152","107.22.46.154","34.203.220.142","50.17.27.77","3.80.252.224","34.238.160.70","3.91.13.148"]
 
 MIGRATION_DURATION_LOG_PATH = "miglog.txt"
+# How clients move to a new proxy: "hot" swaps the peer endpoint on the running
+# interface (endpoint_swap.py), "restart" rewrites wg0.conf and runs wg-quick down/up.
+# "hot" has not been measured on a real interface yet
+CLIENT_MIGRATION_MODE = "restart"
+# Seconds to wait for the first handshake with the new proxy, and how often to check
+HANDSHAKE_WARMUP_TIMEOUT = 5
+HANDSHAKE_POLL_INTERVAL = 0.01
+PERSISTENT_KEEPALIVE = 23
+# Clients notified of a migration at once, and seconds to wait on each one
+MIGRATION_NOTIFY_WORKERS = 64
+MIGRATION_NOTIFY_TIMEOUT = 5
+# How a proxy hands its clients over: "break" says goodbye and closes their
+# connections before telling them where to go; "make_before_break" keeps
+# forwarding until each client confirms it is on the new proxy, or until
+# MIGRATION_DRAIN_TIMEOUT seconds have passed. That only covers the TCP relays
+# already open here: a client that swapped its endpoint sends nothing new this way
+PROXY_MIGRATION_MODE = "break"
+MIGRATION_DRAIN_TIMEOUT = 30
+# Per-second bytes relayed and dropped by the forwarder, see relay_stats.py
+RELAY_THROUGHPUT_LOG_PATH = "throughput_relay.txt"
 CONTROLLER_IP_ADDRESS = "3.91.73.130"  # TODO!!!
+# Telemetry pushed to the controller (telemetry.py): seconds between pushes, and
+# how long to wait before reconnecting after the controller goes away
+TELEMETRY_ENDPOINT = (CONTROLLER_IP_ADDRESS, 8123)
+TELEMETRY_INTERVAL = 1
+TELEMETRY_RECONNECT_DELAY = 5
@@ -0,0 +1,69 @@
+import json
+import socket
+import threading
+from time import sleep
+
+from buffers import send_frame
+from metrics import MetricsSampler
+from settings import TELEMETRY_ENDPOINT, TELEMETRY_INTERVAL, TELEMETRY_RECONNECT_DELAY
+
+
+class TelemetryPusher(threading.Thread):
+    """
+    Pushes the sampler's load figures and client changes to the controller every
+    `interval` seconds, as length-prefixed JSON over one kept-open TCP connection.
+    The first message on a connection has the full client list and later ones
+    only the joins and leaves, which TCP delivers in order, so the controller's
+    copy never misses a change.
+    """
+
+    def __init__(
+        self,
+        sampler: MetricsSampler,
+        controller_endpoint=TELEMETRY_ENDPOINT,
+        interval=TELEMETRY_INTERVAL,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.sampler = sampler
+        self.controller_endpoint = controller_endpoint
+        self.interval = interval
+        self.sock = None
+        self.version = None
+
+    def message(self) -> bytes:
+        with self.sampler.lock:
+            report = self.sampler.report
+            if self.version is None:
+                clients = self.sampler.clients.full()
+            else:
+                clients = self.sampler.clients.since(self.version)
+        self.version = clients["version"]
+        return json.dumps(
+            {
+                "sampled_at": report["sampled_at"],
+                "utility": report["utility"],
+                "throughput": report["throughput"],
+                "connections": report["connections"]["now"],
+                "clients": clients,
+            }
+        ).encode()
+
+    def push(self):
+        if self.sock is None:
+            self.sock = socket.create_connection(
+                self.controller_endpoint, timeout=self.interval
+            )
+            self.version = None
+        send_frame(self.sock, self.message())
+
+    def run(self):
+        while True:
+            try:
+                self.push()
+                sleep(self.interval)
+            except OSError as e:
+                print(f"telemetry to {self.controller_endpoint} failed: {e}")
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                sleep(TELEMETRY_RECONNECT_DELAY)
@@ -0,0 +1,22 @@
+import os
+import socket
+import sys
+
+import pytest
+
+# the modules import each other by bare name, as when run from wireguard/src
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture
+def tcp_pair():
+    """
+    Both ends of a loopback TCP connection, as the tunnel clients set TCP options
+    a socketpair() does not have
+    """
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    yield client, server
+    client.close()
+    server.close()
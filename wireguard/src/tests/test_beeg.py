@@ -0,0 +1,83 @@
+import pytest
+
+from buffers import FrameReader, recv_exact_into
+from framing import BEEG_REQUEST
+from nat_threads import BEEGThread, BulkFile
+from sessions import HELLO, DATA_HEADER
+
+
+@pytest.fixture
+def bulk_file_of(tmp_path):
+    def make(content):
+        path = tmp_path / "beeg"
+        path.write_bytes(content)
+        return BulkFile(str(path))
+
+    return make
+
+
+def serve(tcp_pair, bulk_file):
+    client, server = tcp_pair
+    thread = BEEGThread(server, "test client", bulk_file)
+    thread.start()
+    return client, thread
+
+
+def read_exact(sock, size):
+    data = bytearray(size)
+    recv_exact_into(sock, memoryview(data))
+    return bytes(data)
+
+
+def test_requests_wrap_around_the_file(tcp_pair, bulk_file_of):
+    client, thread = serve(tcp_pair, bulk_file_of(b"0123456789"))
+    client.sendall(b"BEEGMode 13 4\nBEEGMode 8 4\nBEEGMode 0 0\n")
+    reader = FrameReader()
+    assert [bytes(reader.read_frame(client)) for _ in range(3)] == [
+        b"3456",
+        b"89",
+        b"",
+    ]
+    reader.close()
+    client.close()
+    thread.join(5)
+
+
+def test_empty_file_gets_empty_responses(tcp_pair, bulk_file_of):
+    bulk_file = bulk_file_of(b"")
+    assert bytes(bulk_file.read_request(BEEG_REQUEST.pack(5, 100))) == b""
+    client, thread = serve(tcp_pair, bulk_file)
+    client.sendall(b"BEEGMode 5 100\n")
+    reader = FrameReader()
+    assert bytes(reader.read_frame(client)) == b""
+    reader.close()
+    client.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_empty_file_session_streams_nothing(tcp_pair, bulk_file_of):
+    client, thread = serve(tcp_pair, bulk_file_of(b""))
+    client.sendall(b"SESSION NEW 7\n")
+    _, offset = HELLO.unpack(read_exact(client, HELLO.size))
+    assert offset == 7
+    client.settimeout(0.2)
+    with pytest.raises(TimeoutError):
+        client.recv(1)
+    client.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_session_request_split_across_writes(tcp_pair, bulk_file_of):
+    client, thread = serve(tcp_pair, bulk_file_of(b"0123456789"))
+    for part in (b"SES", b"SION NEW", b" 4", b"\n"):
+        client.sendall(part)
+        # give the thread a chance to read each part on its own
+        thread.join(0.05)
+    _, offset = HELLO.unpack(read_exact(client, HELLO.size))
+    assert offset == 4
+    frame_offset, length = DATA_HEADER.unpack(read_exact(client, DATA_HEADER.size))
+    assert (frame_offset, read_exact(client, length)) == (4, b"456789")
+    client.close()
+    thread.join(5)
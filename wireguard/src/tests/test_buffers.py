@@ -0,0 +1,24 @@
+import pytest
+
+from buffers import LENGTH_PREFIX, FrameReader, ProtocolError, send_frame
+
+
+def test_reads_frames_and_grows_for_big_ones(tcp_pair):
+    sender, receiver = tcp_pair
+    reader = FrameReader(initial_size=16)
+    for payload in (b"small", b"x" * 100000, b""):
+        send_frame(sender, payload)
+        assert bytes(reader.read_frame(receiver)) == payload
+    reader.close()
+
+
+def test_refuses_frames_over_the_limit(tcp_pair):
+    sender, receiver = tcp_pair
+    reader = FrameReader(max_size=1024)
+    send_frame(sender, b"x" * 1024)
+    assert len(reader.read_frame(receiver)) == 1024
+    # a corrupt or hostile length must not turn into an allocation
+    sender.sendall(LENGTH_PREFIX.pack(1 << 60))
+    with pytest.raises(ProtocolError, match="over the limit"):
+        reader.read_frame(receiver)
+    reader.close()
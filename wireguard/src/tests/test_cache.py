@@ -0,0 +1,101 @@
+import threading
+from email.utils import formatdate
+from time import time
+
+import pytest
+
+from nat_cache import ResponseCache, get_ttl
+
+
+def test_get_ttl():
+    assert get_ttl({}, 30) == 30
+    assert get_ttl({"Cache-Control": "public, max-age=120"}, 30) == 120
+    assert get_ttl({"Cache-Control": "s-maxage=5, max-age=120"}, 30) == 5
+    assert get_ttl({"Cache-Control": "no-store"}, 30) == 0
+    assert get_ttl({"Cache-Control": "max-age=soon"}, 30) == 0
+    assert 99 <= get_ttl({"Expires": formatdate(time() + 100, usegmt=True)}, 30) <= 100
+    assert get_ttl({"Expires": "0"}, 30) == 0
+    # errors are only cached when they say for how long, and 5xx never
+    assert get_ttl({}, 30, 404) == 0
+    assert get_ttl({"Cache-Control": "max-age=60"}, 30, 404) == 60
+    assert get_ttl({"Cache-Control": "max-age=60"}, 30, 503) == 0
+
+
+def test_hits_misses_and_lru_eviction():
+    cache = ResponseCache(max_bytes=10, default_ttl=30)
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return url.encode() * 4, {}, 200
+
+    assert cache.get("a", fetch) == b"aaaa"
+    assert cache.get("a", fetch) == b"aaaa"
+    cache.get("b", fetch)
+    # reading a makes b the least recently used
+    cache.get("a", fetch)
+    cache.get("c", fetch)
+    assert list(cache.entries) == ["a", "c"]
+    assert fetched == ["a", "b", "c"]
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 3,
+        "coalesced": 0,
+        "evictions": 1,
+        "entries": 2,
+        "bytes": 8,
+    }
+
+
+def test_uncacheable_responses_are_fetched_again():
+    cache = ResponseCache(default_ttl=30)
+    responses = iter(
+        [
+            (b"busy", {}, 503),
+            (b"private", {"Cache-Control": "private"}, 200),
+            (b"ok", {}, 200),
+        ]
+    )
+    assert [cache.get("a", lambda url: next(responses)) for _ in range(4)] == [
+        b"busy",
+        b"private",
+        b"ok",
+        b"ok",
+    ]
+
+
+def test_concurrent_misses_share_one_fetch():
+    cache = ResponseCache(default_ttl=30)
+    release = threading.Event()
+    calls = []
+
+    def slow_fetch(url):
+        calls.append(url)
+        release.wait(5)
+        return b"body", {}, 200
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get("a", slow_fetch)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    while cache.stats()["coalesced"] < 7:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ["a"]
+    assert results == [b"body"] * 8
+
+
+def test_failed_fetch_is_not_cached():
+    cache = ResponseCache(default_ttl=30)
+
+    def failing_fetch(url):
+        raise ConnectionError("upstream down")
+
+    with pytest.raises(ConnectionError):
+        cache.get("a", failing_fetch)
+    assert cache.get("a", lambda url: (b"back", {}, 200)) == b"back"
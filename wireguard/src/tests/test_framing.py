@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from framing import (
+    FETCH,
+    RESPONSE,
+    ERROR,
+    FrameParser,
+    FramedClient,
+    ProtocolError,
+    pack_header,
+    write_frame,
+)
+
+
+def frames_of(parser):
+    return [
+        (frame_type, request_id, flags, bytes(payload))
+        for frame_type, request_id, flags, payload in parser.frames()
+    ]
+
+
+def test_parser_handles_split_and_coalesced_frames():
+    stream = (
+        pack_header(RESPONSE, 1, 5)
+        + b"hello"
+        + pack_header(ERROR, 2, 0)
+        + pack_header(RESPONSE, 3, 3000, flags=1)
+        + b"x" * 3000
+    )
+    parser = FrameParser(initial_size=16)
+    received = []
+    # one byte at a time, then the rest at once
+    for i in range(20):
+        parser.feed(stream[i : i + 1])
+        received += frames_of(parser)
+    parser.feed(stream[20:])
+    received += frames_of(parser)
+    parser.close()
+    assert received == [
+        (RESPONSE, 1, 0, b"hello"),
+        (ERROR, 2, 0, b""),
+        (RESPONSE, 3, 1, b"x" * 3000),
+    ]
+
+
+def test_parser_rejects_other_versions_and_oversized_frames():
+    parser = FrameParser()
+    parser.feed(b"\x02" + pack_header(RESPONSE, 1, 0)[1:])
+    with pytest.raises(ProtocolError):
+        frames_of(parser)
+    parser.close()
+
+    parser = FrameParser(max_size=100)
+    parser.feed(pack_header(RESPONSE, 1, 101))
+    with pytest.raises(ProtocolError):
+        frames_of(parser)
+    parser.close()
+
+
+def answer_in_reverse(sock, count):
+    """
+    Reads `count` requests, then answers them last first, echoing the payload,
+    or with an ERROR for a payload of b"fail"
+    """
+    parser = FrameParser()
+    requests = []
+    while len(requests) < count and parser.recv_into(sock):
+        requests += [
+            (request_id, bytes(payload))
+            for _, request_id, _, payload in parser.frames()
+        ]
+    parser.close()
+    for request_id, payload in reversed(requests):
+        if payload == b"fail":
+            write_frame(sock, ERROR, request_id, b"no such host")
+        else:
+            write_frame(sock, RESPONSE, request_id, payload)
+
+
+def test_client_matches_out_of_order_responses(tcp_pair):
+    client_socket, nat_socket = tcp_pair
+    payloads = [f"request {i}".encode() for i in range(10)] + [b"fail"]
+    nat = threading.Thread(target=answer_in_reverse, args=(nat_socket, len(payloads)))
+    nat.start()
+    client = FramedClient(client_socket)
+    futures = [client.request(FETCH, payload) for payload in payloads]
+    for payload, future in zip(payloads[:-1], futures):
+        assert future.result(5) == payload
+    with pytest.raises(ProtocolError, match="no such host"):
+        futures[-1].result(5)
+    nat.join()
+
+
+def test_fetch_times_out_and_fails_pending_requests_on_close(tcp_pair):
+    client_socket, nat_socket = tcp_pair
+    client = FramedClient(client_socket)
+    with pytest.raises(TimeoutError):
+        client.fetch(FETCH, b"http://example.com/", timeout=0.05)
+    assert client.pending == {}
+    future = client.request(FETCH, b"http://example.com/")
+    nat_socket.close()
+    with pytest.raises(ConnectionResetError):
+        future.result(5)
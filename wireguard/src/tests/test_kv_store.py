@@ -0,0 +1,46 @@
+from buffers import LENGTH_PREFIX
+from kv_store import FakeRedis, KVStore, encode_mget, parse_kv_request
+
+
+def test_parse_kv_request():
+    assert parse_kv_request(b"GET a") == ("GET", ["a"])
+    assert parse_kv_request(b"mget a b c\n") == ("MGET", ["a", "b", "c"])
+    assert parse_kv_request(b"GET a b") is None
+    assert parse_kv_request(b"GET") is None
+    assert parse_kv_request(b"SET a b") is None
+
+
+def test_encode_mget():
+    assert encode_mget([b"one", b""]) == (
+        LENGTH_PREFIX.pack(3) + b"one" + LENGTH_PREFIX.pack(0)
+    )
+
+
+def test_requests_share_one_round_trip():
+    redis = FakeRedis()
+    redis.set("a", "1")
+    redis.set("b", "22")
+    store = KVStore(redis, cache_ttl=0)
+    before = redis.round_trips
+    responses = store.execute(
+        [("GET", ["a"]), ("MGET", ["b", "missing", "a"]), ("GET", ["missing"])]
+    )
+    assert redis.round_trips == before + 1
+    assert responses == [
+        b"1",
+        encode_mget([b"22", b"", b"1"]),
+        b"",
+    ]
+
+
+def test_local_cache_skips_redis_for_known_keys():
+    redis = FakeRedis()
+    redis.set("a", "1")
+    store = KVStore(redis, cache_ttl=30)
+    store.execute([("GET", ["a"]), ("GET", ["missing"])])
+    before = redis.round_trips
+    assert store.execute([("GET", ["a"])]) == [b"1"]
+    assert redis.round_trips == before
+    # misses are not cached, so a key written later is found
+    redis.set("missing", "now")
+    assert store.execute([("GET", ["missing"])]) == [b"now"]
@@ -0,0 +1,80 @@
+import json
+
+from metrics import ClientChanges, MetricsSampler
+
+
+def test_client_changes_since():
+    changes = ClientChanges(history=3)
+    changes.update({"1.1.1.1", "2.2.2.2"})
+    changes.update({"2.2.2.2", "3.3.3.3"})
+    # unchanged sets do not make a new version
+    changes.update({"2.2.2.2", "3.3.3.3"})
+    assert changes.version == 2
+    assert changes.since(2) == {
+        "version": 2,
+        "full": False,
+        "added": [],
+        "removed": [],
+    }
+    assert changes.since(1) == {
+        "version": 2,
+        "full": False,
+        "added": ["3.3.3.3"],
+        "removed": ["1.1.1.1"],
+    }
+    assert changes.since(0)["added"] == ["2.2.2.2", "3.3.3.3"]
+
+
+def test_deltas_bring_any_version_up_to_date():
+    history = [set(), {"1.1.1.1"}, set(), {"1.1.1.1"}, {"2.2.2.2"}, {"1.1.1.1"}]
+    changes = ClientChanges()
+    for clients in history[1:]:
+        changes.update(clients)
+    for version, clients in enumerate(history):
+        delta = changes.since(version)
+        # a client that left and came back (or the reverse) is never both
+        assert not set(delta["added"]) & set(delta["removed"])
+        assert (clients | set(delta["added"])) - set(delta["removed"]) == history[-1]
+
+
+def test_versions_out_of_history_get_the_full_list():
+    changes = ClientChanges(history=2)
+    for i in range(5):
+        changes.update({f"10.0.0.{i}"})
+    assert changes.since(1) == changes.full()
+    assert changes.since(9) == changes.full()
+    assert changes.since(3)["full"] is False
+
+
+class StandInRegistry:
+    def __init__(self):
+        self.clients = []
+
+    def addresses(self):
+        return [(ip, 40000 + i) for i, ip in enumerate(self.clients)]
+
+
+def test_sampler_answers_full_and_delta_polls():
+    registry = StandInRegistry()
+    registry.clients = ["1.1.1.1", "2.2.2.2"]
+    sampler = MetricsSampler(registry=registry)
+    full = json.loads(sampler.answer(b"hello"))
+    assert full["connected_clients"] == ["1.1.1.1", "2.2.2.2"]
+    assert full["connections"]["now"] == 2
+    version = full_version = sampler.clients.version
+
+    registry.clients = ["2.2.2.2", "3.3.3.3"]
+    sampler.sample()
+    delta = json.loads(sampler.answer(f"delta {version}".encode()))
+    assert "connected_clients" not in delta
+    assert delta["clients"] == {
+        "version": full_version + 1,
+        "full": False,
+        "added": ["3.3.3.3"],
+        "removed": ["1.1.1.1"],
+    }
+    # anything that is not a delta poll gets the full report
+    assert json.loads(sampler.answer(b"delta soon"))["connected_clients"] == [
+        "2.2.2.2",
+        "3.3.3.3",
+    ]
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from framing import (
+    FETCH,
+    STREAM_OPEN,
+    STREAM_RESET,
+    WINDOW_UPDATE,
+    WINDOW_INCREMENT,
+    FrameParser,
+    ProtocolError,
+    write_frame,
+)
+from mux import MuxClient, StreamScheduler
+
+
+class StandInNAT(threading.Thread):
+    """
+    NAT side of a mux connection that answers STREAM_OPEN with responses[url],
+    and resets streams for unknown urls
+    """
+
+    def __init__(self, sock, responses, chunk_size, window):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.responses = responses
+        self.send_lock = threading.Lock()
+        self.scheduler = StreamScheduler(sock, self.send_lock, chunk_size, window)
+        self.scheduler.start()
+
+    def run(self):
+        parser = FrameParser()
+        try:
+            while parser.recv_into(self.sock):
+                for frame_type, stream_id, _, payload in parser.frames():
+                    if frame_type == STREAM_OPEN:
+                        url = bytes(payload[1:])
+                        if url in self.responses:
+                            self.scheduler.open(stream_id)
+                            self.scheduler.add(stream_id, self.responses[url])
+                        else:
+                            with self.send_lock:
+                                write_frame(
+                                    self.sock, STREAM_RESET, stream_id, b"unknown"
+                                )
+                    elif frame_type == WINDOW_UPDATE:
+                        (credit,) = WINDOW_INCREMENT.unpack(payload)
+                        self.scheduler.grant(stream_id, credit)
+        except OSError:
+            pass
+        finally:
+            parser.close()
+            self.scheduler.close()
+
+
+@pytest.fixture
+def mux_pair(tcp_pair):
+    client_socket, nat_socket = tcp_pair
+    responses = {
+        b"big": bytes(range(256)) * 4096,
+        b"small": b"small response",
+    }
+    nat = StandInNAT(nat_socket, responses, chunk_size=4096, window=64 * 1024)
+    nat.start()
+    client = MuxClient(client_socket, window=64 * 1024)
+    return client, responses
+
+
+def test_streams_come_back_whole(mux_pair):
+    client, responses = mux_pair
+    streams = [client.open_stream(FETCH, url) for url in (b"big", b"small", b"big")]
+    assert [stream.read_all(5) for stream in streams] == [
+        responses[b"big"],
+        responses[b"small"],
+        responses[b"big"],
+    ]
+    assert client.streams == {}
+
+
+def test_unread_stream_does_not_hold_up_others(mux_pair):
+    client, responses = mux_pair
+    big = client.open_stream(FETCH, b"big")
+    # big stays unread, so it stops at its window while small still gets through
+    assert client.fetch(FETCH, b"small", timeout=5) == responses[b"small"]
+    assert big.read_all(5) == responses[b"big"]
+
+
+def test_reset_fails_only_that_stream(mux_pair):
+    client, responses = mux_pair
+    with pytest.raises(ProtocolError, match="unknown"):
+        client.fetch(FETCH, b"missing", timeout=5)
+    assert client.fetch(FETCH, b"small", timeout=5) == responses[b"small"]
@@ -0,0 +1,64 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from buffers import FrameReader
+from framing import FETCH, FramedClient, ProtocolError
+from nat_async import AsyncNATServer
+
+
+class StandInFetcher:
+    """
+    Answers a url with itself, and fails urls starting with "fail"
+    """
+
+    async def fetch(self, url) -> bytes:
+        if url.startswith("fail"):
+            raise ValueError(f"cannot fetch {url}")
+        return url.encode()
+
+
+@pytest.fixture
+def nat_port():
+    with socket.create_server(("127.0.0.1", 0)) as probe:
+        port = probe.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    server = AsyncNATServer(StandInFetcher())
+    threading.Thread(
+        target=loop.run_until_complete,
+        args=(server.serve("127.0.0.1", port),),
+        daemon=True,
+    ).start()
+    for _ in range(500):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            threading.Event().wait(0.01)
+    return port
+
+
+def test_text_failures_get_empty_responses_in_order(nat_port):
+    with socket.create_connection(("127.0.0.1", nat_port)) as sock:
+        sock.sendall(b"first\nfail-this\n\xff\xfe\nlast\n")
+        reader = FrameReader()
+        responses = [bytes(reader.read_frame(sock)) for _ in range(4)]
+        reader.close()
+    assert responses == [b"first", b"", "��".encode(), b"last"]
+
+
+def test_framed_failures_get_error_frames(nat_port):
+    with socket.create_connection(("127.0.0.1", nat_port)) as sock:
+        client = FramedClient(sock)
+        futures = [
+            client.request(FETCH, payload)
+            for payload in (b"first", b"fail-this", b"\xff\xfe", b"last")
+        ]
+        assert futures[0].result(5) == b"first"
+        with pytest.raises(ProtocolError, match="cannot fetch fail-this"):
+            futures[1].result(5)
+        with pytest.raises(ProtocolError, match="decode"):
+            futures[2].result(5)
+        assert futures[3].result(5) == b"last"
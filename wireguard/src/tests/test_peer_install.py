@@ -0,0 +1,103 @@
+import subprocess
+
+from peer_install import (
+    install_peers,
+    parse_allowed_ips,
+    peer_delta,
+    set_allowed_ips_command,
+)
+from wgconfig import WireGuardConfig
+
+# `wg show wg0 allowed-ips`: one peer per line, tab separated, CIDRs space separated
+WG_SHOW_ALLOWED_IPS = (
+    "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=\t10.27.0.25/32\n"
+    "TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=\t10.27.0.26/32 10.27.1.0/24\n"
+    "gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=\t(none)\n"
+)
+
+CONFIG = """[Interface]
+PrivateKey = yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk=
+ListenPort = 51820
+
+[Peer]
+PublicKey = xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=
+AllowedIPs = 10.27.0.25
+
+[Peer]
+PublicKey = TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=
+AllowedIPs = 10.27.1.0/24, 10.27.0.26
+
+[Peer]
+PublicKey = gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=
+AllowedIPs = 10.27.0.27
+
+[Peer]
+PublicKey = HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=
+AllowedIPs = 10.27.0.28
+"""
+
+
+def test_parse_allowed_ips():
+    live = parse_allowed_ips(WG_SHOW_ALLOWED_IPS)
+    assert live == {
+        "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=": "10.27.0.25/32",
+        "TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=": "10.27.0.26/32, 10.27.1.0/24",
+        "gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=": "",
+    }
+
+
+def test_peer_delta_matches_bare_addresses_to_cidrs():
+    delta = peer_delta(
+        WireGuardConfig.parse(CONFIG), parse_allowed_ips(WG_SHOW_ALLOWED_IPS)
+    )
+    # the first two are installed as configured; the third has lost its
+    # allowed IPs and the fourth is missing
+    assert [peer.public_key for peer in delta] == [
+        "gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=",
+        "HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=",
+    ]
+
+
+def test_set_allowed_ips_command():
+    config = WireGuardConfig.parse(CONFIG)
+    peers = [config.peers[key] for key in list(config.peers)[1:3]]
+    assert set_allowed_ips_command(peers, "wg1") == [
+        "wg",
+        "set",
+        "wg1",
+        "peer",
+        "TrMvSoP4jYQlY6RIzBgbssQqY3vxI2Pi+y71lOWWXX0=",
+        "allowed-ips",
+        "10.27.1.0/24,10.27.0.26",
+        "peer",
+        "gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=",
+        "allowed-ips",
+        "10.27.0.27",
+    ]
+
+
+def test_install_peers_adds_new_and_replaces_changed(tmp_path, monkeypatch):
+    commands = []
+
+    def run(command, input=None, **kwargs):
+        commands.append((command[:3], input))
+        stdout = WG_SHOW_ALLOWED_IPS if command[:2] == ["wg", "show"] else ""
+        return subprocess.CompletedProcess(command, 0, stdout, "")
+
+    monkeypatch.setattr(subprocess, "run", run)
+    config_location = tmp_path / "wg0.conf"
+    config_location.write_text(CONFIG.split("[Peer]")[0])
+    installed, _ = install_peers(CONFIG, "wg0", str(config_location))
+
+    new, changed = (
+        "HIgo9xNzJMWLKASShiTqIybxZ0U3wGLiUeJ1PKf8ykw=",
+        "gN65BkIKy1eCE9pP1wdc8ROUtkHLF2PfAqYdyYBz6EA=",
+    )
+    assert [peer.public_key for peer in installed] == [changed, new]
+    addconf, wg_set = commands[1:3]
+    # only the missing peer goes through addconf, which merges allowed IPs
+    assert addconf[0] == ["wg", "addconf", "wg0"]
+    assert new in addconf[1] and changed not in addconf[1]
+    assert wg_set[0] == ["wg", "set", "wg0"]
+    saved = WireGuardConfig.load(str(config_location))
+    assert list(saved.peers) == [changed, new]
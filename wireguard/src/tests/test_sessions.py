@@ -0,0 +1,46 @@
+from time import time
+
+from sessions import AckReader, SessionTable, parse_session_request
+
+
+def test_parse_session_request():
+    session_id = bytes(range(16))
+    assert parse_session_request(b"SESSION NEW 0\n") == (None, 0)
+    assert parse_session_request(
+        f"SESSION RESUME {session_id.hex()} 4096\n".encode()
+    ) == (session_id, 4096)
+    for request in (
+        b"SESSION NEW\n",
+        b"SESSION NEW -1\n",
+        b"SESSION NEW 18446744073709551616\n",
+        b"SESSION RESUME nothex 0\n",
+        b"SESSION OPEN 0\n",
+    ):
+        assert parse_session_request(request) is None
+
+
+def test_ack_reader_keeps_partial_lines():
+    reader = AckReader()
+    assert reader.feed(b"ACK 10") == -1
+    assert reader.feed(b"24\nACK 2048\nAC") == 2048
+    assert reader.feed(b"K 4096\nACK x\n") == 4096
+    assert reader.feed(b"garbage\n") == -1
+
+
+def test_session_table_resumes_and_expires():
+    table = SessionTable(ttl=60)
+    session = table.open(None, 100)
+    table.ack(session, 500)
+    table.ack(session, 300)
+    assert session.acked == 500
+    # resuming rewinds to what the client says it has
+    assert table.open(session.id, 400) is session
+    assert session.acked == 400
+    # unknown ids, e.g. after a NAT restart, get a new session at the offset
+    other = table.open(b"\x00" * 16, 700)
+    assert other is not session and other.acked == 700
+
+    session.last_seen = time() - 61
+    table.open(None, 0)
+    assert session.id not in table.sessions
+    assert other.id in table.sessions
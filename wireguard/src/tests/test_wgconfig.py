@@ -0,0 +1,54 @@
+import os
+
+from wgconfig import Peer, WireGuardConfig
+
+CONFIG = """[Interface]
+PrivateKey = yAnz5TF+lXXJte14tji3zlMNq+hd2rYUIgJBgB3fBmk=
+ListenPort = 51820
+# hand-written comment the appends must keep
+[Peer]
+PublicKey = xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=
+AllowedIPs = 10.27.0.25"""
+
+
+def new_peer(last_octet):
+    return Peer(
+        {"PublicKey": f"key{last_octet}=", "AllowedIPs": f"10.27.0.{last_octet}"}
+    )
+
+
+def test_added_peers_are_appended_in_place(tmp_path):
+    path = tmp_path / "wg0.conf"
+    # no newline at the end, as an editor may leave it
+    path.write_text(CONFIG)
+    inode = os.stat(path).st_ino
+    config = WireGuardConfig.load(str(path))
+    config.add_peer(new_peer(26))
+    config.save(str(path))
+    config.add_peer(new_peer(27))
+    config.save(str(path))
+
+    assert os.stat(path).st_ino == inode
+    assert path.read_text() == (
+        CONFIG + "\n" + new_peer(26).render() + new_peer(27).render()
+    )
+    assert list(WireGuardConfig.load(str(path)).peers) == [
+        "xTIBA5rboUvnH4htodjb6e697QjLERt1NAB4mZqp8Dg=",
+        "key26=",
+        "key27=",
+    ]
+
+
+def test_changed_peers_rewrite_the_file(tmp_path):
+    path = tmp_path / "wg0.conf"
+    path.write_text(CONFIG)
+    config = WireGuardConfig.load(str(path))
+    config.add_peer(new_peer(26))
+    config.update_peer("key26=", AllowedIPs="10.27.0.30")
+    config.save(str(path))
+
+    assert path.read_text() == config.render()
+    assert WireGuardConfig.load(str(path)).peer_for_ip("10.27.0.30").public_key == (
+        "key26="
+    )
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".wgconfig-")]
@@ -0,0 +1,194 @@
+"""
+A parsed wg/wg-quick config, indexed by peer public key and allowed IP.
+
+Kept free of project imports so buildbulkeys.py can use it as src.wgconfig.
+"""
+import os
+import tempfile
+
+
+def write_atomically(path, text):
+    """
+    Writes path by filling a file beside it and renaming it over, so readers never
+    see a half-written config
+    """
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".wgconfig-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def append_text(path, text):
+    """
+    Writes text after the current content of path, starting it on a new line,
+    without reading or rewriting what is already there
+    """
+    with open(path, "a+b") as f:
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                text = "\n" + text
+        f.write(text.encode())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def split_allowed_ips(value: str) -> list:
+    return [ip.strip() for ip in value.split(",") if ip.strip()]
+
+
+class Peer:
+    """
+    One [Peer] section. Options keep their file order; the rendered text is cached
+    until an option changes.
+    """
+
+    def __init__(self, options: dict):
+        self.options = options
+        self.text = None
+
+    @property
+    def public_key(self):
+        return self.options["PublicKey"]
+
+    @property
+    def allowed_ips(self) -> list:
+        return split_allowed_ips(self.options.get("AllowedIPs", ""))
+
+    def render(self) -> str:
+        if self.text is None:
+            self.text = "[Peer]\n" + "".join(
+                f"{name} = {value}\n" for name, value in self.options.items()
+            )
+        return self.text
+
+
+class WireGuardConfig:
+    def __init__(self, interface: dict = None):
+        self.interface = interface or {}
+        self.peers = {}
+        self.by_allowed_ip = {}
+        # peers added since the file was last written, while it needs no rewrite
+        self.unsaved = []
+        self.rewrite_needed = False
+
+    @classmethod
+    def parse(cls, text: str):
+        interface = {}
+        peer_sections = []
+        options = None
+        for line in text.splitlines():
+            if "#" in line:
+                line = line.split("#", 1)[0]
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == "[":
+                section = line.strip("[]").strip().lower()
+                options = interface if section == "interface" else {}
+                if section == "peer":
+                    peer_sections.append(options)
+                continue
+            if options is not None:
+                # base64 keys end in "=", so only the first one separates
+                name, _, value = line.partition("=")
+                options[name.strip()] = value.strip()
+        return cls.from_sections(interface, peer_sections)
+
+    @classmethod
+    def from_sections(cls, interface: dict, peer_sections: list):
+        config = cls(interface)
+        for options in peer_sections:
+            if "PublicKey" in options:
+                config.add_peer(Peer(options))
+        config.unsaved = []
+        config.rewrite_needed = False
+        return config
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.parse(f.read())
+
+    def add_peer(self, peer: Peer):
+        """
+        Adds or replaces the peer with peer.public_key
+        """
+        public_key = peer.public_key
+        if public_key in self.peers:
+            self.remove_peer(public_key)
+        self.peers[public_key] = peer
+        for allowed_ip in peer.allowed_ips:
+            self.by_allowed_ip[allowed_ip] = public_key
+        if not self.rewrite_needed:
+            self.unsaved.append(peer)
+        return peer
+
+    def remove_peer(self, public_key):
+        peer = self.peers.pop(public_key)
+        for allowed_ip in peer.allowed_ips:
+            if self.by_allowed_ip.get(allowed_ip) == public_key:
+                del self.by_allowed_ip[allowed_ip]
+        self.rewrite_needed = True
+        self.unsaved = []
+        return peer
+
+    def update_peer(self, public_key, **options):
+        """
+        Sets options on a peer, e.g. update_peer(key, Endpoint="1.2.3.4:51820")
+        """
+        peer = self.peers[public_key]
+        if "AllowedIPs" in options:
+            for allowed_ip in peer.allowed_ips:
+                if self.by_allowed_ip.get(allowed_ip) == public_key:
+                    del self.by_allowed_ip[allowed_ip]
+        peer.options.update(options)
+        peer.text = None
+        for allowed_ip in peer.allowed_ips:
+            self.by_allowed_ip[allowed_ip] = public_key
+        self.rewrite_needed = True
+        self.unsaved = []
+        return peer
+
+    def peer_for_ip(self, allowed_ip):
+        public_key = self.by_allowed_ip.get(allowed_ip)
+        return self.peers.get(public_key)
+
+    def first_peer(self) -> Peer:
+        return next(iter(self.peers.values()))
+
+    def render_interface(self) -> str:
+        if not self.interface:
+            return ""
+        return "[Interface]\n" + "".join(
+            f"{name} = {value}\n" for name, value in self.interface.items()
+        )
+
+    def render_peers(self, peers=None) -> str:
+        if peers is None:
+            peers = self.peers.values()
+        return "".join(peer.render() for peer in peers)
+
+    def render(self) -> str:
+        return self.render_interface() + self.render_peers()
+
+    def save(self, path):
+        """
+        Appends only the peers added since the last save when nothing else
+        changed, otherwise rewrites the whole config atomically
+        """
+        if self.rewrite_needed:
+            write_atomically(path, self.render())
+        elif self.unsaved:
+            append_text(path, self.render_peers(self.unsaved))
+        self.unsaved = []
+        self.rewrite_needed = False
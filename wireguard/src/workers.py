@@ -0,0 +1,183 @@
+"""
+Forwarding in several processes: every worker binds the WireGuard TCP endpoint
+with SO_REUSEPORT, the kernel spreads new connections over them, and each relays
+its own connections outside the other workers' GIL. The proxy process talks to
+the workers over a Unix socket each, so polling and migration still see every
+client.
+"""
+import json
+import multiprocessing
+import socket
+import threading
+
+from registry import ConnectionRegistry
+from relay_stats import relay_counters
+from server_threads import ForwardingServerThread, SelectorForwardingServerThread
+from settings import FORWARDING_MODE, FORWARDING_WORKERS, RELAY_MODE
+
+# SCM_RIGHTS takes at most 253 fds per message, two per connection
+CONNECTIONS_PER_MESSAGE = 100
+CONTROL_MESSAGE_SIZE = 1024 * 1024
+
+
+def worker_main(channel, listen_endpoint, forward_endpoint, forwarding_mode, relay_mode):
+    registry = ConnectionRegistry()
+    if forwarding_mode == "selector":
+        server = SelectorForwardingServerThread(
+            listen_endpoint, forward_endpoint, registry=registry, reuse_port=True
+        )
+    else:
+        server = ForwardingServerThread(
+            listen_endpoint,
+            forward_endpoint,
+            relay_mode,
+            registry=registry,
+            reuse_port=True,
+        )
+    server.daemon = True
+    server.start()
+    WorkerControl(channel, registry).serve()
+
+
+class WorkerControl:
+    """
+    Worker end of the control channel. Answers "stats", "addresses" and "take";
+    "take" hands the proxy process the sockets themselves, as fds, and forgets
+    them here while the relays keep running until the proxy closes them.
+    """
+
+    def __init__(self, channel: socket.socket, registry: ConnectionRegistry):
+        self.channel = channel
+        self.registry = registry
+
+    def send_connections(self, connections, with_fds):
+        # at least one message, so an idle worker still answers
+        for i in range(0, len(connections), CONNECTIONS_PER_MESSAGE) or [0]:
+            batch = connections[i : i + CONNECTIONS_PER_MESSAGE]
+            message = {
+                "addresses": [address for address, _, _ in batch],
+                "more": i + CONNECTIONS_PER_MESSAGE < len(connections),
+            }
+            fds = []
+            if with_fds:
+                for _, client_socket, nat_socket in batch:
+                    fds += [client_socket.fileno(), nat_socket.fileno()]
+            socket.send_fds(self.channel, [json.dumps(message).encode()], fds)
+
+    def serve(self):
+        # ends when the proxy process goes away
+        while command := self.channel.recv(CONTROL_MESSAGE_SIZE):
+            if command == b"stats":
+                relayed, dropped = relay_counters.snapshot()
+                stats = {
+                    "relayed": relayed,
+                    "dropped": dropped,
+                    "connections": len(self.registry),
+                }
+                self.channel.send(json.dumps(stats).encode())
+            elif command == b"addresses":
+                connections = [c.as_tuple() for c in self.registry.connections()]
+                self.send_connections(connections, with_fds=False)
+            elif command == b"take":
+                connections = [
+                    connection
+                    for connection in self.registry.take_all()
+                    if connection[1].fileno() != -1 and connection[2].fileno() != -1
+                ]
+                self.send_connections(connections, with_fds=True)
+
+
+class ForwardingWorkerPool:
+    """
+    Starts `workers` forwarding processes on listen_endpoint. Stands in for the
+    ConnectionRegistry (len, addresses, take_all) and the RelayCounters (snapshot)
+    of a single-process proxy, summed over all workers.
+    """
+
+    def __init__(
+        self,
+        listen_endpoint: tuple,
+        forward_endpoint: tuple,
+        workers=FORWARDING_WORKERS,
+        forwarding_mode=FORWARDING_MODE,
+        relay_mode=RELAY_MODE,
+    ):
+        self.listen_endpoint = listen_endpoint
+        self.forward_endpoint = forward_endpoint
+        self.workers = workers
+        self.forwarding_mode = forwarding_mode
+        self.relay_mode = relay_mode
+        self.processes = []
+        self.channels = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        # spawn, not fork: the proxy process already runs threads holding locks
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.workers):
+            channel, worker_channel = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET
+            )
+            process = context.Process(
+                target=worker_main,
+                args=(
+                    worker_channel,
+                    self.listen_endpoint,
+                    self.forward_endpoint,
+                    self.forwarding_mode,
+                    self.relay_mode,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_channel.close()
+            self.processes.append(process)
+            self.channels.append(channel)
+
+    def ask(self, command: bytes):
+        """
+        Sends command to every worker and returns a list of (message, fds) replies
+        """
+        replies = []
+        with self.lock:
+            for channel in self.channels:
+                channel.send(command)
+                while True:
+                    data, fds, _, _ = socket.recv_fds(
+                        channel, CONTROL_MESSAGE_SIZE, 2 * CONNECTIONS_PER_MESSAGE
+                    )
+                    message = json.loads(data)
+                    replies.append((message, fds))
+                    if not message.get("more"):
+                        break
+        return replies
+
+    def __len__(self):
+        return sum(message["connections"] for message, _ in self.ask(b"stats"))
+
+    def snapshot(self):
+        # migrations close connections from this process, and count their losses here
+        relayed, dropped = relay_counters.snapshot()
+        for stats, _ in self.ask(b"stats"):
+            relayed += stats["relayed"]
+            dropped += stats["dropped"]
+        return relayed, dropped
+
+    def addresses(self):
+        return [
+            tuple(address)
+            for message, _ in self.ask(b"addresses")
+            for address in message["addresses"]
+        ]
+
+    def take_all(self):
+        """
+        (address, client_socket, nat_socket) for every connection of every worker,
+        the sockets being this process's own copies
+        """
+        connections = []
+        for message, fds in self.ask(b"take"):
+            sockets = [socket.socket(fileno=fd) for fd in fds]
+            for i, address in enumerate(message["addresses"]):
+                connections.append((tuple(address), sockets[2 * i], sockets[2 * i + 1]))
+        return connections